@@ -0,0 +1,234 @@
+"""
+Result cache for the /analytics endpoints.
+
+Entries are keyed on endpoint plus normalized parameters (None dropped,
+dates in ISO form). Each entry remembers which tables it reads and the
+day range it covers; when rows of a table are written (db write
+listener), only entries whose range contains a written row's day are
+invalidated. The rollups bucket days with toDate in the ClickHouse
+server timezone, which the writer does not know, so a write invalidates
+its UTC day and both neighbours. Endpoints without a date range depend
+on every day.
+
+Stale-while-revalidate: an entry is fresh for ANALYTICS_CACHE_TTL
+seconds. After that, or once invalidated, it is still served for up to
+ANALYTICS_CACHE_STALE_TTL seconds from when it was computed while a
+background worker recomputes it. Older entries are recomputed inline.
+
+The cache is per process, so an invalidation in one worker reaches other
+workers only through their TTL.
+"""
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import db
+import metrics
+
+ANALYTICS_CACHE_ENABLED = os.getenv("ANALYTICS_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "30"))  # seconds
+ANALYTICS_CACHE_STALE_TTL = float(os.getenv("ANALYTICS_CACHE_STALE_TTL", "600"))  # seconds
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", "512"))
+ANALYTICS_CACHE_REFRESH_WORKERS = int(os.getenv("ANALYTICS_CACHE_REFRESH_WORKERS", "2"))
+
+# (first day, last day); None on either side means unbounded
+DayRange = Tuple[Optional[date], Optional[date]]
+_ALL_DAYS: DayRange = (None, None)
+
+
+def _day(value: Any) -> Optional[date]:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str) and len(value) >= 10:
+        try:
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            return None
+    return None
+
+
+def _written_days(value: Any) -> Set[Optional[date]]:
+    """Days a written timestamp may land on in the rollups (None = unknown)"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            value = _day(value)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    day = _day(value)
+    if day is None:
+        return {None}
+    # server timezones are within a day of UTC
+    return {day - timedelta(days=1), day, day + timedelta(days=1)}
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        value = value.strip()
+        day = _day(value) if len(value) == 10 else None
+        return day.isoformat() if day else value
+    return value
+
+
+def _covers(days: DayRange, day: Optional[date]) -> bool:
+    if day is None:
+        return True
+    first, last = days
+    return (first is None or day >= first) and (last is None or day <= last)
+
+
+class _Entry:
+    __slots__ = ("value", "computed", "stale", "tables", "days")
+
+    def __init__(self, value: Any, tables: Tuple[str, ...], days: DayRange, stale: bool = False):
+        self.value = value
+        self.computed = time.monotonic()
+        self.stale = stale
+        self.tables = tables
+        self.days = days
+
+
+class AnalyticsCache:
+    def __init__(self, ttl: float = ANALYTICS_CACHE_TTL, stale_ttl: float = ANALYTICS_CACHE_STALE_TTL,
+                 max_entries: int = ANALYTICS_CACHE_MAX_ENTRIES, enabled: bool = ANALYTICS_CACHE_ENABLED):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        # key -> (tables, days, invalidated while computing)
+        self._computing: Dict[tuple, List[Any]] = {}
+        self._refreshing: Set[tuple] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=ANALYTICS_CACHE_REFRESH_WORKERS,
+                                            thread_name_prefix="analytics-cache-refresh")
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0,
+                          "invalidations": 0}
+
+    def _count(self, name: str, endpoint: str, result: Optional[str] = None) -> None:
+        self._counters[name] += 1
+        if result:
+            metrics.ANALYTICS_CACHE_LOOKUPS.labels(endpoint, result).inc()
+
+    def _compute(self, key: tuple, compute: Callable[[], Any], tables: Tuple[str, ...], days: DayRange) -> Any:
+        with self._lock:
+            self._computing[key] = [tables, days, False]
+        try:
+            value = compute()
+        finally:
+            with self._lock:
+                _, _, invalidated = self._computing.pop(key)
+        with self._lock:
+            # a write that landed mid-computation may be missing from value
+            self._entries[key] = _Entry(value, tables, days, stale=invalidated)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def _refresh(self, key: tuple, compute: Callable[[], Any], tables: Tuple[str, ...], days: DayRange) -> None:
+        try:
+            self._compute(key, compute, tables, days)
+            with self._lock:
+                self._counters["refreshes"] += 1
+        except Exception as e:
+            with self._lock:
+                self._counters["refresh_errors"] += 1
+            print(f"[ANALYTICS CACHE] Refresh of {key[0]} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, endpoint: str, params: Dict[str, Any], compute: Callable[[], Any],
+            tables: Tuple[str, ...], days: DayRange = _ALL_DAYS) -> Any:
+        """Cached result of compute() for endpoint/params"""
+        if not self.enabled:
+            return compute()
+        key = (endpoint,) + tuple(sorted((k, _normalize(v)) for k, v in params.items() if v is not None))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry.computed
+                if age < self.ttl and not entry.stale:
+                    self._entries.move_to_end(key)
+                    self._count("hits", endpoint, "hit")
+                    return entry.value
+                if age < self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._count("stale_hits", endpoint, "stale")
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self._executor.submit(self._refresh, key, compute, tables, days)
+                    return entry.value
+            self._count("misses", endpoint, "miss")
+        return self._compute(key, compute, tables, days)
+
+    def invalidate(self, table: str, days: Iterable[Optional[date]] = (None,)) -> int:
+        """Mark entries reading `table` over any of `days` stale (None = every day)"""
+        days = set(days)
+        marked = 0
+        with self._lock:
+            for entry in self._entries.values():
+                if not entry.stale and table in entry.tables and any(_covers(entry.days, d) for d in days):
+                    entry.stale = True
+                    marked += 1
+            for pending in self._computing.values():
+                if table in pending[0] and any(_covers(pending[1], d) for d in days):
+                    pending[2] = True
+            self._counters["invalidations"] += marked
+        return marked
+
+    def on_written(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        """db write listener"""
+        days: Set[Optional[date]] = set()
+        for row in rows:
+            days |= _written_days(row.get("timestamp"))
+        self.invalidate(table, days)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def cached(self, tables: Iterable[str], dated: bool = False):
+        """Decorator for analytics handlers; with dated=True the handler's
+        start_date/end_date parameters bound the days its result depends on."""
+        tables = tuple(tables)
+
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(**kwargs):
+                days = (_day(kwargs.get("start_date")), _day(kwargs.get("end_date"))) if dated else _ALL_DAYS
+                return self.get(handler.__name__, kwargs, lambda: handler(**kwargs), tables, days)
+            return wrapper
+        return decorator
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            stale = sum(1 for entry in self._entries.values() if entry.stale)
+            entries = len(self._entries)
+            refreshing = len(self._refreshing)
+        lookups = counters["hits"] + counters["stale_hits"] + counters["misses"]
+        return {
+            "enabled": self.enabled,
+            "ttl_seconds": self.ttl,
+            "stale_ttl_seconds": self.stale_ttl,
+            "entries": entries,
+            "stale_entries": stale,
+            "refreshing": refreshing,
+            **counters,
+            "hit_ratio": round((counters["hits"] + counters["stale_hits"]) / lookups, 4) if lookups else 0.0,
+        }
+
+
+analytics_cache = AnalyticsCache()
+db._write_listeners.append(analytics_cache.on_written)
@@ -1,29 +1,237 @@
-import httpx
+"""
+Bearer-token checks for the operations service.
+
+Tokens are HS256 JWTs issued by user-service (auth.create_access_token).
+With AUTH_MODE=local (the default) they are verified here against the
+same keyring user-service signs with:
+
+- JWT_KEYS ("kid:secret,kid:secret"), or SECRET_KEY as kid "default".
+  To rotate, add the new key to both services, switch user-service's
+  JWT_ACTIVE_KID, and drop the old key once its tokens have expired.
+  Tokens signed with a kid this service does not know yet are sent to
+  user-service's /verify-token instead of being rejected.
+- Revoked tokens (logout, password change, user deletion) are fetched
+  from user-service's /revocations every AUTH_REVOCATION_SYNC_INTERVAL
+  seconds by a background thread (0 disables it). A failed sync keeps
+  the last list, so auth keeps working while user-service is down, and
+  a revocation takes up to one interval to apply here.
+
+AUTH_MODE=remote asks user-service about every token, as before. Only
+local mode caches verified tokens (identity_cache): a cache hit is only
+as fresh as the revocation list it is checked against, and remote mode
+does not sync one.
+"""
 import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from uuid import uuid4
+
+import httpx
+import requests
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from jose import JWTError, jwt
+
+import metrics
+from identity_cache import identity_cache
+from metrics import track_user_service
+from services import user_service_client
+from services.user_service_client import USER_SERVICE_URL
+
+AUTH_MODE = os.getenv("AUTH_MODE", "local").lower()  # local | remote
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+AUTH_REVOCATION_SYNC_INTERVAL = float(os.getenv("AUTH_REVOCATION_SYNC_INTERVAL", "15"))  # seconds
+# re-read this much before the previous sync so revocations committed
+# while it ran are not missed
+_SYNC_OVERLAP = timedelta(seconds=5)
 
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://localhost:8000")
 security = HTTPBearer()
 
 
-async def verify_token(token: str) -> dict:
+def _load_keys() -> Tuple[Dict[str, str], str]:
+    """Verification keys by kid, and the kid service tokens are signed with"""
+    keys = {}
+    for item in os.getenv("JWT_KEYS", "").split(","):
+        kid, _, secret = item.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret
+    if not keys:
+        keys = {"default": os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")}
+    active = os.getenv("JWT_ACTIVE_KID") or next(iter(keys))
+    return keys, active if active in keys else next(iter(keys))
+
+
+SIGNING_KEYS, ACTIVE_KID = _load_keys()
+
+
+class _UnknownKey(Exception):
+    pass
+
+
+def _timestamp(value: Any) -> float:
+    """Epoch seconds of an ISO datetime from user-service (naive means UTC)"""
+    moment = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+class RevocationList:
+    def __init__(self, interval: float = AUTH_REVOCATION_SYNC_INTERVAL):
+        self.interval = interval
+        self._tokens: Dict[str, float] = {}  # jti -> expiry
+        self._users: Dict[str, Tuple[int, float]] = {}  # username -> (revoked_before, expiry)
+        self._since: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_sync: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._counters = {"syncs": 0, "sync_errors": 0, "rejected": 0}
+
+    def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        jti = claims.get("jti")
+        user = self._users.get(claims.get("sub"))
+        revoked = (jti is not None and jti in self._tokens) or \
+            (user is not None and user[0] > claims.get("iat", 0))
+        if revoked:
+            self._counters["rejected"] += 1
+        return revoked
+
+    def _service_token(self) -> str:
+        now = datetime.now(timezone.utc)
+        claims = {"sub": "operations-service", "role": "service", "iat": int(now.timestamp()),
+                  "exp": now + timedelta(minutes=5), "jti": uuid4().hex}
+        return jwt.encode(claims, SIGNING_KEYS[ACTIVE_KID], algorithm=JWT_ALGORITHM, headers={"kid": ACTIVE_KID})
+
+    def sync(self) -> int:
+        """Fetch revocations recorded since the last sync; returns how many arrived"""
+        params = {"since": (self._since - _SYNC_OVERLAP).isoformat()} if self._since else {}
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            resp = requests.get(f"{USER_SERVICE_URL}/revocations", params=params, timeout=5.0,
+                                headers={"Authorization": f"Bearer {self._service_token()}"})
+            resp.raise_for_status()
+            outcome = "ok"
+        finally:
+            metrics.USER_SERVICE_SECONDS.labels("sync_revocations", outcome).observe(time.perf_counter() - started)
+        body = resp.json()
+        now = time.time()
+        with self._lock:
+            for entry in body["revocations"]:
+                expires = _timestamp(entry["expires_at"])
+                if entry.get("jti"):
+                    self._tokens[entry["jti"]] = expires
+                elif entry.get("revoked_before") is not None:
+                    current = self._users.get(entry["username"])
+                    if current is None or current[0] < entry["revoked_before"]:
+                        self._users[entry["username"]] = (int(entry["revoked_before"]), expires)
+            self._tokens = {jti: expires for jti, expires in self._tokens.items() if expires > now}
+            self._users = {user: entry for user, entry in self._users.items() if entry[1] > now}
+            self._since = datetime.fromisoformat(str(body["server_time"]).replace("Z", "+00:00"))
+            self._counters["syncs"] += 1
+        self.last_sync = now
+        return len(body["revocations"])
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+                self.last_error = None
+            except Exception as e:
+                self._counters["sync_errors"] += 1
+                self.last_error = str(e)
+                print(f"[AUTH] Revocation sync failed, keeping the last list: {e}")
+            if self._stopping.wait(self.interval):
+                return
+
+    def start(self):
+        if self.interval <= 0 or AUTH_MODE != "local":
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="auth-revocations", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens, users = len(self._tokens), len(self._users)
+        return {
+            "mode": AUTH_MODE,
+            "key_ids": sorted(SIGNING_KEYS),
+            "sync_interval_seconds": self.interval,
+            "revoked_tokens": tokens,
+            "revoked_users": users,
+            "last_sync_age_seconds": round(time.time() - self.last_sync, 1) if self.last_sync else None,
+            "last_error": self.last_error,
+            **self._counters,
+        }
+
+
+revocations = RevocationList()
+
+
+def _invalid_token() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid or expired token"
+    )
+
+
+def verify_token_locally(token: str) -> dict:
+    """Check signature, expiry and revocation without calling user-service"""
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid is not None and kid not in SIGNING_KEYS:
+            raise _UnknownKey(kid)
+        # tokens issued before key ids were added: try every key
+        secrets = [SIGNING_KEYS[kid]] if kid is not None else list(SIGNING_KEYS.values())
+        claims = None
+        for secret in secrets:
+            try:
+                claims = jwt.decode(token, secret, algorithms=[JWT_ALGORITHM])
+                break
+            except JWTError as e:
+                error = e
+        if claims is None:
+            raise error
+    except JWTError:
+        metrics.AUTH_VERIFICATIONS.labels("local", "invalid").inc()
+        raise _invalid_token()
+
+    if claims.get("sub") is None or revocations.is_revoked(claims):
+        metrics.AUTH_VERIFICATIONS.labels("local", "invalid").inc()
+        raise _invalid_token()
+    metrics.AUTH_VERIFICATIONS.labels("local", "valid").inc()
+    return {"valid": True, "username": claims["sub"], "role": claims.get("role")}
+
+
+async def verify_token_remote(token: str) -> dict:
     """Verify token with user service"""
-    async with httpx.AsyncClient() as client:
+    async with track_user_service("verify_token"):
         try:
-            response = await client.post(
-                f"{USER_SERVICE_URL}/verify-token",
+            response = await user_service_client.request(
+                "verify_token", "POST",
+                "/verify-token",
                 headers={"Authorization": f"Bearer {token}"},
                 timeout=5.0
             )
-            
+
             if response.status_code == 200:
+                metrics.AUTH_VERIFICATIONS.labels("remote", "valid").inc()
                 return response.json()
             else:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid or expired token"
-                )
+                metrics.AUTH_VERIFICATIONS.labels("remote", "invalid").inc()
+                raise _invalid_token()
         except httpx.RequestError:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -31,6 +239,24 @@ async def verify_token(token: str) -> dict:
             )
 
 
+async def _verify_uncached(token: str) -> dict:
+    if AUTH_MODE == "local":
+        try:
+            return verify_token_locally(token)
+        except _UnknownKey as e:
+            # signed with a key rotated in on user-service but not configured here yet
+            print(f"[AUTH] Unknown key id {e}, asking user-service")
+    return await verify_token_remote(token)
+
+
+async def verify_token(token: str) -> dict:
+    """Verify a bearer token; returns {valid, username, role}"""
+    if AUTH_MODE != "local":
+        # no revocation sync here, so a cached token would outlive its logout
+        return await _verify_uncached(token)
+    return await identity_cache.verified(token, _verify_uncached, revocations.is_revoked)
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     """Get current user from token"""
     token = credentials.credentials
@@ -0,0 +1,96 @@
+"""
+Point-lookup latency by primary ID: source table vs. ID-ordered mirror.
+
+Builds a scratch copy of `classes` (sorted by start_time, class_id) plus
+its `_by_id` mirror fed by a materialized view, fills it server-side, and
+times select-by-class_id against both. Rows read per lookup come from the
+X-ClickHouse-Summary header. Scratch tables are dropped at the end.
+
+    cd operations-service
+    CLICKHOUSE_HOST=localhost python benchmarks/id_lookup.py [rows] [lookups]
+"""
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from migrations.ddl import column_names, create_mirror  # noqa: E402
+from migrations.versions.v0001_versioned_tables import TABLES, create_sql  # noqa: E402
+
+TABLE = "bench_classes"
+MIRROR = "bench_classes_by_id"
+
+
+def setup(rows: int):
+    teardown()
+    db._http_post(create_sql("classes", TABLE))
+    create_mirror(MIRROR, TABLE, TABLES["classes"][0], "class_id", index_granularity=1024)
+    column_list = ", ".join(column_names(TABLES["classes"][0]))
+    # start times spread over ~2 years, in 1M-row inserts to keep server memory flat
+    chunk = 1_000_000
+    for offset in range(0, rows, chunk):
+        n = min(chunk, rows - offset)
+        db._http_post(
+            f"INSERT INTO {TABLE} ({column_list}) SELECT generateUUIDv4(), concat('class-', toString(number)), "
+            f"generateUUIDv4(), generateUUIDv4(), now() - (number * 7 % 63072000), "
+            f"now() - (number * 7 % 63072000) + 3600, 20, 15.0, NULL, toUnixTimestamp64Nano(now64(9)), 1 "
+            f"FROM numbers({offset}, {n})"
+        )
+    db._http_post(f"OPTIMIZE TABLE {TABLE} FINAL")
+    db._http_post(f"OPTIMIZE TABLE {MIRROR} FINAL")
+
+
+def teardown():
+    db._http_post(f"DROP VIEW IF EXISTS {MIRROR}_mv")
+    db._http_post(f"DROP TABLE IF EXISTS {MIRROR}")
+    db._http_post(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+def sample_ids(n: int):
+    rows = db.query(f"SELECT class_id FROM {TABLE} ORDER BY rand() LIMIT {n}")
+    return [row["class_id"] for row in rows]
+
+
+def measure(source: str, ids):
+    samples = []
+    rows_read = []
+    for class_id in ids:
+        sql = f"SELECT * FROM {source} WHERE class_id = {db._literal(class_id)} LIMIT 1 FORMAT JSONCompactEachRow"
+        started = time.perf_counter()
+        resp = db._http_post(sql)
+        samples.append((time.perf_counter() - started) * 1000)
+        summary = json.loads(resp.headers.get("X-ClickHouse-Summary", "{}"))
+        rows_read.append(int(summary.get("read_rows", 0)))
+    samples.sort()
+    return {
+        "mean_ms": round(statistics.mean(samples), 2),
+        "p50_ms": round(samples[len(samples) // 2], 2),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 2),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "mean_rows_read": int(statistics.mean(rows_read)),
+    }
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print(f"Preparing {TABLE} with {rows} rows...")
+    setup(rows)
+    try:
+        ids = sample_ids(n)
+        source = measure(TABLE, ids)
+        mirror = measure(MIRROR, ids)
+        print(f"\n{n} lookups by class_id over {rows} rows")
+        print(f"  source (start_time, class_id) : {source}")
+        print(f"  mirror (class_id)             : {mirror}")
+        print(f"  speedup (mean)                : {source['mean_ms'] / mirror['mean_ms']:.1f}x")
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
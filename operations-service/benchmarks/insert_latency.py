@@ -0,0 +1,96 @@
+"""
+Insert latency: read-before-write duplicate check vs. ID filter + dedup token.
+
+Runs against the ClickHouse configured through the usual CLICKHOUSE_* env
+vars, using a scratch copy of the attendances table that is dropped at the
+end. The scratch table is pre-filled so the old path's duplicate check has
+to scan realistic data.
+
+    cd operations-service
+    CLICKHOUSE_HOST=localhost python benchmarks/insert_latency.py [prefill_rows] [inserts]
+"""
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+TABLE = "bench_attendances"
+
+
+def setup(prefill: int):
+    db._http_post(f"DROP TABLE IF EXISTS {TABLE}")
+    db._http_post(
+        f"CREATE TABLE {TABLE} (event_id UUID, class_id UUID, member_id String, timestamp DateTime, status String) "
+        f"ENGINE = MergeTree() PARTITION BY toYYYYMM(timestamp) ORDER BY (class_id, timestamp, event_id) "
+        f"SETTINGS non_replicated_deduplication_window = {db.CLICKHOUSE_DEDUP_WINDOW}"
+    )
+    db._http_post(
+        f"INSERT INTO {TABLE} SELECT generateUUIDv4(), generateUUIDv4(), toString(number % 5000), "
+        f"now() - number, 'confirmed' FROM numbers({prefill})"
+    )
+    # the benchmark table shares the attendances ID column
+    db._ID_FIELDS[TABLE] = "event_id"
+    db._id_filter(TABLE).warmed = True
+
+
+def row():
+    return {
+        "event_id": str(uuid4()),
+        "class_id": str(uuid4()),
+        "member_id": "bench",
+        "timestamp": datetime.utcnow(),
+        "status": "confirmed",
+    }
+
+
+def old_insert(obj):
+    # the pre-change path: full select on event_id, then insert
+    if db.select_one(TABLE, "event_id", obj["event_id"]):
+        raise ValueError("duplicate")
+    db._http_post(db._insert_sql(TABLE), data=db._row_json(obj) + "\n")
+
+
+def new_insert(obj):
+    db.insert_one(TABLE, obj)
+
+
+def measure(fn, n: int):
+    samples = []
+    for _ in range(n):
+        obj = row()
+        started = time.perf_counter()
+        fn(obj)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": round(statistics.mean(samples), 2),
+        "p50_ms": round(samples[len(samples) // 2], 2),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 2),
+    }
+
+
+def main():
+    prefill = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print(f"Preparing {TABLE} with {prefill} rows...")
+    setup(prefill)
+    try:
+        old = measure(old_insert, n)
+        new = measure(new_insert, n)
+        print(f"\n{n} single-row inserts with caller-supplied IDs")
+        print(f"  read-before-write : {old}")
+        print(f"  ID filter + token : {new}")
+        print(f"  speedup (mean)    : {old['mean_ms'] / new['mean_ms']:.1f}x")
+        print(f"  filter stats      : {db.get_id_filter_stats()[TABLE]}")
+    finally:
+        db._http_post(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Overbooking under burst load: check-then-insert vs. seat reservations.
+
+Fires thousands of concurrent bookings at a few small classes. Each
+booking waits a random 1-20 ms between admission and writing the
+attendance (standing in for the balance deduction and payment insert),
+and 5% fail at that point and roll back. Attendance rows go through the
+same db queue listener the write buffer uses, so the roster sees them
+exactly as in the service. Nothing touches ClickHouse.
+
+- naive: read the roster's seat count, then write (what book_class did)
+- reserve (async): seat_reservations.areserve / confirm / release
+- reserve (threads): the sync reserve from a thread pool, as the
+  threadpool routes use it
+
+    cd operations-service
+    python benchmarks/seat_reservations.py [bookings] [classes] [capacity] [threads]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from roster_index import roster_index  # noqa: E402
+from seat_reservations import seat_reservations, SeatUnavailableError  # noqa: E402
+
+FAILURE_RATE = 0.05
+DUPLICATE_RATE = 0.05
+
+
+def new_classes(n: int):
+    class_ids = [str(uuid4()) for _ in range(n)]
+    # empty, loaded rosters (what a warm-up of fresh classes produces)
+    roster_index._merge(class_ids, [], time.time_ns(), touch=True)
+    return class_ids
+
+
+def requests_for(class_ids, bookings: int):
+    members = [f"member-{i}" for i in range(bookings)]
+    requests = []
+    for i in range(bookings):
+        # a few members double-submit
+        member = members[i - 1] if i and random.random() < DUPLICATE_RATE else members[i]
+        requests.append((random.choice(class_ids), member))
+    return requests
+
+
+def write_attendance(class_id: str, member_id: str):
+    db._queued("attendances", [{"event_id": str(uuid4()), "class_id": class_id,
+                                "member_id": member_id, "status": "confirmed"}])
+
+
+def summarize(label, class_ids, capacity, outcomes, latencies, elapsed):
+    seats = [roster_index.peek(class_id)[0] for class_id in class_ids]
+    overbooked = sum(max(0, s - capacity) for s in seats)
+    latencies.sort()
+    print(f"\n{label}")
+    print(f"  bookings            : {sum(outcomes.values())} in {elapsed:.2f}s "
+          f"({sum(outcomes.values()) / elapsed:.0f}/s)")
+    print(f"  outcomes            : {outcomes}")
+    print(f"  seats taken         : {sum(seats)} of {capacity * len(class_ids)}")
+    print(f"  overbooked seats    : {overbooked}")
+    print(f"  admission p50/p99   : {latencies[len(latencies) // 2] * 1e6:.1f} / "
+          f"{latencies[int(len(latencies) * 0.99) - 1] * 1e6:.1f} us "
+          f"(mean {statistics.mean(latencies) * 1e6:.1f} us)")
+
+
+async def run_naive(requests, capacity):
+    outcomes = {"booked": 0, "full": 0, "failed": 0}
+    latencies = []
+
+    async def book(class_id, member_id):
+        started = time.perf_counter()
+        seats, _ = roster_index.peek(class_id, member_id)
+        latencies.append(time.perf_counter() - started)
+        if seats >= capacity:
+            outcomes["full"] += 1
+            return
+        await asyncio.sleep(random.uniform(0.001, 0.02))
+        if random.random() < FAILURE_RATE:
+            outcomes["failed"] += 1
+            return
+        write_attendance(class_id, member_id)
+        outcomes["booked"] += 1
+
+    await asyncio.gather(*(book(c, m) for c, m in requests))
+    return outcomes, latencies
+
+
+async def run_reserve_async(requests, capacity):
+    outcomes = {"booked": 0, "full": 0, "duplicate": 0, "failed": 0}
+    latencies = []
+
+    async def book(class_id, member_id):
+        started = time.perf_counter()
+        try:
+            reservation = await seat_reservations.areserve(class_id, member_id, capacity)
+        except SeatUnavailableError as e:
+            latencies.append(time.perf_counter() - started)
+            outcomes[e.reason] += 1
+            return
+        latencies.append(time.perf_counter() - started)
+        try:
+            await asyncio.sleep(random.uniform(0.001, 0.02))
+            if random.random() < FAILURE_RATE:
+                outcomes["failed"] += 1
+                return
+            write_attendance(class_id, member_id)
+            seat_reservations.confirm(reservation)
+            outcomes["booked"] += 1
+        finally:
+            seat_reservations.release(reservation)
+
+    await asyncio.gather(*(book(c, m) for c, m in requests))
+    return outcomes, latencies
+
+
+def run_reserve_threads(requests, capacity, threads):
+    outcomes = {"booked": 0, "full": 0, "duplicate": 0, "failed": 0}
+    latencies = []
+
+    def book(request):
+        class_id, member_id = request
+        started = time.perf_counter()
+        try:
+            reservation = seat_reservations.reserve(class_id, member_id, capacity)
+        except SeatUnavailableError as e:
+            return e.reason, time.perf_counter() - started
+        latency = time.perf_counter() - started
+        try:
+            time.sleep(random.uniform(0.001, 0.02))
+            if random.random() < FAILURE_RATE:
+                return "failed", latency
+            write_attendance(class_id, member_id)
+            seat_reservations.confirm(reservation)
+            return "booked", latency
+        finally:
+            seat_reservations.release(reservation)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for outcome, latency in pool.map(book, requests):
+            outcomes[outcome] += 1
+            latencies.append(latency)
+    return outcomes, latencies
+
+
+def main():
+    bookings = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_classes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+    print(f"{bookings} concurrent bookings over {n_classes} classes of {capacity} seats")
+
+    for label, runner in (
+        ("naive check-then-insert (async)", lambda r: asyncio.run(run_naive(r, capacity))),
+        ("seat reservations (async)", lambda r: asyncio.run(run_reserve_async(r, capacity))),
+        (f"seat reservations ({threads} threads)", lambda r: run_reserve_threads(r, capacity, threads)),
+    ):
+        class_ids = new_classes(n_classes)
+        requests = requests_for(class_ids, bookings)
+        started = time.perf_counter()
+        outcomes, latencies = runner(requests)
+        summarize(label, class_ids, capacity, outcomes, latencies, time.perf_counter() - started)
+    print(f"\nreservation counters: {seat_reservations.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Booking-path user-service latency: per-call clients vs. the shared pool.
+
+Times the user-service part of /bookings/book-class (token check, then
+the balance deduction) against a running user-service:
+
+- per-call: POST /verify-token and POST /balance/deduct, each through a
+  new httpx.AsyncClient (what the service did before)
+- shared pool: the same two calls over the shared client
+  (auth_middleware.verify_token_remote, deduct_user_balance)
+- shared pool + local auth: auth_middleware.verify_token (local check,
+  cached) and deduct_user_balance; needs user-service's SECRET_KEY or
+  JWT_KEYS in the environment
+
+Each variant runs sequentially and then with [concurrency] bookings in
+flight. Every booking deducts 0.01 from a balance topped up for the
+run; whatever is left of the top-up is taken back at the end. Without
+BENCH_USERNAME/BENCH_PASSWORD a scratch member is registered (and left
+in place).
+
+    cd operations-service
+    USER_SERVICE_URL=http://localhost:8000 python benchmarks/user_service_pool.py [bookings] [concurrency]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from uuid import uuid4
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth_middleware import verify_token, verify_token_remote  # noqa: E402
+from services import user_service_client  # noqa: E402
+from services.user_balance_service import deduct_user_balance  # noqa: E402
+from services.user_service_client import USER_SERVICE_URL  # noqa: E402
+
+AMOUNT = 0.01
+_deducted = [0]  # bookings charged so far
+
+
+async def login() -> tuple:
+    username = os.getenv("BENCH_USERNAME")
+    password = os.getenv("BENCH_PASSWORD")
+    async with httpx.AsyncClient(base_url=USER_SERVICE_URL, timeout=10.0) as client:
+        if not username:
+            username, password = f"bench{uuid4().hex[:12]}", uuid4().hex
+            resp = await client.post("/register", json={
+                "username": username, "email": f"{username}@bench.local", "full_name": "Benchmark",
+                "password": password, "role": "member",
+            })
+            resp.raise_for_status()
+            print(f"Registered scratch member {username}")
+        resp = await client.post("/login", json={"username": username, "password": password})
+        resp.raise_for_status()
+        token = resp.json()["access_token"]
+        resp = await client.get("/me", headers={"Authorization": f"Bearer {token}"})
+        resp.raise_for_status()
+        user = resp.json()
+        return token, user.get("_id") or user.get("id")
+
+
+async def adjust_balance(token: str, user_id: str, path: str, amount: float) -> None:
+    async with httpx.AsyncClient(base_url=USER_SERVICE_URL, timeout=10.0) as client:
+        resp = await client.post(f"/users/{user_id}/balance/{path}", json={"amount": round(amount, 2)},
+                                 headers={"Authorization": f"Bearer {token}"})
+        resp.raise_for_status()
+
+
+async def per_call(token: str, user_id: str) -> None:
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient() as client:
+        resp = await client.post(f"{USER_SERVICE_URL}/verify-token", headers=headers, timeout=5.0)
+        resp.raise_for_status()
+    async with httpx.AsyncClient() as client:
+        resp = await client.post(f"{USER_SERVICE_URL}/users/{user_id}/balance/deduct", headers=headers,
+                                 json={"amount": AMOUNT}, timeout=5.0)
+        resp.raise_for_status()
+    _deducted[0] += 1
+
+
+async def shared_pool(token: str, user_id: str) -> None:
+    await verify_token_remote(token)
+    await deduct_user_balance(user_id, AMOUNT, token)
+    _deducted[0] += 1
+
+
+async def shared_pool_local_auth(token: str, user_id: str) -> None:
+    await verify_token(token)
+    await deduct_user_balance(user_id, AMOUNT, token)
+    _deducted[0] += 1
+
+
+async def run(booking, token: str, user_id: str, bookings: int, concurrency: int) -> dict:
+    samples = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with limit:
+            started = time.perf_counter()
+            await booking(token, user_id)
+            samples.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(bookings)))
+    elapsed = time.perf_counter() - started
+    samples.sort()
+    return {
+        "per_second": round(bookings / elapsed),
+        "mean_ms": round(statistics.mean(samples), 2),
+        "p50_ms": round(samples[len(samples) // 2], 2),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 2),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 2),
+    }
+
+
+async def main():
+    bookings = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    token, user_id = await login()
+    # three variants, two runs each, plus warm-ups
+    top_up = (6 * bookings + 3) * AMOUNT
+    await adjust_balance(token, user_id, "add", top_up)
+    try:
+        print(f"\n{bookings} bookings against {USER_SERVICE_URL}")
+        for label, booking in (("per-call clients", per_call), ("shared pool", shared_pool),
+                               ("shared + local auth", shared_pool_local_auth)):
+            await booking(token, user_id)  # warm-up (imports, first connection, token cache)
+            sequential = await run(booking, token, user_id, bookings, 1)
+            concurrent = await run(booking, token, user_id, bookings, concurrency)
+            print(f"  {label:<19} sequential   : {sequential}")
+            print(f"  {label:<19} {concurrency:>3} in flight : {concurrent}")
+        print(f"\npool: {user_service_client.get_pool_stats()}")
+    finally:
+        await user_service_client.aclose_client()
+        leftover = top_up - _deducted[0] * AMOUNT
+        if leftover >= AMOUNT:
+            await adjust_balance(token, user_id, "deduct", leftover)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
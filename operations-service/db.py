@@ -1,188 +1,1001 @@
+import asyncio
 import os
 import json
+import base64
+import hashlib
+import operator
+import threading
+import time
 from datetime import datetime, date
 from uuid import UUID, uuid4
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from utils.rowbinary import decode_rowbinary
+from utils.bloom import BloomFilter
+import metrics
 
 CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "clickhouse")
 CLICKHOUSE_PORT = os.getenv("CLICKHOUSE_PORT", "8123")
 CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "admin")
 CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "admin")
 
+# Connection pool tuning
+CLICKHOUSE_POOL_CONNECTIONS = int(os.getenv("CLICKHOUSE_POOL_CONNECTIONS", "4"))  # number of per-host pools kept
+CLICKHOUSE_POOL_MAXSIZE = int(os.getenv("CLICKHOUSE_POOL_MAXSIZE", "32"))  # max keep-alive connections per host
+CLICKHOUSE_POOL_BLOCK = os.getenv("CLICKHOUSE_POOL_BLOCK", "false").lower() in ("1", "true", "yes")
+CLICKHOUSE_CONNECT_TIMEOUT = float(os.getenv("CLICKHOUSE_CONNECT_TIMEOUT", "3"))
+CLICKHOUSE_READ_TIMEOUT = float(os.getenv("CLICKHOUSE_READ_TIMEOUT", "60"))
+CLICKHOUSE_KEEPALIVE = os.getenv("CLICKHOUSE_KEEPALIVE", "true").lower() in ("1", "true", "yes")
+
+# Inserts: let ClickHouse batch small inserts server-side (async_insert)
+CLICKHOUSE_ASYNC_INSERT = os.getenv("CLICKHOUSE_ASYNC_INSERT", "false").lower() in ("1", "true", "yes")
+CLICKHOUSE_WAIT_FOR_ASYNC_INSERT = os.getenv("CLICKHOUSE_WAIT_FOR_ASYNC_INSERT", "true").lower() in ("1", "true", "yes")
+
+# Duplicate-ID detection without a read on the write path: a local Bloom
+# filter of known IDs plus ClickHouse insert deduplication tokens. The filter
+# only sees this process's writes; with several writer processes set
+# ID_FILTER_WARM=false so every caller-supplied ID is verified by a read.
+ID_FILTER_CAPACITY = int(os.getenv("ID_FILTER_CAPACITY", "1000000"))
+ID_FILTER_ERROR_RATE = float(os.getenv("ID_FILTER_ERROR_RATE", "0.001"))
+ID_FILTER_WARM = os.getenv("ID_FILTER_WARM", "true").lower() in ("1", "true", "yes")
+CLICKHOUSE_DEDUP_WINDOW = int(os.getenv("CLICKHOUSE_DEDUP_WINDOW", "1000"))
+
+# Reads by ID or member go through re-sorted mirror tables (see LOOKUP_MIRRORS)
+CLICKHOUSE_MIRRORS = os.getenv("CLICKHOUSE_MIRRORS", "true").lower() in ("1", "true", "yes")
+
+# Wire format used for row reads: "JSONCompactEachRow" or "RowBinary"
+CLICKHOUSE_READ_FORMAT = os.getenv("CLICKHOUSE_READ_FORMAT", "JSONCompactEachRow")
+
 _BASE_URL = f"http://{CLICKHOUSE_HOST}:{CLICKHOUSE_PORT}"
 
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
 
-def _http_post(query: str, data: Optional[str] = None) -> requests.Response:
-    url = _BASE_URL
+
+def _get_session() -> requests.Session:
+    """Return the process-wide ClickHouse session, creating it on first use"""
+    global _session
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is not None:
+            return _session
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=CLICKHOUSE_POOL_CONNECTIONS,
+            pool_maxsize=CLICKHOUSE_POOL_MAXSIZE,
+            pool_block=CLICKHOUSE_POOL_BLOCK,
+            max_retries=0,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Only send HTTP basic auth when both user and password are provided
+        if CLICKHOUSE_USER and CLICKHOUSE_PASSWORD:
+            session.auth = (CLICKHOUSE_USER, CLICKHOUSE_PASSWORD)
+        if not CLICKHOUSE_KEEPALIVE:
+            session.headers["Connection"] = "close"
+        _session = session
+        return _session
+
+
+def close_session() -> None:
+    """Close all pooled ClickHouse connections (called on shutdown)"""
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    """Return the shared async ClickHouse client, creating it on first use"""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            base_url=_BASE_URL,
+            auth=(CLICKHOUSE_USER, CLICKHOUSE_PASSWORD) if CLICKHOUSE_USER and CLICKHOUSE_PASSWORD else None,
+            limits=httpx.Limits(
+                max_connections=CLICKHOUSE_POOL_MAXSIZE,
+                max_keepalive_connections=CLICKHOUSE_POOL_MAXSIZE if CLICKHOUSE_KEEPALIVE else 0,
+            ),
+            timeout=httpx.Timeout(CLICKHOUSE_READ_TIMEOUT, connect=CLICKHOUSE_CONNECT_TIMEOUT),
+        )
+    return _async_client
+
+
+async def aclose_async_client() -> None:
+    """Close the shared async ClickHouse client (called on shutdown)"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Connection reuse statistics for the ClickHouse pool"""
+    stats = {
+        "pool_maxsize": CLICKHOUSE_POOL_MAXSIZE,
+        "pool_block": CLICKHOUSE_POOL_BLOCK,
+        "keepalive": CLICKHOUSE_KEEPALIVE,
+        "hosts": [],
+    }
+    if _session is None:
+        return stats
+
+    adapter = _session.get_adapter(_BASE_URL)
+    for key in list(adapter.poolmanager.pools.keys()):
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is None:
+            continue
+        requests_served = pool.num_requests
+        connections_opened = pool.num_connections
+        # urllib3 pre-fills the queue with None placeholders; only real sockets are idle connections
+        idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+        stats["hosts"].append({
+            "host": f"{pool.host}:{pool.port}",
+            "requests": requests_served,
+            "connections_opened": connections_opened,
+            "idle_connections": idle,
+            "reuse_ratio": round(1 - connections_opened / requests_served, 4) if requests_served else 0.0,
+        })
+    return stats
+
+
+def _clickhouse_error(status_code: int, error_body: str, query: str, data: Optional[str]) -> RuntimeError:
+    # Include ClickHouse error details in exception
+    return RuntimeError(
+        f"ClickHouse error {status_code}: {error_body}\n"
+        f"Query: {query}\n"
+        f"Data: {data[:500] if data else 'None'}"
+    )
+
+
+# Sent with every request. Tables are versioned (see migrations), so reads
+# apply FINAL to collapse each row to its latest state; a row's versions
+# never span partitions, which makes per-partition FINAL safe.
+_BASE_SETTINGS = {
     # Ensure ClickHouse ALTER UPDATE/DELETE wait for completion
-    params = {"query": query, "mutations_sync": "1"}
-    # Only send HTTP basic auth when both user and password are provided
-    if CLICKHOUSE_USER and CLICKHOUSE_PASSWORD:
-        auth = (CLICKHOUSE_USER, CLICKHOUSE_PASSWORD)
-    else:
-        auth = None
-    if data is None:
-        resp = requests.post(url, params=params, auth=auth)
-    else:
-        resp = requests.post(url, params=params, data=data.encode('utf-8'), auth=auth)
-    
+    "mutations_sync": "1",
+    "final": "1",
+    "do_not_merge_across_partitions_select_final": "1",
+}
+
+
+def _http_post(query: str, data: Optional[str] = None, settings: Optional[Dict[str, str]] = None) -> requests.Response:
+    url = _BASE_URL
+    params = {"query": query, **_BASE_SETTINGS, **(settings or {})}
+    session = _get_session()
+    timeout = (CLICKHOUSE_CONNECT_TIMEOUT, CLICKHOUSE_READ_TIMEOUT)
+    started = time.perf_counter()
+    resp = None
+    try:
+        if data is None:
+            resp = session.post(url, params=params, timeout=timeout)
+        else:
+            resp = session.post(url, params=params, data=data.encode('utf-8'), timeout=timeout)
+    finally:
+        metrics.observe_clickhouse(query, time.perf_counter() - started, resp)
+
     try:
         resp.raise_for_status()
     except requests.HTTPError as e:
-        # Include ClickHouse error details in exception
         error_body = ""
         try:
             error_body = resp.text
         except:
             error_body = "<unable to read response>"
-        raise RuntimeError(
-            f"ClickHouse error {resp.status_code}: {error_body}\n"
-            f"Query: {query}\n"
-            f"Data: {data[:500] if data else 'None'}"
-        ) from e
+        raise _clickhouse_error(resp.status_code, error_body, query, data) from e
     return resp
 
 
-def init_tables():
-    stmts = [
-        "CREATE TABLE IF NOT EXISTS rooms (room_id UUID, name String, capacity Int32, has_equipment UInt8) ENGINE = MergeTree() ORDER BY (room_id)",
-        "CREATE TABLE IF NOT EXISTS trainers (trainer_id UUID, name String, email Nullable(String), specialization String, rating Nullable(Float64), experience_years Nullable(Int32)) ENGINE = MergeTree() ORDER BY (trainer_id)",
-        "CREATE TABLE IF NOT EXISTS payments (payment_id UUID, member_id String, class_id UUID, amount Float64, timestamp DateTime, status String DEFAULT 'completed') ENGINE = MergeTree() PARTITION BY toYYYYMM(timestamp) ORDER BY (class_id, timestamp)",
-        "CREATE TABLE IF NOT EXISTS classes (class_id UUID, name String, trainer_id Nullable(UUID), room_id Nullable(UUID), start_time DateTime, end_time DateTime, capacity Nullable(Int32), price Nullable(Float64), description Nullable(String)) ENGINE = MergeTree() PARTITION BY toYYYYMM(start_time) ORDER BY (start_time, class_id)",
-        "CREATE TABLE IF NOT EXISTS attendances (event_id UUID, class_id UUID, member_id String, timestamp DateTime, status String) ENGINE = MergeTree() PARTITION BY toYYYYMM(timestamp) ORDER BY (class_id, timestamp, event_id)",
-    ]
-    for s in stmts:
-        _http_post(s)
+async def _ahttp_post(query: str, data: Optional[str] = None, settings: Optional[Dict[str, str]] = None) -> httpx.Response:
+    """Async twin of _http_post running on the shared httpx pool"""
+    params = {"query": query, **_BASE_SETTINGS, **(settings or {})}
+    client = _get_async_client()
+    started = time.perf_counter()
+    resp = None
+    try:
+        if data is None:
+            resp = await client.post("/", params=params)
+        else:
+            resp = await client.post("/", params=params, content=data.encode('utf-8'))
+    finally:
+        metrics.observe_clickhouse(query, time.perf_counter() - started, resp)
 
+    if resp.is_error:
+        raise _clickhouse_error(resp.status_code, resp.text, query, data)
+    return resp
 
-def select_all(table: str) -> List[Dict[str, Any]]:
-    query = f"SELECT * FROM {table} FORMAT JSON"
-    resp = _http_post(query)
-    data = resp.json()
-    # ClickHouse JSON returns 'data' key with rows
-    return data.get("data", [])
 
+# Versioned-row storage: every table is a VersionedCollapsingMergeTree.
+# A row is written with _sign = 1; an update writes a cancel row (the old
+# state with _sign = -1 and its original _version) plus the new state under
+# a fresh _version, and a delete writes only the cancel row. Reads collapse
+# with FINAL, so no ALTER TABLE mutation is ever needed.
+VERSION_COLUMN = "_version"
+SIGN_COLUMN = "_sign"
+# Every read filters on this: a cancel row whose state it cancels is
+# missing survives FINAL and must never be returned or counted.
+LIVE_ROWS = f"{SIGN_COLUMN} = 1"
 
-def insert_one(table: str, obj: Dict[str, Any]):
-    # use JSONEachRow format; provide single JSON object with newline
-    query = f"INSERT INTO {table} FORMAT JSONEachRow"
-
-    # before inserting, handle id generation and duplicate prevention
-    id_field_map = {
-        "rooms": "room_id",
-        "trainers": "trainer_id",
-        "payments": "payment_id",
-        "classes": "class_id",
-        "attendances": "event_id",
-    }
+# An update or delete reads the row's current version and then cancels it;
+# two of them on the same row must not interleave, or both cancel the same
+# version. Striped by (table, ID). The locks are per process, which covers
+# the single uvicorn worker the service runs as.
+ROW_LOCK_STRIPES = 256
+_row_locks = [threading.Lock() for _ in range(ROW_LOCK_STRIPES)]
+
+
+def row_lock(table: str, value: Any) -> threading.Lock:
+    """Lock serializing version writes to one row"""
+    return _row_locks[hash((table, str(value))) % ROW_LOCK_STRIPES]
+
+# Mirrors of the time-ordered tables, re-sorted for other access paths
+# (built by migrations/versions). A materialized view copies every inserted
+# row, cancel rows included, so a mirror collapses exactly like its source.
+#
+# ID-ordered mirrors: lookups by ID hit the primary index instead of
+# scanning every granule.
+LOOKUP_MIRRORS = {
+    "classes": "classes_by_id",
+    "payments": "payments_by_id",
+    "attendances": "attendances_by_id",
+}
+# Member-ordered mirrors: a member's history is a few granules.
+MEMBER_MIRRORS = {
+    "payments": "payments_by_member",
+    "attendances": "attendances_by_member",
+}
+# mirrors whose backfill has finished (see refresh_mirrors)
+_ready_mirrors: set = set()
+
+
+def refresh_mirrors() -> None:
+    """Load which mirrors are built; reads use a mirror only once it is ready"""
+    global _ready_mirrors
+    rows = query(
+        "SELECT name FROM system.tables WHERE database = currentDatabase() AND comment = 'mirror:ready'"
+    )
+    _ready_mirrors = {row["name"] for row in rows}
+
+
+def _lookup_source(table: str, key: str) -> str:
+    """Table to read for a lookup on `key`: the ID mirror when there is one"""
+    if CLICKHOUSE_MIRRORS and key == _ID_FIELDS.get(table) and LOOKUP_MIRRORS.get(table) in _ready_mirrors:
+        return LOOKUP_MIRRORS[table]
+    return table
+
+
+def id_source(table: str) -> str:
+    """Table to read for queries filtered by the table's ID"""
+    return _lookup_source(table, _ID_FIELDS[table])
+
+
+def member_source(table: str) -> str:
+    """Table to read for queries filtered by member_id"""
+    if CLICKHOUSE_MIRRORS and MEMBER_MIRRORS.get(table) in _ready_mirrors:
+        return MEMBER_MIRRORS[table]
+    return table
+
+
+def _filter_source(table: str, filters: Dict[str, Any]) -> str:
+    if filters.get(_ID_FIELDS.get(table)) is not None:
+        return _lookup_source(table, _ID_FIELDS[table])
+    if filters.get("member_id") is not None:
+        return member_source(table)
+    return table
+
+
+_ID_FIELDS = {
+    "rooms": "room_id",
+    "trainers": "trainer_id",
+    "payments": "payment_id",
+    "classes": "class_id",
+    "attendances": "event_id",
+}
+
+
+def _literal(value: Any) -> str:
+    """Render a Python value as a ClickHouse SQL literal"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return str(value)
+    value = _normalize(value)
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+        return f"'{escaped}'"
+    return str(value)
+
+
+# Compact result formats: the SQL suffix to request and the settings that make
+# ClickHouse emit 64-bit numbers as JSON numbers instead of quoted strings
+_FORMAT_SUFFIX = {
+    "JSONCompactEachRow": "JSONCompactEachRowWithNames",
+    "RowBinary": "RowBinaryWithNamesAndTypes",
+}
+_COMPACT_SETTINGS = {
+    "output_format_json_quote_64bit_integers": "0",
+    "output_format_json_quote_64bit_floats": "0",
+}
+
+
+def _compact_sql(sql: str, fmt: Optional[str]) -> Tuple[str, str]:
+    fmt = fmt or CLICKHOUSE_READ_FORMAT
+    if fmt not in _FORMAT_SUFFIX:
+        raise ValueError(f"Unsupported result format {fmt}; expected one of {', '.join(_FORMAT_SUFFIX)}")
+    return f"{sql} FORMAT {_FORMAT_SUFFIX[fmt]}", fmt
+
+
+def _decode_compact(resp, fmt: str) -> Tuple[List[str], List[tuple]]:
+    """Decode a compact response (requests or httpx) into (column names, row tuples)"""
+    content = resp.content
+    if fmt == "RowBinary":
+        # DateTimes are rendered in the server timezone, as the JSON format does
+        return decode_rowbinary(content, resp.headers.get("X-ClickHouse-Timezone"))
+    lines = content.decode("utf-8").splitlines()
+    if not lines:
+        return [], []
+    names = json.loads(lines[0])
+    # one json.loads over the whole body is far cheaper than one per row
+    rows = json.loads("[" + ",".join(line for line in lines[1:] if line) + "]")
+    return names, [tuple(row) for row in rows]
 
-    id_field = id_field_map.get(table)
-    if id_field:
-        # if id provided, ensure not duplicate
-        if id_field in obj and obj.get(id_field) is not None:
-            existing = select_one(table, id_field, str(obj[id_field]))
-            if existing:
-                raise ValueError(f"Duplicate {id_field} {obj[id_field]} for table {table}")
-        else:
-            # generate UUID for id
-            obj[id_field] = str(uuid4())
 
+def _as_dicts(names: List[str], rows: List[tuple]) -> List[Dict[str, Any]]:
+    return [dict(zip(names, row)) for row in rows]
+
+
+def _as_columns(names: List[str], rows: List[tuple]) -> Dict[str, list]:
+    if not rows:
+        return {name: [] for name in names}
+    return {name: list(column) for name, column in zip(names, zip(*rows))}
+
+
+# ----------------------------------------------------------------------
+# Query builders shared by the sync and async APIs
+# ----------------------------------------------------------------------
+
+def _select_all_sql(table: str) -> str:
+    return f"SELECT * FROM {table} WHERE {LIVE_ROWS}"
+
+
+def _select_one_sql(table: str, key: str, value: Any) -> str:
+    return f"SELECT * FROM {_lookup_source(table, key)} WHERE {key} = {_literal(value)} AND {LIVE_ROWS} LIMIT 1"
+
+
+# Sort keys used for keyset pagination; each is the table's ORDER BY key,
+# extended with the row ID where the ORDER BY key alone is not unique
+ORDER_KEYS = {
+    "rooms": ("room_id",),
+    "trainers": ("trainer_id",),
+    "classes": ("start_time", "class_id"),
+    "payments": ("class_id", "timestamp", "payment_id"),
+    "attendances": ("class_id", "timestamp", "event_id"),
+}
+
+# Filter key suffixes understood by select_by_filters, e.g. {"timestamp__gte": ...}
+_FILTER_OPS = {
+    "eq": "=",
+    "ne": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+}
+
+
+def _filter_clause(key: str, value: Any) -> str:
+    column, _, op = key.partition("__")
+    if op == "in":
+        values = list(value)
+        if not values:
+            return "0"
+        return f"{column} IN ({', '.join(_literal(v) for v in values)})"
+    if op and op not in _FILTER_OPS:
+        raise ValueError(f"Unsupported filter operator '{op}' in {key}")
+    return f"{column} {_FILTER_OPS.get(op or 'eq')} {_literal(value)}"
+
+
+_MATCH_OPS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+
+def matches_filters(row: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    """Whether a row satisfies select_by_filters-style filters, evaluated in Python.
+
+    Both sides are normalized as for SQL literals, so UUIDs and datetimes
+    compare like the strings ClickHouse returns. None values are ignored.
+    """
+    for key, value in filters.items():
+        if value is None:
+            continue
+        column, _, op = key.partition("__")
+        actual = _normalize(row.get(column))
+        if op == "in":
+            if actual not in [_normalize(v) for v in value]:
+                return False
+            continue
+        expected = _normalize(value)
+        if isinstance(expected, (int, float)) and isinstance(actual, str):
+            try:
+                actual = float(actual)
+            except ValueError:
+                return False
+        try:
+            if not _MATCH_OPS[op or "eq"](actual, expected):
+                return False
+        except TypeError:
+            # e.g. a NULL column under a range filter; SQL would not match it either
+            return False
+    return True
+
+
+def _keyset_clause(columns: Tuple[str, ...], values: List[Any]) -> str:
+    """Expand (c1, c2, ...) > (v1, v2, ...) into comparisons the primary index can use"""
+    clause = f"{columns[-1]} > {_literal(values[-1])}"
+    for column, value in zip(reversed(columns[:-1]), reversed(values[:-1])):
+        clause = f"({column} > {_literal(value)} OR ({column} = {_literal(value)} AND {clause}))"
+    # redundant leading-column bound lets ClickHouse skip granules before the cursor
+    return f"{columns[0]} >= {_literal(values[0])} AND {clause}"
+
+
+def _select_by_filters_sql(table: str, filters: Dict[str, Any], order_by: Optional[str] = None,
+                           limit: Optional[int] = None, after: Optional[List[Any]] = None) -> str:
+    where_clauses = [_filter_clause(key, value) for key, value in (filters or {}).items() if value is not None]
+    where_clauses.append(LIVE_ROWS)
+    if after is not None:
+        where_clauses.append(_keyset_clause(ORDER_KEYS[table], after))
+    sql = f"SELECT * FROM {_filter_source(table, filters or {})} WHERE {' AND '.join(where_clauses)}"
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    return sql
+
+
+def encode_cursor(table: str, row: Dict[str, Any]) -> str:
+    """Opaque cursor holding the sort-key values of the last row of a page"""
+    values = [_normalize(row.get(column)) for column in ORDER_KEYS[table]]
+    raw = json.dumps(values, default=str, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(table: str, cursor: str) -> List[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(values, list) or len(values) != len(ORDER_KEYS[table]):
+        raise ValueError("Malformed cursor")
+    return values
+
+
+def _page_sql(table: str, filters: Dict[str, Any], limit: int, cursor: Optional[str]) -> str:
+    after = decode_cursor(table, cursor) if cursor else None
+    # fetch one extra row to know whether another page exists
+    return _select_by_filters_sql(table, filters, ", ".join(ORDER_KEYS[table]), limit + 1, after)
+
+
+def _split_page(table: str, rows: List[Dict[str, Any]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(table, rows[-1])
+
+
+def _assign_id(table: str, obj: Dict[str, Any]):
+    """Generate a UUID for the row's ID column if missing.
+
+    Returns (id_field, needs_duplicate_check).
+    """
+    id_field = _ID_FIELDS.get(table)
+    if not id_field:
+        return None, False
+    if id_field in obj and obj.get(id_field) is not None:
+        # if id provided, caller must ensure it is not a duplicate
+        return id_field, True
+    # generate UUID for id
+    obj[id_field] = str(uuid4())
+    return id_field, False
+
+
+def _next_version(previous: Any = None) -> int:
+    version = time.time_ns()
+    if previous is not None:
+        version = max(version, int(previous) + 1)
+    return version
+
+
+def _stamp_version(table: str, obj: Dict[str, Any]) -> None:
+    if table in _ID_FIELDS and obj.get(VERSION_COLUMN) is None:
+        obj[VERSION_COLUMN] = _next_version()
+        obj[SIGN_COLUMN] = 1
+
+
+def _row_json(obj: Dict[str, Any]) -> str:
     normalized = {k: _normalize(v) for k, v in obj.items()}
-    body = json.dumps(normalized, default=str) + "\n"
-    _http_post(query, data=body)
+    return json.dumps(normalized, default=str)
+
+
+def _insert_sql(table: str) -> str:
+    # use JSONEachRow format; one JSON object per line
+    return f"INSERT INTO {table} FORMAT JSONEachRow"
+
+
+def _insert_settings(async_insert: Optional[bool]) -> Dict[str, str]:
+    if async_insert is None:
+        async_insert = CLICKHOUSE_ASYNC_INSERT
+    if not async_insert:
+        return {}
+    return {
+        "async_insert": "1",
+        "wait_for_async_insert": "1" if CLICKHOUSE_WAIT_FOR_ASYNC_INSERT else "0",
+    }
+
+
+def _prepare_insert(table: str, obj: Dict[str, Any]):
+    """Assign an ID if missing and serialize the row.
+
+    Returns (sql, body, id_field, needs_duplicate_check).
+    """
+    id_field, needs_check = _assign_id(table, obj)
+    _stamp_version(table, obj)
+    return _insert_sql(table), _row_json(obj) + "\n", id_field, needs_check
+
+
+def _prepare_insert_many(table: str, objs: List[Dict[str, Any]]):
+    """Assign IDs and serialize a batch.
+
+    Returns (sql, body, id_field, ids, provided_ids) where provided_ids are
+    the caller-supplied IDs that still need a duplicate check.
+    """
+    id_field = _ID_FIELDS.get(table)
+    provided = []
+    for obj in objs:
+        _, needs_check = _assign_id(table, obj)
+        _stamp_version(table, obj)
+        if needs_check:
+            provided.append(str(obj[id_field]))
+    body = "".join(_row_json(obj) + "\n" for obj in objs)
+    ids = [obj.get(id_field) for obj in objs] if id_field else []
+    return _insert_sql(table), body, id_field, ids, provided
+
+
+def _existing_ids_sql(table: str, id_field: str, ids: List[str]) -> str:
+    return (f"SELECT {id_field} FROM {_lookup_source(table, id_field)} "
+            f"WHERE {_filter_clause(id_field + '__in', ids)} AND {LIVE_ROWS}")
+
+
+class DuplicateIdError(ValueError):
+    """Raised when an insert carries a caller-supplied ID that already exists"""
+    pass
+
+
+class _IdFilter:
+    """Bloom filter of the IDs a table is known to contain.
+
+    Until warm() has loaded the table's existing IDs every caller-supplied
+    ID is treated as suspect, so correctness never depends on warm-up.
+    """
+
+    def __init__(self):
+        self.bloom = BloomFilter(ID_FILTER_CAPACITY, ID_FILTER_ERROR_RATE)
+        self.warmed = False
+        self.skipped_reads = 0
+        self.verified_reads = 0
+        self.duplicates = 0
+
+
+_id_filters: Dict[str, _IdFilter] = {}
+_id_filters_lock = threading.Lock()
+
+
+def _id_filter(table: str) -> _IdFilter:
+    f = _id_filters.get(table)
+    if f is None:
+        with _id_filters_lock:
+            f = _id_filters.setdefault(table, _IdFilter())
+    return f
+
+
+def _suspect_ids(table: str, ids: List[str]) -> List[str]:
+    """IDs that may already exist and need a verifying read"""
+    f = _id_filter(table)
+    if not f.warmed:
+        suspects = list(ids)
+    else:
+        suspects = [i for i in ids if i in f.bloom]
+    f.skipped_reads += len(ids) - len(suspects)
+    f.verified_reads += len(suspects)
+    return suspects
+
+
+def _remember_ids(table: str, ids: List[Any]) -> None:
+    bloom = _id_filter(table).bloom
+    for i in ids:
+        if i is not None:
+            bloom.add(str(i))
+
+
+def _dedup_token(table: str, body: str) -> Dict[str, str]:
+    # keyed by content: a retried INSERT of the same body is dropped by
+    # ClickHouse, a different row under an existing ID is not (the ID check
+    # rejects that one)
+    return {"insert_deduplication_token": f"{table}:{hashlib.sha1(body.encode('utf-8')).hexdigest()}"}
+
+
+def warm_id_filters() -> None:
+    """Load every table's existing IDs into its filter (run in the background)"""
+    for table, id_field in _ID_FIELDS.items():
+        f = _id_filter(table)
+        try:
+            for row in stream_rows(f"SELECT {id_field} FROM {table} WHERE {LIVE_ROWS}"):
+                f.bloom.add(str(row[id_field]))
+            f.warmed = True
+        except Exception as e:
+            print(f"[ID FILTER] Could not warm {table}: {e}")
+
+
+def get_id_filter_stats() -> Dict[str, Any]:
+    return {
+        table: {
+            "warmed": f.warmed,
+            "ids": f.bloom.count,
+            "expected_false_positive_rate": round(f.bloom.saturation(), 6),
+            "skipped_reads": f.skipped_reads,
+            "verified_reads": f.verified_reads,
+            "duplicates_rejected": f.duplicates,
+        }
+        for table, f in _id_filters.items()
+    }
+
+
+def get_mutation_backlog() -> Dict[str, Any]:
+    """Unfinished ALTER mutations per table, from system.mutations"""
+    rows = query(
+        "SELECT table, count() AS pending, min(create_time) AS oldest, "
+        "countIf(latest_fail_reason != '') AS failing "
+        "FROM system.mutations WHERE database = currentDatabase() AND NOT is_done GROUP BY table"
+    )
+    return {
+        "pending": sum(int(row["pending"]) for row in rows),
+        "tables": {
+            row["table"]: {"pending": int(row["pending"]), "oldest": row["oldest"], "failing": int(row["failing"])}
+            for row in rows
+        },
+    }
+
+
+def _cancel_row(existing: Dict[str, Any]) -> Dict[str, Any]:
+    # identical to the stored state (same sort key and _version) with the opposite sign
+    return {**existing, SIGN_COLUMN: -1}
+
+
+def update_rows(key: str, existing: Dict[str, Any], obj: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Cancel row plus new state for an update of `existing`"""
+    changes = {k: v for k, v in obj.items() if k not in (key, VERSION_COLUMN, SIGN_COLUMN)}
+    new_state = {**existing, **changes, SIGN_COLUMN: 1, VERSION_COLUMN: _next_version(existing.get(VERSION_COLUMN))}
+    return [_cancel_row(existing), new_state]
+
+
+def delete_rows(existing: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Cancel row for a delete of `existing`"""
+    return [_cancel_row(existing)]
+
+
+# Read-your-writes hook for mutations that are queued but not yet written
+# (installed by mutation_queue); maps (table, rows, filters) to the rows as
+# they will be, dropping those a queued update moves outside the filters.
+_pending_overlay: Optional[Callable[[str, List[Dict[str, Any]], Optional[Dict[str, Any]]],
+                                    List[Dict[str, Any]]]] = None
+
+
+def _overlay(table: str, rows: List[Dict[str, Any]],
+             filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    return _pending_overlay(table, rows, filters) if _pending_overlay is not None and rows else rows
+
+
+# Rows accepted by write_buffer but not yet written, looked up by (table, ID)
+# (installed by write_buffer), so a row can be read back right after create.
+_pending_insert: Optional[Callable[[str, str], Optional[Dict[str, Any]]]] = None
+
+
+def _buffered_row(table: str, key: str, value: Any) -> Optional[Dict[str, Any]]:
+    if _pending_insert is None or key != _ID_FIELDS.get(table):
+        return None
+    return _pending_insert(table, str(value))
+
+
+# Called with (table, rows) after rows reach ClickHouse, from every insert path
+# (including buffered and queued writes once they flush); used by caches
+# derived from table contents.
+_write_listeners: List[Callable[[str, List[Dict[str, Any]]], None]] = []
+# Called with (table, rows) when write_buffer or mutation_queue accepts rows,
+# before they are written; for in-process state that must not lag the buffers.
+_queue_listeners: List[Callable[[str, List[Dict[str, Any]]], None]] = []
+# Called with (table, rows) when write_buffer or mutation_queue gives up on
+# queued rows (dead-lettered); they will never reach ClickHouse.
+_drop_listeners: List[Callable[[str, List[Dict[str, Any]]], None]] = []
+
+
+def _notify(listeners, table: str, rows: List[Dict[str, Any]]) -> None:
+    for listener in listeners:
+        try:
+            listener(table, rows)
+        except Exception as e:
+            print(f"[DB] Write listener failed for {table}: {e}")
+
+
+def _written(table: str, rows: List[Dict[str, Any]]) -> None:
+    _notify(_write_listeners, table, rows)
+
+
+def _queued(table: str, rows: List[Dict[str, Any]]) -> None:
+    _notify(_queue_listeners, table, rows)
+
+
+def _dropped(table: str, rows: List[Dict[str, Any]]) -> None:
+    _notify(_drop_listeners, table, rows)
+
+
+# ----------------------------------------------------------------------
+# Sync API (used by the plain `def` routes running in the threadpool)
+# ----------------------------------------------------------------------
+
+def query_compact(sql: str, fmt: Optional[str] = None) -> Tuple[List[str], List[tuple]]:
+    """Run a SELECT in a compact format and return (column names, row tuples)"""
+    full_sql, fmt = _compact_sql(sql, fmt)
+    resp = _http_post(full_sql, settings=_COMPACT_SETTINGS)
+    return _decode_compact(resp, fmt)
+
+
+def query_columns(sql: str, fmt: Optional[str] = None) -> Dict[str, list]:
+    """Run a SELECT and return one array per column"""
+    return _as_columns(*query_compact(sql, fmt))
+
+
+def query(sql: str) -> List[Dict[str, Any]]:
+    """Run a SELECT and return its rows as dicts"""
+    return _as_dicts(*query_compact(sql))
+
+
+def stream_rows(sql: str) -> Iterator[Dict[str, Any]]:
+    """Yield rows of a SELECT one at a time as ClickHouse sends them (JSONEachRow).
+
+    The request is sent eagerly so ClickHouse errors surface before the
+    caller starts writing a response.
+    """
+    params = {"query": f"{sql} FORMAT JSONEachRow", **_BASE_SETTINGS, **_COMPACT_SETTINGS}
+    started = time.perf_counter()
+    resp = None
+    try:
+        resp = _get_session().post(
+            _BASE_URL,
+            params=params,
+            timeout=(CLICKHOUSE_CONNECT_TIMEOUT, CLICKHOUSE_READ_TIMEOUT),
+            stream=True,
+        )
+    finally:
+        # time to first byte; the body is consumed by the caller
+        metrics.observe_clickhouse(sql, time.perf_counter() - started, resp)
+    if not resp.ok:
+        try:
+            raise _clickhouse_error(resp.status_code, resp.text, sql, None)
+        finally:
+            resp.close()
+
+    def rows() -> Iterator[Dict[str, Any]]:
+        try:
+            for line in resp.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            # returns the connection to the pool even if the consumer stops early
+            resp.close()
+    return rows()
+
+
+def stream_table(table: str, filters: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    rows = stream_rows(_select_by_filters_sql(table, filters or {}))
+    if _pending_overlay is None:
+        return rows
+    return (visible for row in rows for visible in _overlay(table, [row], filters))
+
+
+def select_all(table: str) -> List[Dict[str, Any]]:
+    return _overlay(table, query(_select_all_sql(table)))
+
+
+def insert_one(table: str, obj: Dict[str, Any]):
+    sql, body, id_field, needs_check = _prepare_insert(table, obj)
+    if needs_check and _suspect_ids(table, [str(obj[id_field])]) and select_one(table, id_field, str(obj[id_field])):
+        _id_filter(table).duplicates += 1
+        raise DuplicateIdError(f"Duplicate {id_field} {obj[id_field]} for table {table}")
+    ids = [obj.get(id_field)] if id_field else []
+    _http_post(sql, data=body, settings={**_insert_settings(None), **_dedup_token(table, body)})
+    if id_field:
+        _remember_ids(table, ids)
+    _written(table, [obj])
     
     # Return the generated or provided ID
     return obj.get(id_field) if id_field else None
 
 
+def insert_many(table: str, objs: List[Dict[str, Any]], async_insert: Optional[bool] = None,
+                check_duplicates: bool = True) -> List[Any]:
+    """Insert a batch of rows in one INSERT (one data part) and return their IDs.
+
+    Caller-supplied IDs the ID filter cannot rule out are checked with a
+    single IN query, unless check_duplicates is False (IDs known to be
+    freshly generated).
+    """
+    if not objs:
+        return []
+    sql, body, id_field, ids, provided = _prepare_insert_many(table, objs)
+    suspects = _suspect_ids(table, provided) if provided and check_duplicates else []
+    if suspects:
+        existing = query(_existing_ids_sql(table, id_field, suspects))
+        if existing:
+            _id_filter(table).duplicates += 1
+            raise DuplicateIdError(f"Duplicate {id_field} {existing[0][id_field]} for table {table}")
+    _http_post(sql, data=body, settings={**_insert_settings(async_insert), **_dedup_token(table, body)})
+    if id_field:
+        _remember_ids(table, ids)
+    _written(table, objs)
+    return ids
+
+
 def select_one(table: str, key: str, value: Any) -> Optional[Dict[str, Any]]:
-    # naive equality select
-    # For strings, add quotes
-    if isinstance(value, (str, UUID)):
-        val = f"'{value}'"
-    else:
-        val = str(value)
-    query = f"SELECT * FROM {table} WHERE {key} = {val} FORMAT JSON"
-    resp = _http_post(query)
-    data = resp.json()
-    rows = data.get("data", [])
+    # a buffered row leaves the buffer only once written, so checking it first never misses
+    buffered = _buffered_row(table, key, value)
+    rows = _overlay(table, [buffered] if buffered is not None else query(_select_one_sql(table, key, value)),
+                    {key: value})
     return rows[0] if rows else None
 
 
-def select_by_filters(table: str, filters: Dict[str, Any], order_by: Optional[str] = None) -> List[Dict[str, Any]]:
-    """Select rows matching multiple filters with optional ordering"""
-    if not filters:
-        return select_all(table)
-    
-    where_clauses = []
-    for key, value in filters.items():
-        if value is None:
-            continue
-        if isinstance(value, (str, UUID)):
-            where_clauses.append(f"{key} = '{value}'")
-        elif isinstance(value, bool):
-            where_clauses.append(f"{key} = {1 if value else 0}")
-        else:
-            where_clauses.append(f"{key} = {value}")
-    
-    if not where_clauses:
-        return select_all(table)
-    
-    where_clause = " AND ".join(where_clauses)
-    query = f"SELECT * FROM {table} WHERE {where_clause}"
-    
-    if order_by:
-        query += f" ORDER BY {order_by}"
-    
-    query += " FORMAT JSON"
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+def select_by_filters(table: str, filters: Dict[str, Any], order_by: Optional[str] = None,
+                      limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Select rows matching multiple filters with optional ordering.
+
+    Filter keys may carry an operator suffix: __ne, __gt, __gte, __lt, __lte, __in.
+    """
+    return _overlay(table, query(_select_by_filters_sql(table, filters, order_by, limit)), filters)
+
+
+def select_page(table: str, filters: Dict[str, Any], limit: int,
+                cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Keyset-paginated select ordered by the table's sort key.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    rows, next_cursor = _split_page(table, query(_page_sql(table, filters, limit, cursor)), limit)
+    return _overlay(table, rows, filters), next_cursor
+
+
+def write_versions(table: str, rows: List[Dict[str, Any]]) -> None:
+    """Write prepared version rows (cancel rows and new states) in one INSERT"""
+    body = "".join(_row_json(row) + "\n" for row in rows)
+    _http_post(_insert_sql(table), data=body, settings=_dedup_token(table, body))
+    _written(table, rows)
 
 
 def update_one(table: str, key: str, value: Any, obj: Dict[str, Any]) -> bool:
-    # Use ALTER TABLE UPDATE for updating records
-    # mutations are async; this returns True if the request was accepted.
-    normalized = {k: _normalize(v) for k, v in obj.items() if k != key}
-    
-    if not normalized:
-        return True
-    
-    # Build SET clause
-    set_clauses = []
-    for col, val in normalized.items():
-        if isinstance(val, str):
-            set_clauses.append(f"{col} = '{val}'")
-        elif val is None:
-            set_clauses.append(f"{col} = NULL")
-        else:
-            set_clauses.append(f"{col} = {val}")
-    
-    set_clause = ", ".join(set_clauses)
-    
-    if isinstance(value, str):
-        val = f"'{value}'"
-    else:
-        val = str(value)
-    
-    query = f"ALTER TABLE {table} UPDATE {set_clause} WHERE {key} = {val}"
-    resp = _http_post(query)
-    # If no exception was raised, consider the mutation accepted.
+    """Write a new version of a row; returns False if the row does not exist.
+
+    The current version is read under the row's lock, so concurrent writes
+    to the same row apply one after the other.
+    """
+    with row_lock(table, value):
+        existing = select_one(table, key, value)
+        if existing is None:
+            return False
+        write_versions(table, update_rows(key, existing, obj))
     return True
 
 
 def delete_one(table: str, key: str, value: Any) -> bool:
-    # mutations are async; this returns True if the request was accepted.
-    if isinstance(value, str):
-        val = f"'{value}'"
-    else:
-        val = str(value)
-    query = f"ALTER TABLE {table} DELETE WHERE {key} = {val}"
-    resp = _http_post(query)
-    # If no exception was raised, consider the mutation accepted.
+    """Cancel a row's current version; returns False if the row does not exist"""
+    with row_lock(table, value):
+        existing = select_one(table, key, value)
+        if existing is None:
+            return False
+        write_versions(table, delete_rows(existing))
     return True
 
+
+# ----------------------------------------------------------------------
+# Async API (for `async def` routes; never blocks the event loop)
+# ----------------------------------------------------------------------
+
+async def aquery_compact(sql: str, fmt: Optional[str] = None) -> Tuple[List[str], List[tuple]]:
+    full_sql, fmt = _compact_sql(sql, fmt)
+    resp = await _ahttp_post(full_sql, settings=_COMPACT_SETTINGS)
+    return _decode_compact(resp, fmt)
+
+
+async def aquery_columns(sql: str, fmt: Optional[str] = None) -> Dict[str, list]:
+    return _as_columns(*await aquery_compact(sql, fmt))
+
+
+async def aquery(sql: str) -> List[Dict[str, Any]]:
+    """Run a SELECT and return its rows as dicts"""
+    return _as_dicts(*await aquery_compact(sql))
+
+
+async def aselect_all(table: str) -> List[Dict[str, Any]]:
+    return _overlay(table, await aquery(_select_all_sql(table)))
+
+
+async def ainsert_one(table: str, obj: Dict[str, Any]):
+    sql, body, id_field, needs_check = _prepare_insert(table, obj)
+    if needs_check and _suspect_ids(table, [str(obj[id_field])]) and await aselect_one(table, id_field, str(obj[id_field])):
+        _id_filter(table).duplicates += 1
+        raise DuplicateIdError(f"Duplicate {id_field} {obj[id_field]} for table {table}")
+    ids = [obj.get(id_field)] if id_field else []
+    await _ahttp_post(sql, data=body, settings={**_insert_settings(None), **_dedup_token(table, body)})
+    if id_field:
+        _remember_ids(table, ids)
+    _written(table, [obj])
+    return obj.get(id_field) if id_field else None
+
+
+async def ainsert_many(table: str, objs: List[Dict[str, Any]], async_insert: Optional[bool] = None,
+                       check_duplicates: bool = True) -> List[Any]:
+    if not objs:
+        return []
+    sql, body, id_field, ids, provided = _prepare_insert_many(table, objs)
+    suspects = _suspect_ids(table, provided) if provided and check_duplicates else []
+    if suspects:
+        existing = await aquery(_existing_ids_sql(table, id_field, suspects))
+        if existing:
+            _id_filter(table).duplicates += 1
+            raise DuplicateIdError(f"Duplicate {id_field} {existing[0][id_field]} for table {table}")
+    await _ahttp_post(sql, data=body, settings={**_insert_settings(async_insert), **_dedup_token(table, body)})
+    if id_field:
+        _remember_ids(table, ids)
+    _written(table, objs)
+    return ids
+
+
+async def aselect_one(table: str, key: str, value: Any) -> Optional[Dict[str, Any]]:
+    buffered = _buffered_row(table, key, value)
+    rows = _overlay(table, [buffered] if buffered is not None else await aquery(_select_one_sql(table, key, value)),
+                    {key: value})
+    return rows[0] if rows else None
+
+
+async def aselect_by_filters(table: str, filters: Dict[str, Any], order_by: Optional[str] = None,
+                             limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    return _overlay(table, await aquery(_select_by_filters_sql(table, filters, order_by, limit)), filters)
+
+
+async def aselect_page(table: str, filters: Dict[str, Any], limit: int,
+                       cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    rows, next_cursor = _split_page(table, await aquery(_page_sql(table, filters, limit, cursor)), limit)
+    return _overlay(table, rows, filters), next_cursor
+
+
+# Row writes hold a row_lock shared with the sync API, so they run on a
+# worker thread rather than blocking the event loop on it.
+async def aupdate_one(table: str, key: str, value: Any, obj: Dict[str, Any]) -> bool:
+    return await asyncio.to_thread(update_one, table, key, value, obj)
+
+
+async def adelete_one(table: str, key: str, value: Any) -> bool:
+    return await asyncio.to_thread(delete_one, table, key, value)
+
 def _normalize(value: Any) -> Any:
     if isinstance(value, bool):
         return 1 if value else 0
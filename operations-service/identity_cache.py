@@ -0,0 +1,173 @@
+"""
+Cache of verified bearer tokens and the user IDs they resolve to.
+
+Entries are keyed on the SHA-256 of the token (tokens themselves are not
+kept) and hold the verified claims ({valid, username, role}) plus, once
+someone asked, the user's Mongo _id from user-service /me. An entry
+expires at the token's own exp or IDENTITY_CACHE_TTL seconds after it was
+verified, whichever is sooner; at most IDENTITY_CACHE_MAX_ENTRIES are
+kept (least recently used evicted first).
+
+A hit is still checked against the revocation list, so a logout seen by
+the revocation sync takes effect on cached tokens too. Concurrent misses
+for the same token share one verification or /me call, so a page firing
+several requests at once costs at most one identity round trip.
+
+Invalid tokens are not cached, and with AUTH_MODE=remote no tokens are
+(auth_middleware.verify_token). Like the other caches, this is per process.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from jose import JWTError, jwt
+
+import metrics
+
+IDENTITY_CACHE_ENABLED = os.getenv("IDENTITY_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "300"))  # seconds
+IDENTITY_CACHE_MAX_ENTRIES = int(os.getenv("IDENTITY_CACHE_MAX_ENTRIES", "10000"))
+
+
+class _Entry:
+    __slots__ = ("user", "token_claims", "user_id", "expires")
+
+    def __init__(self, user: Dict[str, Any], token_claims: Dict[str, Any], expires: float):
+        self.user = user  # what verification returned
+        self.token_claims = token_claims  # sub/iat/jti, for revocation checks
+        self.user_id: Optional[str] = None
+        self.expires = expires  # epoch seconds
+
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class IdentityCache:
+    def __init__(self, ttl: float = IDENTITY_CACHE_TTL, max_entries: int = IDENTITY_CACHE_MAX_ENTRIES,
+                 enabled: bool = IDENTITY_CACHE_ENABLED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "revoked": 0, "evictions": 0}
+
+    def _count(self, name: str, kind: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+        metrics.IDENTITY_CACHE_LOOKUPS.labels(kind, name).inc()
+
+    def _entry(self, key: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    async def _single_flight(self, kind: str, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        flight = (kind, key)
+        task = self._inflight.get(flight)
+        if task is not None:
+            self._count("coalesced", kind)
+            return await asyncio.shield(task)
+        self._count("misses", kind)
+        task = asyncio.ensure_future(compute())
+        self._inflight[flight] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(flight) is task:
+                del self._inflight[flight]
+
+    async def verified(self, token: str, verify: Callable[[str], Awaitable[Dict[str, Any]]],
+                       is_revoked: Callable[[Dict[str, Any]], bool]) -> Dict[str, Any]:
+        """The verified claims for token: cached, or from verify(token)"""
+        if not self.enabled:
+            return await verify(token)
+        key = _digest(token)
+        entry = self._entry(key)
+        if entry is not None:
+            if not is_revoked(entry.token_claims):
+                self._count("hits", "token")
+                return entry.user
+            # let verify() raise the 401
+            self.discard(token)
+            self._count("revoked", "token")
+
+        async def compute():
+            user = await verify(token)
+            self._store(key, token, user)
+            return user
+
+        return await self._single_flight("token", key, compute)
+
+    def _store(self, key: str, token: str, user: Dict[str, Any]) -> None:
+        try:
+            token_claims = jwt.get_unverified_claims(token)
+        except JWTError:
+            return
+        expires = time.time() + self.ttl
+        if token_claims.get("exp") is not None:
+            expires = min(expires, float(token_claims["exp"]))
+        with self._lock:
+            self._entries[key] = _Entry(user, token_claims, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    async def user_id(self, token: str, resolve: Callable[[], Awaitable[str]]) -> str:
+        """The user ID behind a token verified through verified(): cached, or from resolve()"""
+        if not self.enabled:
+            return await resolve()
+        key = _digest(token)
+        entry = self._entry(key)
+        if entry is not None and entry.user_id is not None:
+            self._count("hits", "user_id")
+            return entry.user_id
+
+        async def compute():
+            user_id = await resolve()
+            cached = self._entry(key)
+            if cached is not None:
+                cached.user_id = user_id
+            return user_id
+
+        return await self._single_flight("user_id", key, compute)
+
+    def discard(self, token: str) -> None:
+        with self._lock:
+            self._entries.pop(_digest(token), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            entries = len(self._entries)
+            with_user_id = sum(1 for entry in self._entries.values() if entry.user_id is not None)
+        lookups = counters["hits"] + counters["misses"] + counters["coalesced"]
+        return {
+            "enabled": self.enabled,
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries,
+            "entries": entries,
+            "entries_with_user_id": with_user_id,
+            **counters,
+            "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+identity_cache = IdentityCache()
@@ -1,7 +1,16 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+import threading
 import uvicorn
 import db
+import metrics
+import migrations
+import os
+from write_buffer import write_buffer
+from mutation_queue import mutation_queue
+from roster_index import roster_index
+from auth_middleware import revocations
+from services import user_service_client
 from routers.rooms import router as rooms_router
 from routers.payments import router as payments_router
 from routers.trainers import router as trainers_router
@@ -9,11 +18,15 @@ from routers.classes import router as classes_router
 from routers.attendances import router as attendances_router
 from routers.analytics import router as analytics_router
 from routers.bookings import router as bookings_router
+from routers.stats import router as stats_router
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() in ("1", "true", "yes")
 
 app = FastAPI(
     title="Operations Service",
     version="1.0.0",
-    description="Fitness Center Operations Microservice - Protected by JWT Authentication"
+    description="Fitness Center Operations Microservice - Protected by JWT Authentication",
+    dependencies=[Depends(metrics.track_in_flight)],
 )
 
 # CORS middleware
@@ -23,7 +36,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(rooms_router)
 app.include_router(payments_router)
@@ -32,22 +47,54 @@ app.include_router(classes_router)
 app.include_router(attendances_router)
 app.include_router(analytics_router)
 app.include_router(bookings_router)
+app.include_router(stats_router)
 
 @app.on_event("startup")
 def on_startup():
-    # ensure ClickHouse tables exist
+    # migrations normally run ahead of the deploy (python -m migrations up);
+    # when run here, a failure aborts startup rather than serving a half-migrated schema
+    if MIGRATE_ON_STARTUP:
+        migrations.migrate()
     try:
-        db.init_tables()
+        pending = [s["version"] for s in migrations.status() if s["state"] == "pending"]
+        if pending:
+            print(f"[MIGRATION] Schema is behind: migrations {pending} not applied, run `python -m migrations up`")
+        db.refresh_mirrors()
     except Exception as e:
-        # log errors but don't crash startup
+        # log errors but don't crash startup; reads fall back to the source tables
         import traceback
-        print(f"Error initializing tables: {e}")
+        print(f"Error checking the schema: {e}")
         traceback.print_exc()
+    write_buffer.start()
+    mutation_queue.start()
+    roster_index.start()
+    user_service_client.open_client()
+    revocations.start()
+    if db.ID_FILTER_WARM:
+        # load existing IDs so inserts with caller-supplied IDs can skip the duplicate read
+        threading.Thread(target=db.warm_id_filters, name="id-filter-warmup", daemon=True).start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # write out buffered rows and queued mutations before the pool goes away
+    write_buffer.stop()
+    mutation_queue.stop()
+    roster_index.stop()
+    revocations.stop()
+    # release pooled ClickHouse connections
+    db.close_session()
+    await db.aclose_async_client()
+    await user_service_client.aclose_client()
 
 @app.get("/")
 def root():
     return {"message": "Operations Service is running!"}
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return metrics.metrics_response()
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
@@ -0,0 +1,206 @@
+"""
+Prometheus metrics for the operations service, served on /metrics.
+
+- clickhouse_query_seconds: every ClickHouse HTTP call, by table and operation
+- clickhouse_read_rows_total / _read_bytes_total / _written_rows_total:
+  from the X-ClickHouse-Summary response header. ClickHouse sends the
+  header with the first bytes of the response, so for large streamed
+  SELECTs it reflects progress up to that point.
+- http_request_duration_seconds / http_requests_in_flight: per route template
+  (the in-flight gauge is kept by the track_in_flight app dependency,
+  which runs once the route is known)
+- user_service_request_seconds: calls to user-service, by operation and outcome
+- reference_cache_lookups_total: rooms/trainers cache hits and misses
+- analytics_cache_lookups_total: analytics result cache hits, stale hits and misses
+- booking_phase_seconds: time spent in each phase of /bookings/book-class, by outcome
+- auth_verifications_total: bearer-token checks, local or via user-service, by result
+- identity_cache_lookups_total: verified-token and user-ID cache hits, misses and coalesced misses
+- user_service_breaker_state: per-operation circuit state (0 closed, 1 half-open, 2 open),
+  with user_service_breaker_transitions_total counting state changes
+- user_service_resilience_events_total: retries, hedged requests, exhausted retry budget
+  and calls short-circuited by an open breaker
+"""
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CLICKHOUSE_QUERY_SECONDS = Histogram(
+    "clickhouse_query_seconds", "ClickHouse HTTP call latency", ["table", "operation"], buckets=_LATENCY_BUCKETS,
+)
+CLICKHOUSE_QUERY_ERRORS = Counter(
+    "clickhouse_query_errors_total", "ClickHouse calls that failed or returned an error status", ["table", "operation"],
+)
+CLICKHOUSE_READ_ROWS = Counter("clickhouse_read_rows_total", "Rows read by ClickHouse", ["table", "operation"])
+CLICKHOUSE_READ_BYTES = Counter("clickhouse_read_bytes_total", "Bytes read by ClickHouse", ["table", "operation"])
+CLICKHOUSE_WRITTEN_ROWS = Counter("clickhouse_written_rows_total", "Rows written by ClickHouse", ["table", "operation"])
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served", ["method", "route"])
+
+USER_SERVICE_SECONDS = Histogram(
+    "user_service_request_seconds", "Calls from this service to user-service", ["operation", "outcome"],
+    buckets=_LATENCY_BUCKETS,
+)
+
+REFERENCE_CACHE_LOOKUPS = Counter(
+    "reference_cache_lookups_total", "Reference-data cache lookups", ["table", "result"],
+)
+
+ANALYTICS_CACHE_LOOKUPS = Counter(
+    "analytics_cache_lookups_total", "Analytics result cache lookups", ["endpoint", "result"],
+)
+
+BOOKING_PHASE_SECONDS = Histogram(
+    "booking_phase_seconds", "Booking transaction phases (phase=total for the whole request)", ["phase", "outcome"],
+    buckets=_LATENCY_BUCKETS,
+)
+
+AUTH_VERIFICATIONS = Counter(
+    "auth_verifications_total", "Bearer-token verifications", ["mode", "result"],
+)
+
+IDENTITY_CACHE_LOOKUPS = Counter(
+    "identity_cache_lookups_total", "Verified-token and user-ID cache lookups", ["kind", "result"],
+)
+
+USER_SERVICE_BREAKER_STATE = Gauge(
+    "user_service_breaker_state", "Circuit breaker state per user-service operation (0 closed, 1 half-open, 2 open)",
+    ["operation"],
+)
+USER_SERVICE_BREAKER_TRANSITIONS = Counter(
+    "user_service_breaker_transitions_total", "Circuit breaker state changes", ["operation", "state"],
+)
+USER_SERVICE_RESILIENCE_EVENTS = Counter(
+    "user_service_resilience_events_total", "Retries, hedges and short-circuited user-service calls",
+    ["operation", "event"],
+)
+
+_STATEMENT = re.compile(
+    r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([A-Za-z_][\w.]*))?",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def _labels(query: str) -> Tuple[str, str]:
+    """(table, operation) for a SQL statement, e.g. ("payments", "select")"""
+    match = _STATEMENT.match(query)
+    if not match:
+        return "unknown", "unknown"
+    return (match.group(2) or "none"), match.group(1).lower()
+
+
+def observe_clickhouse(query: str, seconds: float, resp: Optional[Any]) -> None:
+    """Record one ClickHouse HTTP call; resp is None when the request itself failed"""
+    table, operation = _labels(query)
+    CLICKHOUSE_QUERY_SECONDS.labels(table, operation).observe(seconds)
+    if resp is None or resp.status_code >= 400:
+        CLICKHOUSE_QUERY_ERRORS.labels(table, operation).inc()
+        return
+    summary = resp.headers.get("X-ClickHouse-Summary")
+    if not summary:
+        return
+    try:
+        stats = json.loads(summary)
+    except ValueError:
+        return
+    CLICKHOUSE_READ_ROWS.labels(table, operation).inc(int(stats.get("read_rows", 0)))
+    CLICKHOUSE_READ_BYTES.labels(table, operation).inc(int(stats.get("read_bytes", 0)))
+    CLICKHOUSE_WRITTEN_ROWS.labels(table, operation).inc(int(stats.get("written_rows", 0)))
+
+
+@asynccontextmanager
+async def track_user_service(operation: str):
+    """Time a call to user-service; the outcome label is "error" if the block raises"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        USER_SERVICE_SECONDS.labels(operation, outcome).observe(time.perf_counter() - started)
+
+
+async def track_in_flight(request: Request):
+    """App-wide dependency counting requests in flight per route template.
+
+    Middleware runs before routing and cannot know the template yet; a
+    dependency runs after it, so this labels by /classes/{class_id} like
+    the latency histogram rather than by raw path.
+    """
+    in_flight = HTTP_IN_FLIGHT.labels(request.method, request.scope["route"].path)
+    in_flight.inc()
+    try:
+        yield
+    finally:
+        in_flight.dec()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # label by route template (/classes/{class_id}), not the raw path
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+
+
+class PhaseTimer:
+    """Splits one request into consecutive phases; lap(name) closes the current one"""
+
+    def __init__(self, histogram: Histogram = BOOKING_PHASE_SECONDS):
+        self.histogram = histogram
+        self.started = self._last = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def lap(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def as_ms(self) -> Dict[str, float]:
+        return {phase: round(seconds * 1000, 2) for phase, seconds in self.phases.items()}
+
+    def server_timing(self) -> str:
+        """Value for a Server-Timing response header"""
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items())
+
+    def observe(self, outcome: str) -> None:
+        for phase, seconds in self.phases.items():
+            self.histogram.labels(phase, outcome).observe(seconds)
+        self.histogram.labels("total", outcome).observe(time.perf_counter() - self.started)
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
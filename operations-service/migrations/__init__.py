@@ -0,0 +1,17 @@
+"""
+Versioned ClickHouse schema migrations.
+
+    python -m migrations status      # applied / pending / changed scripts
+    python -m migrations up [--to N] # apply pending scripts
+    python -m migrations verify      # fail if an applied script was edited
+
+Run `up` ahead of a deploy (docker-compose does, in the
+operations-migrations service). The mirror and rollup builds are online,
+so the running service keeps serving reads and writes meanwhile; moving
+legacy MergeTree tables to versioned storage (v0001) is not and needs a
+maintenance window. With MIGRATE_ON_STARTUP=true the service migrates
+before serving instead, and does not start if a migration fails.
+"""
+from migrations.runner import MigrationError, applied, discover, migrate, status, verify
+
+__all__ = ["MigrationError", "applied", "discover", "migrate", "status", "verify"]
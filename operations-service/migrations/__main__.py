@@ -0,0 +1,34 @@
+import argparse
+import sys
+
+from migrations.runner import MigrationError, migrate, status, verify
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m migrations", description="ClickHouse schema migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="list migrations and whether they are applied")
+    up = sub.add_parser("up", help="apply pending migrations")
+    up.add_argument("--to", type=int, default=None, help="stop after this version")
+    sub.add_parser("verify", help="check applied migrations against their checksums")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "status":
+            for s in status():
+                applied_at = f"  {s['applied_at']} ({s['duration_ms']} ms)" if s["applied_at"] else ""
+                print(f"v{s['version']:04d}  {s['state']:<8} {s['name']}{applied_at}")
+        elif args.command == "up":
+            done = migrate(target=args.to)
+            print(f"Applied {len(done)} migration(s)" + (f": {done}" if done else ""))
+        elif args.command == "verify":
+            verify()
+            print("All applied migrations match their scripts")
+    except MigrationError as e:
+        print(f"[MIGRATION ERROR] {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+DDL helpers shared by the migration scripts.
+
+Everything here is idempotent so a migration interrupted halfway can be
+re-run. Large copies go partition by partition with progress output, and
+mirrors are built online: the materialized view is attached first, then
+existing data is backfilled up to a version watermark and the result is
+checked against the source (verify_copy). Rollups are filled the same way
+and reconciled against the source afterwards.
+"""
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db import _http_post, query, LIVE_ROWS, VERSION_COLUMN, SIGN_COLUMN
+from migrations.runner import MigrationError
+
+Columns = List[Tuple[str, str]]
+# (name, expression over the source row, type) for rollup keys and measures
+Expressions = List[Tuple[str, str, str]]
+
+# table comment set on a mirror once its backfill has finished; db only
+# routes reads to mirrors carrying it
+MIRROR_READY_COMMENT = "mirror:ready"
+
+
+def column_names(columns: Columns) -> List[str]:
+    return [col for col, _ in columns] + [VERSION_COLUMN, SIGN_COLUMN]
+
+
+def versioned_table_sql(name: str, columns: Columns, order_by: str, partition_by: Optional[str] = None,
+                        settings: Optional[Dict[str, object]] = None) -> str:
+    """CREATE TABLE IF NOT EXISTS for a VersionedCollapsingMergeTree table"""
+    column_defs = ", ".join(f"{col} {col_type}" for col, col_type in columns)
+    partition = f" PARTITION BY {partition_by}" if partition_by else ""
+    sql = (
+        f"CREATE TABLE IF NOT EXISTS {name} ("
+        f"{column_defs}, {VERSION_COLUMN} UInt64, {SIGN_COLUMN} Int8 DEFAULT 1"
+        f") ENGINE = VersionedCollapsingMergeTree({SIGN_COLUMN}, {VERSION_COLUMN})"
+        f"{partition} ORDER BY ({order_by})"
+    )
+    if settings:
+        sql += " SETTINGS " + ", ".join(f"{key} = {value}" for key, value in settings.items())
+    return sql
+
+
+def table_engines() -> Dict[str, str]:
+    rows = query("SELECT name, engine FROM system.tables WHERE database = currentDatabase()")
+    return {row["name"]: row["engine"] for row in rows}
+
+
+def table_comment(name: str) -> Optional[str]:
+    rows = query(f"SELECT comment FROM system.tables WHERE database = currentDatabase() AND name = '{name}'")
+    return rows[0]["comment"] if rows else None
+
+
+def partitions(table: str) -> List[Tuple[str, int]]:
+    """(partition_id, rows) of a table's active parts, oldest partition first"""
+    rows = query(
+        f"SELECT partition_id, sum(rows) AS rows FROM system.parts "
+        f"WHERE database = currentDatabase() AND table = '{table}' AND active "
+        f"GROUP BY partition_id ORDER BY partition_id"
+    )
+    return [(row["partition_id"], int(row["rows"])) for row in rows]
+
+
+def backfill(target: str, source: str, select: str, where: Optional[str] = None, final: bool = True,
+             label: Optional[str] = None, progress: Callable[[str], None] = print) -> int:
+    """INSERT INTO target SELECT ... FROM source, one source partition at a time.
+
+    `select` is the column list/expressions; `final` reads the collapsed
+    state of the source. Returns the number of source rows scanned.
+    """
+    parts = partitions(source)
+    total = sum(rows for _, rows in parts) or 1
+    done = 0
+    label = label or target
+    started = time.perf_counter()
+    for i, (partition_id, rows) in enumerate(parts, 1):
+        conditions = [f"_partition_id = '{partition_id}'"] + ([where] if where else [])
+        _http_post(
+            f"INSERT INTO {target} SELECT {select} FROM {source} WHERE {' AND '.join(conditions)}",
+            settings={"final": "1" if final else "0"},
+        )
+        done += rows
+        progress(
+            f"[MIGRATION] backfill {label}: partition {partition_id} ({i}/{len(parts)}), "
+            f"{done}/{total} rows ({done * 100 / total:.1f}%), {time.perf_counter() - started:.1f}s"
+        )
+    return done
+
+
+def _live_summary(table: str, versioned: bool = True, key: Optional[str] = None) -> Tuple[int, int]:
+    """(live rows, fingerprint of their (key, _version) pairs or 0 without a key)"""
+    where = f" WHERE {LIVE_ROWS}" if versioned else ""
+    fingerprint = f"sum(cityHash64({key}, {VERSION_COLUMN}))" if key else "0"
+    row = query(f"SELECT count() AS rows, {fingerprint} AS fingerprint FROM {table}{where}")[0]
+    return int(row["rows"]), int(row["fingerprint"])
+
+
+def verify_copy(source: str, target: str, source_versioned: bool = True, key: Optional[str] = None,
+                attempts: int = 3, progress: Callable[[str], None] = print) -> None:
+    """Raise MigrationError unless target holds the same live rows as source.
+
+    Compares row counts and, given the ID column as `key` (versioned
+    sources only), which versions of which rows are live. Checked a few
+    times a second apart, so a write that reached one table and not yet
+    the other can settle.
+    """
+    key = key if source_versioned else None
+    for attempt in range(1, attempts + 1):
+        expected, actual = _live_summary(source, source_versioned, key), _live_summary(target, True, key)
+        if expected == actual:
+            progress(f"[MIGRATION] verified {target}: {actual[0]} rows, same as {source}")
+            return
+        if attempt < attempts:
+            time.sleep(1)
+    if expected[0] != actual[0]:
+        raise MigrationError(f"{target} has {actual[0]} live rows but {source} has {expected[0]}")
+    raise MigrationError(f"{target} has the same row count as {source} but different live versions")
+
+
+def create_mirror(name: str, source: str, columns: Columns, order_by: str, index_granularity: int = 8192,
+                  progress: Callable[[str], None] = print) -> None:
+    """Build a re-sorted copy of a versioned table, kept current by a materialized view.
+
+    The view is attached first and the version watermark taken after it,
+    so every row versioned past the watermark reaches the mirror through
+    the view. The backfill copies the collapsed state of rows versioned up
+    to the watermark, skipping those the view has already copied (a row
+    versioned just before the watermark can be inserted after the view
+    attached). Cancel rows whose state the backfill could not copy are
+    paired off (repair_cancels), and the mirror's live rows are checked
+    against the source. Until the mirror is
+    marked ready, reads keep going to the source table. The first column
+    in `columns` must be the row ID.
+    """
+    if table_comment(name) == MIRROR_READY_COMMENT and name + "_mv" in table_engines():
+        return
+    # unfinished or unmarked: rebuild from scratch
+    _http_post(f"DROP VIEW IF EXISTS {name}_mv")
+    _http_post(f"DROP TABLE IF EXISTS {name}")
+    column_list = ", ".join(column_names(columns))
+    _http_post(versioned_table_sql(name, columns, order_by, settings={"index_granularity": index_granularity}))
+    _http_post(f"CREATE MATERIALIZED VIEW {name}_mv TO {name} AS SELECT {column_list} FROM {source}")
+    watermark = time.time_ns()
+    id_column = columns[0][0]
+    # the mirror holds only what the view copied so far, so this set stays small
+    copied = f"({id_column}, {VERSION_COLUMN}) NOT IN (SELECT {id_column}, {VERSION_COLUMN} FROM {name})"
+    backfill(name, source, column_list, where=f"{VERSION_COLUMN} <= {watermark} AND {copied}", progress=progress)
+    repair_cancels(name, columns, watermark)
+    verify_copy(source, name, key=id_column, progress=progress)
+    _http_post(f"ALTER TABLE {name} MODIFY COMMENT '{MIRROR_READY_COMMENT}'")
+    progress(f"[MIGRATION] mirror {name} of {source} is live")
+
+
+def repair_cancels(name: str, columns: Columns, watermark: int) -> None:
+    """Give each orphaned cancel row in a mirror the state it cancels.
+
+    A row cancelled after the view attached but before the backfill read it
+    is collapsed in the source, so only its cancel reached the mirror.
+    Cancels of rows the mirror already holds (backfilled, or inserted
+    through the view, then updated or deleted) are left alone, as are
+    cancels versioned past the watermark, whose state came through the view.
+    """
+    id_column = columns[0][0]
+    column_list = ", ".join(column_names(columns))
+    repaired = ", ".join([col for col, _ in columns] + [VERSION_COLUMN, f"1 AS {SIGN_COLUMN}"])
+    # filtered in a subquery: in the outer SELECT, `1 AS _sign` would shadow the column
+    _http_post(
+        f"INSERT INTO {name} ({column_list}) SELECT {repaired} FROM ("
+        f"SELECT {column_list} FROM {name} "
+        f"WHERE {SIGN_COLUMN} = -1 AND {VERSION_COLUMN} <= {watermark} "
+        f"AND ({id_column}, {VERSION_COLUMN}) NOT IN "
+        f"(SELECT {id_column}, {VERSION_COLUMN} FROM {name} WHERE {SIGN_COLUMN} = 1))",
+        settings={"final": "0"},
+    )
+
+
+def create_rollup(name: str, source: str, keys: Expressions, measures: Expressions, partition_by: str,
+                  progress: Callable[[str], None] = print) -> None:
+    """Build an AggregatingMergeTree of per-key sums over a versioned table.
+
+    The materialized view folds every inserted row in with its sign, so an
+    update adds the new values and subtracts the old ones, and a delete
+    subtracts. Every measure is a sumState; read with sumMerge. The view is
+    attached first and reconcile_rollup then fills in existing data.
+    """
+    key_names = ", ".join(key for key, _, _ in keys)
+    key_defs = ", ".join(f"{key} {key_type}" for key, _, key_type in keys)
+    measure_defs = ", ".join(f"{measure} AggregateFunction(sum, {measure_type})"
+                             for measure, _, measure_type in measures)
+    _http_post(
+        f"CREATE TABLE IF NOT EXISTS {name} ({key_defs}, {measure_defs}) ENGINE = AggregatingMergeTree "
+        f"PARTITION BY {partition_by} ORDER BY ({key_names})"
+    )
+    key_select = ", ".join(f"{expr} AS {key}" for key, expr, _ in keys)
+    signed = ", ".join(f"sumState(to{measure_type}({expr} * {SIGN_COLUMN})) AS {measure}"
+                       for measure, expr, measure_type in measures)
+    _http_post(
+        f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name}_mv TO {name} AS "
+        f"SELECT {key_select}, {signed} FROM {source} GROUP BY {key_names}"
+    )
+    reconcile_rollup(name, source, keys, measures, progress=progress)
+    progress(f"[MIGRATION] rollup {name} of {source} is live")
+
+
+def reconcile_rollup(name: str, source: str, keys: Expressions, measures: Expressions,
+                     progress: Callable[[str], None] = print) -> None:
+    """Insert the difference between the source and the rollup, partition by partition.
+
+    On an empty rollup this is the backfill. Run again at any time to
+    correct drift, e.g. from a cancel row that raced the initial fill.
+    Rollup and source must use the same partition expression.
+    """
+    key_names = ", ".join(key for key, _, _ in keys)
+    key_select = ", ".join(f"{expr} AS {key}" for key, expr, _ in keys)
+    actual = ", ".join(f"sum(to{measure_type}({expr})) AS {measure}_delta" for measure, expr, measure_type in measures)
+    recorded = ", ".join(f"-sumMerge({measure}) AS {measure}_delta" for measure, _, _ in measures)
+    states = ", ".join(f"sumState({measure}_delta) AS {measure}" for measure, _, _ in measures)
+    changed = " OR ".join(f"sum({measure}_delta) != 0" for measure, _, _ in measures)
+    partition_ids = sorted({pid for pid, _ in partitions(source)} | {pid for pid, _ in partitions(name)})
+    started = time.perf_counter()
+    for i, partition_id in enumerate(partition_ids, 1):
+        _http_post(
+            f"INSERT INTO {name} SELECT {key_names}, {states} FROM ("
+            f"SELECT {key_select}, {actual} FROM {source} FINAL "
+            f"WHERE _partition_id = '{partition_id}' GROUP BY {key_names} "
+            f"UNION ALL "
+            f"SELECT {key_names}, {recorded} FROM {name} "
+            f"WHERE _partition_id = '{partition_id}' GROUP BY {key_names}"
+            f") GROUP BY {key_names} HAVING {changed}"
+        )
+        progress(
+            f"[MIGRATION] reconcile {name}: partition {partition_id} ({i}/{len(partition_ids)}), "
+            f"{time.perf_counter() - started:.1f}s"
+        )
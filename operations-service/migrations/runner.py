@@ -0,0 +1,133 @@
+"""
+Applies the numbered scripts in migrations/versions in order and records
+each one in the schema_migrations table with a checksum of its source.
+
+A script is a module named vNNNN_<name>.py with a DESCRIPTION string and
+an up() function. Applied scripts must not be edited: a checksum mismatch
+stops the run until the change is moved into a new migration.
+"""
+import hashlib
+import importlib
+import os
+import pkgutil
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import db
+
+MIGRATIONS_TABLE = "schema_migrations"
+_VERSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "versions")
+
+
+class MigrationError(Exception):
+    """Raised when the recorded history does not match the scripts on disk"""
+    pass
+
+
+class Migration:
+    def __init__(self, version: int, name: str, module):
+        self.version = version
+        self.name = name
+        self.module = module
+        with open(module.__file__, "rb") as f:
+            self.checksum = hashlib.sha256(f.read()).hexdigest()
+
+    @property
+    def description(self) -> str:
+        return getattr(self.module, "DESCRIPTION", self.name)
+
+
+def discover() -> List[Migration]:
+    """All migration scripts, ordered by version"""
+    migrations = []
+    for info in pkgutil.iter_modules([_VERSIONS_DIR]):
+        prefix, _, name = info.name.partition("_")
+        if not (prefix.startswith("v") and prefix[1:].isdigit()):
+            continue
+        module = importlib.import_module(f"migrations.versions.{info.name}")
+        migrations.append(Migration(int(prefix[1:]), name, module))
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(set(versions)) != len(versions):
+        raise MigrationError(f"Duplicate migration versions: {versions}")
+    return migrations
+
+
+def _ensure_table() -> None:
+    db._http_post(
+        f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} ("
+        f"version UInt32, name String, checksum String, applied_at DateTime64(3), duration_ms UInt64"
+        f") ENGINE = ReplacingMergeTree(applied_at) ORDER BY version"
+    )
+
+
+def applied() -> Dict[int, Dict[str, Any]]:
+    _ensure_table()
+    rows = db.query(f"SELECT version, name, checksum, applied_at, duration_ms FROM {MIGRATIONS_TABLE} FINAL")
+    return {int(row["version"]): row for row in rows}
+
+
+def status() -> List[Dict[str, Any]]:
+    """One entry per script: applied / pending / changed (checksum mismatch)"""
+    history = applied()
+    migrations = discover()
+    result = []
+    for m in migrations:
+        record = history.get(m.version)
+        if record is None:
+            state = "pending"
+        elif record["checksum"] != m.checksum:
+            state = "changed"
+        else:
+            state = "applied"
+        result.append({
+            "version": m.version,
+            "name": m.name,
+            "description": m.description,
+            "state": state,
+            "applied_at": record["applied_at"] if record else None,
+            "duration_ms": int(record["duration_ms"]) if record else None,
+        })
+    known = {m.version for m in migrations}
+    for version, record in sorted(history.items()):
+        if version not in known:
+            result.append({"version": version, "name": record["name"], "description": "",
+                           "state": "missing", "applied_at": record["applied_at"],
+                           "duration_ms": int(record["duration_ms"])})
+    return result
+
+
+def verify() -> None:
+    """Raise MigrationError if an applied script was edited or removed"""
+    bad = [s for s in status() if s["state"] in ("changed", "missing")]
+    if bad:
+        details = ", ".join(f"v{s['version']:04d}_{s['name']} ({s['state']})" for s in bad)
+        raise MigrationError(f"Applied migrations do not match the scripts on disk: {details}")
+
+
+def migrate(target: Optional[int] = None) -> List[int]:
+    """Apply pending migrations up to `target` (all by default); returns the versions applied"""
+    verify()
+    history = applied()
+    done = []
+    for m in discover():
+        if m.version in history:
+            continue
+        if target is not None and m.version > target:
+            break
+        print(f"[MIGRATION] Applying v{m.version:04d}_{m.name}: {m.description}")
+        started = time.perf_counter()
+        m.module.up()
+        duration_ms = int((time.perf_counter() - started) * 1000)
+        record = {
+            "version": m.version,
+            "name": m.name,
+            "checksum": m.checksum,
+            "applied_at": datetime.utcnow().isoformat(sep=" ", timespec="milliseconds"),
+            "duration_ms": duration_ms,
+        }
+        db._http_post(f"INSERT INTO {MIGRATIONS_TABLE} FORMAT JSONEachRow", data=db._row_json(record) + "\n")
+        print(f"[MIGRATION] v{m.version:04d}_{m.name} applied in {duration_ms} ms")
+        done.append(m.version)
+    return done
@@ -0,0 +1,100 @@
+"""
+Base tables as VersionedCollapsingMergeTree (_sign, _version).
+
+Tables still on plain MergeTree from before versioned rows are copied into
+the new layout and swapped in; the old table is kept as
+<table>__premigration.
+
+Unlike the later migrations this one is NOT online: run it with writes
+stopped, i.e. `python -m migrations up` in a maintenance window, after
+the old service is down and before the new one starts. The bulk copy runs while the legacy table is still in place; the
+table is then renamed away, so any write still arriving fails instead of
+being lost, inserts made during the copy are copied too, and the row
+counts are compared before the new table takes the name. Updates and
+deletes made during the copy are not carried over; a count mismatch puts
+the legacy table back.
+"""
+from db import _http_post, CLICKHOUSE_DEDUP_WINDOW
+from migrations.ddl import backfill, table_engines, verify_copy, versioned_table_sql
+
+DESCRIPTION = "Create versioned base tables, migrating legacy MergeTree tables"
+
+# table -> (columns, PARTITION BY, ORDER BY)
+TABLES = {
+    "rooms": (
+        [("room_id", "UUID"), ("name", "String"), ("capacity", "Int32"), ("has_equipment", "UInt8")],
+        None,
+        "room_id",
+    ),
+    "trainers": (
+        [("trainer_id", "UUID"), ("name", "String"), ("email", "Nullable(String)"), ("specialization", "String"),
+         ("rating", "Nullable(Float64)"), ("experience_years", "Nullable(Int32)")],
+        None,
+        "trainer_id",
+    ),
+    "payments": (
+        [("payment_id", "UUID"), ("member_id", "String"), ("class_id", "UUID"), ("amount", "Float64"),
+         ("timestamp", "DateTime"), ("status", "String DEFAULT 'completed'")],
+        "toYYYYMM(timestamp)",
+        "class_id, timestamp, payment_id",
+    ),
+    "classes": (
+        [("class_id", "UUID"), ("name", "String"), ("trainer_id", "Nullable(UUID)"), ("room_id", "Nullable(UUID)"),
+         ("start_time", "DateTime"), ("end_time", "DateTime"), ("capacity", "Nullable(Int32)"),
+         ("price", "Nullable(Float64)"), ("description", "Nullable(String)")],
+        "toYYYYMM(start_time)",
+        "start_time, class_id",
+    ),
+    "attendances": (
+        [("event_id", "UUID"), ("class_id", "UUID"), ("member_id", "String"), ("timestamp", "DateTime"),
+         ("status", "String")],
+        "toYYYYMM(timestamp)",
+        "class_id, timestamp, event_id",
+    ),
+}
+
+# let insert_deduplication_token drop retried inserts
+_SETTINGS = {"non_replicated_deduplication_window": CLICKHOUSE_DEDUP_WINDOW}
+
+
+def create_sql(table: str, name: str = None) -> str:
+    columns, partition_by, order_by = TABLES[table]
+    return versioned_table_sql(name or table, columns, order_by, partition_by, settings=_SETTINGS)
+
+
+def _migrate_legacy(table: str) -> None:
+    staging = f"{table}__versioned"
+    backup = f"{table}__premigration"
+    id_column = TABLES[table][0][0][0]
+    select = ", ".join(col for col, _ in TABLES[table][0]) + ", toUnixTimestamp64Nano(now64(9)), 1"
+    print(f"[MIGRATION] Moving {table} to versioned storage (maintenance window: stop writes first)")
+    _http_post(f"DROP TABLE IF EXISTS {staging}")
+    _http_post(create_sql(table, staging))
+    backfill(staging, table, select, final=False, label=table)
+    # from here on writes to the legacy table fail instead of being lost
+    _http_post(f"RENAME TABLE {table} TO {backup}")
+    try:
+        _http_post(
+            f"INSERT INTO {staging} SELECT {select} FROM {backup} "
+            f"WHERE {id_column} NOT IN (SELECT {id_column} FROM {staging})",
+            settings={"final": "0"},
+        )
+        verify_copy(backup, staging, source_versioned=False)
+    except Exception:
+        _http_post(f"RENAME TABLE {backup} TO {table}")
+        print(f"[MIGRATION] {table} left on legacy storage; rerun with writes stopped")
+        raise
+    _http_post(f"RENAME TABLE {staging} TO {table}")
+    print(f"[MIGRATION] {table} migrated; previous data kept in {backup}")
+
+
+def up():
+    engines = table_engines()
+    for table in TABLES:
+        engine = engines.get(table)
+        if engine is None:
+            _http_post(create_sql(table))
+        elif engine != "VersionedCollapsingMergeTree":
+            _migrate_legacy(table)
+        else:
+            _http_post(f"ALTER TABLE {table} MODIFY SETTING non_replicated_deduplication_window = {CLICKHOUSE_DEDUP_WINDOW}")
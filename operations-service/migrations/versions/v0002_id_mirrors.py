@@ -0,0 +1,19 @@
+"""
+ID-ordered mirrors for tables whose sort key does not start with the ID,
+so db.select_one by ID reads the primary index instead of every granule.
+"""
+from migrations.ddl import create_mirror
+from migrations.versions.v0001_versioned_tables import TABLES
+
+DESCRIPTION = "Add ID-ordered lookup mirrors for classes, payments and attendances"
+
+MIRRORS = {
+    "classes_by_id": ("classes", "class_id"),
+    "payments_by_id": ("payments", "payment_id"),
+    "attendances_by_id": ("attendances", "event_id"),
+}
+
+
+def up():
+    for mirror, (source, order_by) in MIRRORS.items():
+        create_mirror(mirror, source, TABLES[source][0], order_by, index_granularity=1024)
@@ -0,0 +1,17 @@
+"""
+Member-ordered mirrors so per-member history reads a few granules.
+"""
+from migrations.ddl import create_mirror
+from migrations.versions.v0001_versioned_tables import TABLES
+
+DESCRIPTION = "Add member-ordered mirrors for payments and attendances"
+
+MIRRORS = {
+    "payments_by_member": ("payments", "member_id, timestamp, payment_id"),
+    "attendances_by_member": ("attendances", "member_id, timestamp, event_id"),
+}
+
+
+def up():
+    for mirror, (source, order_by) in MIRRORS.items():
+        create_mirror(mirror, source, TABLES[source][0], order_by, index_granularity=1024)
@@ -0,0 +1,28 @@
+"""
+Daily per-class rollups behind the analytics endpoints, so their cost
+follows the number of days and classes rather than raw history.
+"""
+from migrations.ddl import create_rollup
+
+DESCRIPTION = "Add daily revenue and attendance rollups per class"
+
+# rollup -> (source, keys, measures, PARTITION BY); partitions line up with the source's
+ROLLUPS = {
+    "revenue_daily_by_class": (
+        "payments",
+        [("date", "toDate(timestamp)", "Date"), ("class_id", "class_id", "UUID")],
+        [("revenue", "amount", "Float64"), ("payments", "1", "Int64")],
+        "toYYYYMM(date)",
+    ),
+    "attendance_daily_by_class": (
+        "attendances",
+        [("date", "toDate(timestamp)", "Date"), ("class_id", "class_id", "UUID"), ("status", "status", "String")],
+        [("attendances", "1", "Int64")],
+        "toYYYYMM(date)",
+    ),
+}
+
+
+def up():
+    for rollup, (source, keys, measures, partition_by) in ROLLUPS.items():
+        create_rollup(rollup, source, keys, measures, partition_by)
@@ -0,0 +1,125 @@
+"""
+Coalescing queue for row updates and deletes.
+
+Updates and deletes on the versioned tables are cancel rows plus new
+states (see db.update_rows / db.delete_rows). Instead of one INSERT per
+request they are queued per table and written together once a table has
+MUTATION_QUEUE_MAX_ROWS rows waiting or its oldest row is
+MUTATION_QUEUE_MAX_AGE seconds old.
+
+Until a batch is written, db reads go through this queue's overlay: a
+queued delete hides the row and a queued update replaces it (or hides it,
+if the update no longer matches the read's filters), so callers see their
+own mutations immediately.
+
+Each mutation reads the row's current state and queues it under the row's
+db.row_lock, so two mutations of one row chain instead of both cancelling
+the same version.
+"""
+import asyncio
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+from write_buffer import WriteBuffer
+
+MUTATION_QUEUE_MAX_ROWS = int(os.getenv("MUTATION_QUEUE_MAX_ROWS", "500"))
+MUTATION_QUEUE_MAX_AGE = float(os.getenv("MUTATION_QUEUE_MAX_AGE", "0.5"))  # seconds
+MUTATION_QUEUE_MAX_PENDING = int(os.getenv("MUTATION_QUEUE_MAX_PENDING", "50000"))
+
+
+class MutationQueue(WriteBuffer):
+    log_tag = "MUTATION QUEUE"
+    thread_name = "clickhouse-mutation-queue"
+
+    def __init__(self, max_rows: int = MUTATION_QUEUE_MAX_ROWS, max_age: float = MUTATION_QUEUE_MAX_AGE,
+                 max_pending: int = MUTATION_QUEUE_MAX_PENDING):
+        super().__init__(max_rows=max_rows, max_age=max_age, max_pending=max_pending)
+        # table -> {id: (state or None when deleted, last queued row)}
+        self._pending: Dict[str, Dict[str, Tuple[Optional[Dict[str, Any]], Dict[str, Any]]]] = {}
+        self._pending_lock = threading.Lock()
+
+    def _current(self, table: str, key: str, value: Any) -> Optional[Dict[str, Any]]:
+        """The row as it will be once everything queued is written (call under the row lock)"""
+        with self._pending_lock:
+            entry = self._pending.get(table, {}).get(str(value))
+        if entry is not None:
+            return entry[0]
+        # entries are dropped only after their batch is written, so ClickHouse is current here
+        return db.select_one(table, key, value)
+
+    def update(self, table: str, key: str, value: Any, obj: Dict[str, Any]) -> bool:
+        """Queue an update; returns False if the row does not exist"""
+        with db.row_lock(table, value):
+            existing = self._current(table, key, value)
+            if existing is None:
+                return False
+            rows = db.update_rows(key, existing, obj)
+            self._queue(table, str(value), rows, rows[-1])
+        return True
+
+    def delete(self, table: str, key: str, value: Any) -> bool:
+        """Queue a delete; returns False if the row does not exist"""
+        with db.row_lock(table, value):
+            existing = self._current(table, key, value)
+            if existing is None:
+                return False
+            self._queue(table, str(value), db.delete_rows(existing), None)
+        return True
+
+    async def aupdate(self, table: str, key: str, value: Any, obj: Dict[str, Any]) -> bool:
+        """update() for async routes: the row lock and current-state read run off the event loop"""
+        return await asyncio.to_thread(self.update, table, key, value, obj)
+
+    async def adelete(self, table: str, key: str, value: Any) -> bool:
+        """delete() for async routes: the row lock and current-state read run off the event loop"""
+        return await asyncio.to_thread(self.delete, table, key, value)
+
+    def _queue(self, table: str, row_id: str, rows: List[Dict[str, Any]], state: Optional[Dict[str, Any]]):
+        def remember():
+            with self._pending_lock:
+                self._pending.setdefault(table, {})[row_id] = (state, rows[-1])
+        self._enqueue(table, rows, on_queued=remember)
+
+    def _write(self, table: str, rows: List[Dict[str, Any]]):
+        db.write_versions(table, rows)
+
+    def _settled(self, table: str, rows: List[Dict[str, Any]]):
+        written = {id(row) for row in rows}
+        with self._pending_lock:
+            pending = self._pending.get(table, {})
+            # keep entries re-queued after this batch was taken
+            for row_id in [r for r, (_, last) in pending.items() if id(last) in written]:
+                del pending[row_id]
+
+    def overlay(self, table: str, rows: List[Dict[str, Any]],
+                filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Apply queued updates and deletes to rows read from ClickHouse.
+
+        A queued update can move a row outside the filters the rows were
+        read with (e.g. a status change), so replaced rows are re-checked.
+        """
+        id_field = db._ID_FIELDS.get(table)
+        with self._pending_lock:
+            pending = self._pending.get(table)
+            if not pending or not id_field:
+                return rows
+            visible = []
+            for row in rows:
+                entry = pending.get(str(row.get(id_field)))
+                if entry is None:
+                    visible.append(row)
+                elif entry[0] is not None and (not filters or db.matches_filters(entry[0], filters)):
+                    visible.append(entry[0])
+            return visible
+
+    def stats(self) -> Dict[str, Any]:
+        result = super().stats()
+        with self._pending_lock:
+            result["pending_ids"] = {table: len(ids) for table, ids in self._pending.items() if ids}
+        return result
+
+
+mutation_queue = MutationQueue()
+db._pending_overlay = mutation_queue.overlay
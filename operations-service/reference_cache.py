@@ -0,0 +1,179 @@
+"""
+Cache for the rooms and trainers reference tables.
+
+Both tables are small and rarely written, so each is cached whole (one
+entry per table) and lookups by ID or simple filters are answered from
+the cached rows. Entries expire after REFERENCE_CACHE_TTL seconds and at
+most REFERENCE_CACHE_MAX_ENTRIES are kept; the room and trainer handlers
+invalidate a table right after writing to it. A load that was already
+running when its table was invalidated is returned but not cached.
+
+The cache serves reads only: updates and deletes read the row they
+replace from ClickHouse (db.update_one / db.delete_one).
+
+With REFERENCE_CACHE_REDIS_URL set, entries live in Redis instead so all
+workers share them and an invalidation in one worker is seen by all.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import db
+import metrics
+
+REFERENCE_CACHE_TABLES = ("rooms", "trainers")
+REFERENCE_CACHE_TTL = float(os.getenv("REFERENCE_CACHE_TTL", "300"))  # seconds
+REFERENCE_CACHE_MAX_ENTRIES = int(os.getenv("REFERENCE_CACHE_MAX_ENTRIES", "64"))
+REFERENCE_CACHE_REDIS_URL = os.getenv("REFERENCE_CACHE_REDIS_URL")
+
+
+class LocalBackend:
+    """In-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Shared backend; values are stored as JSON with a Redis-side TTL"""
+
+    def __init__(self, url: str):
+        import redis  # optional dependency, only needed with REFERENCE_CACHE_REDIS_URL
+        self._redis = redis.Redis.from_url(url)
+
+    def _key(self, key: str) -> str:
+        return f"reference-cache:{key}"
+
+    def get(self, key: str) -> Optional[Any]:
+        raw = self._redis.get(self._key(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._redis.set(self._key(key), json.dumps(value, default=str), px=max(1, int(ttl * 1000)))
+
+    def delete(self, key: str) -> None:
+        self._redis.delete(self._key(key))
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+def _make_backend():
+    if REFERENCE_CACHE_REDIS_URL:
+        try:
+            return RedisBackend(REFERENCE_CACHE_REDIS_URL)
+        except Exception as e:
+            print(f"[REFERENCE CACHE] Redis backend unavailable, using in-process cache: {e}")
+    return LocalBackend(REFERENCE_CACHE_MAX_ENTRIES)
+
+
+class ReferenceCache:
+    def __init__(self, backend=None, ttl: float = REFERENCE_CACHE_TTL):
+        self.backend = backend or _make_backend()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # bumped by invalidate(); a load only caches if its table's generation is unchanged
+        self._generations = {table: 0 for table in REFERENCE_CACHE_TABLES}
+        self._counters = {table: {"hits": 0, "misses": 0, "loads": 0, "invalidations": 0}
+                          for table in REFERENCE_CACHE_TABLES}
+
+    def _count(self, table: str, name: str) -> None:
+        with self._lock:
+            self._counters[table][name] += 1
+
+    def rows(self, table: str) -> List[Dict[str, Any]]:
+        """All rows of a reference table"""
+        try:
+            cached = self.backend.get(table)
+        except Exception as e:
+            print(f"[REFERENCE CACHE] Read failed for {table}: {e}")
+            cached = None
+        if cached is not None:
+            self._count(table, "hits")
+            metrics.REFERENCE_CACHE_LOOKUPS.labels(table, "hit").inc()
+            return cached
+        self._count(table, "misses")
+        metrics.REFERENCE_CACHE_LOOKUPS.labels(table, "miss").inc()
+        with self._lock:
+            generation = self._generations[table]
+        rows = db.select_all(table)
+        self._count(table, "loads")
+        with self._lock:
+            if self._generations[table] != generation:
+                return rows  # invalidated while loading: may predate the write
+            try:
+                self.backend.set(table, rows, self.ttl)
+            except Exception as e:
+                print(f"[REFERENCE CACHE] Write failed for {table}: {e}")
+        return rows
+
+    def filter(self, table: str, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Cached rows matching filters (same key__op syntax as db.select_by_filters)"""
+        filters = {key: value for key, value in filters.items() if value is not None}
+        return [row for row in self.rows(table) if db.matches_filters(row, filters)]
+
+    def get(self, table: str, id_value: Any) -> Optional[Dict[str, Any]]:
+        """One row by ID. IDs missing from the cache are re-checked in ClickHouse
+        so a row created by another worker is found before the entry expires."""
+        id_field = db._ID_FIELDS[table]
+        wanted = str(id_value)
+        for row in self.rows(table):
+            if str(row.get(id_field)) == wanted:
+                return row
+        return db.select_one(table, id_field, wanted)
+
+    def invalidate(self, table: str) -> None:
+        with self._lock:
+            self._generations[table] += 1
+        self._count(table, "invalidations")
+        try:
+            self.backend.delete(table)
+        except Exception as e:
+            print(f"[REFERENCE CACHE] Invalidation failed for {table}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {table: dict(c) for table, c in self._counters.items()}
+        for c in counters.values():
+            lookups = c["hits"] + c["misses"]
+            c["hit_ratio"] = round(c["hits"] / lookups, 4) if lookups else 0.0
+        return {
+            "backend": type(self.backend).__name__,
+            "ttl_seconds": self.ttl,
+            "entries": self.backend.size(),
+            "tables": counters,
+        }
+
+
+reference_cache = ReferenceCache()
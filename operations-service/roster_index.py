@@ -0,0 +1,304 @@
+"""
+In-memory per-class roster for booking admission checks.
+
+For every class it keeps each attendance's member and status, the number
+of seats taken (attendances that are not cancelled) and the members
+holding one, so capacity and duplicate-booking checks need no ClickHouse
+round trip.
+
+- Rosters for classes that have not ended are loaded at startup
+  (ROSTER_WARM); any other class is loaded on first use.
+- Every attendance row accepted by the write buffer or mutation queue,
+  or written directly, is applied as it happens (db queue and write
+  listeners). Rows are applied by (_version, _sign), so seeing the same
+  row at enqueue time and again at flush is harmless; until the flush the
+  row is marked pending.
+- Every ROSTER_RECONCILE_INTERVAL seconds loaded rosters are reloaded from
+  ClickHouse; local changes newer than the reload and pending rows are
+  kept. This also
+  picks up bookings made through other workers, which this process
+  otherwise does not see.
+- Rosters unused for ROSTER_IDLE_TTL seconds are dropped.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import db
+
+ROSTER_WARM = os.getenv("ROSTER_WARM", "true").lower() in ("1", "true", "yes")
+ROSTER_RECONCILE_INTERVAL = float(os.getenv("ROSTER_RECONCILE_INTERVAL", "60"))  # seconds
+ROSTER_IDLE_TTL = float(os.getenv("ROSTER_IDLE_TTL", "3600"))  # seconds
+ROSTER_LOAD_BATCH = int(os.getenv("ROSTER_LOAD_BATCH", "500"))  # classes per reload query
+
+_CANCELLED = "cancelled"
+
+
+class _Event:
+    __slots__ = ("member_id", "status", "version", "changed_at", "pending")
+
+    def __init__(self, member_id: Optional[str], status: Optional[str], version: Optional[int], changed_at: int,
+                 pending: bool = False):
+        # member_id None marks a deleted attendance (kept so a stale reload cannot revive it)
+        self.member_id = member_id
+        self.status = status
+        self.version = version
+        self.changed_at = changed_at  # time_ns of the local change, 0 when loaded
+        self.pending = pending  # queued in write_buffer/mutation_queue, not yet in ClickHouse
+
+    @property
+    def holds_seat(self) -> bool:
+        return self.member_id is not None and self.status != _CANCELLED
+
+
+class Roster:
+    __slots__ = ("events", "seats", "members", "loaded", "used")
+
+    def __init__(self):
+        self.events: Dict[str, _Event] = {}
+        self.seats = 0
+        self.members: Dict[str, int] = {}  # member -> seats held
+        self.loaded = False
+        self.used = time.monotonic()
+
+    def _count(self, event: Optional[_Event], delta: int) -> None:
+        if event is None or not event.holds_seat:
+            return
+        self.seats += delta
+        held = self.members.get(event.member_id, 0) + delta
+        if held > 0:
+            self.members[event.member_id] = held
+        else:
+            self.members.pop(event.member_id, None)
+
+    def _set(self, event_id: str, event: Optional[_Event]) -> None:
+        self._count(self.events.get(event_id), -1)
+        if event is None:
+            self.events.pop(event_id, None)
+        else:
+            self.events[event_id] = event
+            self._count(event, 1)
+
+    def apply(self, row: Dict[str, Any], now: int, pending: bool = False) -> None:
+        event_id = str(row.get("event_id"))
+        version = row.get(db.VERSION_COLUMN)
+        version = int(version) if version is not None else None
+        current = self.events.get(event_id)
+        if current is not None and current.version is not None and version is not None and current.version > version:
+            return  # an older state or a cancel of one
+        if int(row.get(db.SIGN_COLUMN, 1)) < 0:
+            self._set(event_id, _Event(None, None, version, now, pending))
+        else:
+            self._set(event_id, _Event(str(row.get("member_id")), row.get("status"), version, now, pending))
+
+    def merge(self, rows: List[Dict[str, Any]], watermark: int) -> None:
+        """Replace the roster's content with a ClickHouse snapshot taken after
+        `watermark`, keeping local changes made since then and unflushed rows"""
+        keep = {event_id: event for event_id, event in self.events.items()
+                if event.changed_at > watermark or event.pending}
+        for event_id in list(self.events):
+            self._set(event_id, None)
+        for row in rows:
+            self._set(str(row["event_id"]), _Event(str(row["member_id"]), row.get("status"),
+                                                    int(row[db.VERSION_COLUMN]), 0))
+        for event_id, event in keep.items():
+            self._set(event_id, event)
+        # deletion markers only matter until the next reload
+        for event_id in [e for e, event in self.events.items()
+                         if event.member_id is None and event.changed_at <= watermark and not event.pending]:
+            del self.events[event_id]
+        self.loaded = True
+
+
+def _attendance_sql(class_ids: Iterable[str]) -> str:
+    ids = ", ".join(f"'{class_id}'" for class_id in class_ids)
+    return (
+        f"SELECT event_id, class_id, member_id, status, {db.VERSION_COLUMN} "
+        f"FROM attendances WHERE class_id IN ({ids}) AND {db.LIVE_ROWS}"
+    )
+
+
+def _group(rows: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    by_class: Dict[str, List[Dict[str, Any]]] = {}
+    # hide rows whose delete is still queued
+    for row in db._overlay("attendances", rows):
+        by_class.setdefault(str(row["class_id"]), []).append(row)
+    return by_class
+
+
+class RosterIndex:
+    def __init__(self, reconcile_interval: float = ROSTER_RECONCILE_INTERVAL, idle_ttl: float = ROSTER_IDLE_TTL):
+        self.reconcile_interval = reconcile_interval
+        self.idle_ttl = idle_ttl
+        self._rosters: Dict[str, Roster] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._counters = {"checks": 0, "loads": 0, "rows_applied": 0, "reconciles": 0, "evictions": 0}
+        self.last_reconcile_ms = 0.0
+        self.last_error: Optional[str] = None
+
+    def _roster(self, class_id: str) -> Roster:
+        roster = self._rosters.get(class_id)
+        if roster is None:
+            roster = self._rosters[class_id] = Roster()
+        return roster
+
+    # -- updates ------------------------------------------------------
+
+    def _apply(self, table: str, rows: List[Dict[str, Any]], pending: bool) -> None:
+        if table != "attendances":
+            return
+        now = time.time_ns()
+        with self._lock:
+            for row in rows:
+                class_id = row.get("class_id")
+                if class_id is not None:
+                    self._roster(str(class_id)).apply(row, now, pending)
+            self._counters["rows_applied"] += len(rows)
+
+    def on_queued(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        """db queue listener: rows accepted by a buffer, not yet written"""
+        self._apply(table, rows, pending=True)
+
+    def on_written(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        """db write listener: rows now in ClickHouse"""
+        self._apply(table, rows, pending=False)
+
+    def on_dropped(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        """db drop listener: queued rows that will never be written. Their
+        events stop being pending, so the next reload replaces them."""
+        if table != "attendances":
+            return
+        with self._lock:
+            for row in rows:
+                roster = self._rosters.get(str(row.get("class_id")))
+                event = roster.events.get(str(row.get("event_id"))) if roster is not None else None
+                if event is not None and event.pending and event.version == row.get(db.VERSION_COLUMN):
+                    event.pending = False
+
+    def _merge(self, class_ids: List[str], rows: List[Dict[str, Any]], watermark: int, touch: bool) -> None:
+        by_class = _group(rows)
+        with self._lock:
+            for class_id in class_ids:
+                roster = self._roster(class_id)
+                roster.merge(by_class.get(class_id, []), watermark)
+                if touch:
+                    roster.used = time.monotonic()
+            self._counters["loads"] += len(class_ids)
+
+    def load(self, class_ids: List[str], touch: bool = False) -> None:
+        """(Re)load rosters from ClickHouse"""
+        for start in range(0, len(class_ids), ROSTER_LOAD_BATCH):
+            batch = class_ids[start:start + ROSTER_LOAD_BATCH]
+            watermark = time.time_ns()
+            self._merge(batch, db.query(_attendance_sql(batch)), watermark, touch)
+
+    async def aload(self, class_ids: List[str], touch: bool = False) -> None:
+        for start in range(0, len(class_ids), ROSTER_LOAD_BATCH):
+            batch = class_ids[start:start + ROSTER_LOAD_BATCH]
+            watermark = time.time_ns()
+            self._merge(batch, await db.aquery(_attendance_sql(batch)), watermark, touch)
+
+    # -- admission checks ---------------------------------------------
+
+    def peek(self, class_id: str, member_id: Optional[str] = None) -> Optional[Tuple[int, bool]]:
+        """Like admission, but None instead of loading when the roster is not loaded"""
+        with self._lock:
+            roster = self._rosters.get(class_id)
+            if roster is None or not roster.loaded:
+                return None
+            roster.used = time.monotonic()
+            self._counters["checks"] += 1
+            return roster.seats, member_id is not None and str(member_id) in roster.members
+
+    def admission(self, class_id: Any, member_id: Optional[Any] = None) -> Tuple[int, bool]:
+        """(seats taken, whether member_id already holds a seat) for a class"""
+        class_id = str(class_id)
+        result = self.peek(class_id, member_id)
+        if result is None:
+            self.load([class_id], touch=True)
+            result = self.peek(class_id, member_id)
+        return result
+
+    async def aadmission(self, class_id: Any, member_id: Optional[Any] = None) -> Tuple[int, bool]:
+        class_id = str(class_id)
+        result = self.peek(class_id, member_id)
+        if result is None:
+            await self.aload([class_id], touch=True)
+            result = self.peek(class_id, member_id)
+        return result
+
+    def seats_taken(self, class_id: Any) -> int:
+        return self.admission(class_id)[0]
+
+    # -- background warm-up and reconciliation ------------------------
+
+    def warm(self) -> None:
+        """Load rosters for every class that has not ended yet"""
+        rows = db.query(f"SELECT class_id FROM {db.id_source('classes')} WHERE end_time >= now() AND {db.LIVE_ROWS}")
+        class_ids = [str(row["class_id"]) for row in rows]
+        self.load(class_ids, touch=True)
+        print(f"[ROSTER] Warmed {len(class_ids)} class rosters")
+
+    def reconcile(self) -> None:
+        """Drop idle rosters and reload the rest from ClickHouse"""
+        started = time.perf_counter()
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = [class_id for class_id, roster in self._rosters.items() if roster.used < cutoff]
+            for class_id in idle:
+                del self._rosters[class_id]
+            class_ids = [class_id for class_id, roster in self._rosters.items() if roster.loaded]
+            self._counters["evictions"] += len(idle)
+        self.load(class_ids)
+        with self._lock:
+            self._counters["reconciles"] += 1
+        self.last_reconcile_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def _run(self):
+        if ROSTER_WARM:
+            try:
+                self.warm()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[ROSTER] Warm-up failed: {e}")
+        while not self._stopping.wait(self.reconcile_interval):
+            try:
+                self.reconcile()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"[ROSTER] Reconcile failed: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="roster-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            loaded = [roster for roster in self._rosters.values() if roster.loaded]
+            return {
+                "rosters": len(self._rosters),
+                "loaded": len(loaded),
+                "seats_tracked": sum(roster.seats for roster in loaded),
+                "reconcile_interval_seconds": self.reconcile_interval,
+                "last_reconcile_ms": self.last_reconcile_ms,
+                "last_error": self.last_error,
+                **self._counters,
+            }
+
+
+roster_index = RosterIndex()
+db._queue_listeners.append(roster_index.on_queued)
+db._write_listeners.append(roster_index.on_written)
+db._drop_listeners.append(roster_index.on_dropped)
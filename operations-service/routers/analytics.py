@@ -1,144 +1,157 @@
+import asyncio
+import functools
+import time
 from fastapi import APIRouter, Query
-from typing import Optional
-from db import _http_post
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Dict, List, Optional, Literal, get_args
+from db import query as run_query, query_columns, aquery, id_source, member_source, LIVE_ROWS
+from analytics_cache import analytics_cache
+from reference_cache import reference_cache
 
 router = APIRouter(prefix="/analytics", tags=["analytics"])
 
+# daily per-class rollups (see migrations/versions/v0004_analytics_rollups.py);
+# measures are sumState columns, so read them with sumMerge
+REVENUE_ROLLUP = "revenue_daily_by_class"
+ATTENDANCE_ROLLUP = "attendance_daily_by_class"
+
+Layout = Literal["rows", "columns"]
+_LAYOUT_QUERY = Query("rows", description="'rows' returns a list of objects, 'columns' returns one array per column")
+
+
+def _run(query: str, layout: str):
+    """Run an analytics query using the compact wire format"""
+    if layout == "columns":
+        return query_columns(query)
+    return run_query(query)
+
+
+def _date_range(start_date: Optional[str], end_date: Optional[str]) -> str:
+    where_clauses = []
+    if start_date:
+        where_clauses.append(f"date >= '{start_date}'")
+    if end_date:
+        where_clauses.append(f"date <= '{end_date}'")
+    return f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+
 
 @router.get("/revenue/total")
+@analytics_cache.cached(("payments",), dated=True)
 def get_total_revenue(
     start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD format"),
-    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format")
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format"),
+    layout: Layout = _LAYOUT_QUERY
 ):
     """Get total revenue, optionally filtered by date range"""
-    where_clauses = []
-    
-    if start_date:
-        where_clauses.append(f"timestamp >= '{start_date} 00:00:00'")
-    if end_date:
-        where_clauses.append(f"timestamp <= '{end_date} 23:59:59'")
-    
-    where_clause = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
-    
     query = f"""
         SELECT 
-            sum(amount) as total_revenue,
-            count(*) as total_payments,
-            avg(amount) as average_payment
-        FROM payments 
-        {where_clause}
-        FORMAT JSON
+            sumMerge(revenue) as total_revenue,
+            sumMerge(payments) as total_payments,
+            total_revenue / nullIf(total_payments, 0) as average_payment
+        FROM {REVENUE_ROLLUP} 
+        {_date_range(start_date, end_date)}
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [{}])[0] if data.get("data") else {}
+    result = _run(query, layout)
+    if layout == "columns":
+        return result
+    return result[0] if result else {}
 
 
 @router.get("/revenue/by-class")
+@analytics_cache.cached(("payments",), dated=True)
 def get_revenue_by_class(
     start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD format"),
-    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format")
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format"),
+    layout: Layout = _LAYOUT_QUERY
 ):
     """Get revenue grouped by class"""
-    where_clauses = []
-    
-    if start_date:
-        where_clauses.append(f"timestamp >= '{start_date} 00:00:00'")
-    if end_date:
-        where_clauses.append(f"timestamp <= '{end_date} 23:59:59'")
-    
-    where_clause = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
-    
     query = f"""
         SELECT 
             class_id,
-            sum(amount) as total_revenue,
-            count(*) as payment_count,
-            avg(amount) as average_payment
-        FROM payments 
-        {where_clause}
+            sumMerge(revenue) as total_revenue,
+            sumMerge(payments) as payment_count,
+            total_revenue / payment_count as average_payment
+        FROM {REVENUE_ROLLUP} 
+        {_date_range(start_date, end_date)}
         GROUP BY class_id
+        HAVING payment_count > 0
         ORDER BY total_revenue DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+    return _run(query, layout)
 
 
 @router.get("/classes/attendance-stats")
-def get_class_attendance_stats(class_id: Optional[str] = Query(None)):
+@analytics_cache.cached(("attendances",))
+def get_class_attendance_stats(class_id: Optional[str] = Query(None), layout: Layout = _LAYOUT_QUERY):
     """Get attendance statistics for classes"""
     where_clause = f"WHERE class_id = '{class_id}'" if class_id else ""
     
     query = f"""
         SELECT 
             class_id,
-            count(*) as total_attendances,
-            countIf(status = 'checked-in') as checked_in_count,
-            countIf(status = 'checked-out') as checked_out_count,
-            countIf(status = 'cancelled') as cancelled_count
-        FROM attendances
+            sumMerge(attendances) as total_attendances,
+            sumMergeIf(attendances, status = 'checked-in') as checked_in_count,
+            sumMergeIf(attendances, status = 'checked-out') as checked_out_count,
+            sumMergeIf(attendances, status = 'cancelled') as cancelled_count
+        FROM {ATTENDANCE_ROLLUP}
         {where_clause}
         GROUP BY class_id
+        HAVING total_attendances > 0
         ORDER BY total_attendances DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    result = data.get("data", [])
+    result = _run(query, layout)
+    if layout == "columns":
+        return result
     return result[0] if class_id and result else result
 
 
 @router.get("/trainers/utilization")
-def get_trainer_utilization():
+@analytics_cache.cached(("classes",))
+def get_trainer_utilization(layout: Layout = _LAYOUT_QUERY):
     """Get trainer utilization statistics"""
-    query = """
+    query = f"""
         SELECT 
             trainer_id,
             count(*) as total_classes,
             min(start_time) as first_class,
             max(end_time) as last_class
         FROM classes
-        WHERE trainer_id IS NOT NULL
+        WHERE trainer_id IS NOT NULL AND {LIVE_ROWS}
         GROUP BY trainer_id
         ORDER BY total_classes DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+    return _run(query, layout)
 
 
 @router.get("/rooms/occupancy")
-def get_room_occupancy():
+@analytics_cache.cached(("classes",))
+def get_room_occupancy(layout: Layout = _LAYOUT_QUERY):
     """Get room occupancy statistics"""
-    query = """
+    query = f"""
         SELECT 
             room_id,
             count(*) as total_classes,
             min(start_time) as first_class,
             max(end_time) as last_class
         FROM classes
-        WHERE room_id IS NOT NULL
+        WHERE room_id IS NOT NULL AND {LIVE_ROWS}
         GROUP BY room_id
         ORDER BY total_classes DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+    return _run(query, layout)
 
 
 @router.get("/members/activity")
-def get_member_activity(member_id: Optional[str] = Query(None)):
+@analytics_cache.cached(("attendances",))
+def get_member_activity(member_id: Optional[str] = Query(None), layout: Layout = _LAYOUT_QUERY):
     """Get member activity statistics"""
-    where_clause = f"WHERE member_id = '{member_id}'" if member_id else ""
+    where_clause = f"WHERE {LIVE_ROWS}" + (f" AND member_id = '{member_id}'" if member_id else "")
+    source = member_source("attendances") if member_id else "attendances"
     
     query = f"""
         SELECT 
@@ -146,73 +159,163 @@ def get_member_activity(member_id: Optional[str] = Query(None)):
             count(*) as total_attendances,
             min(timestamp) as first_attendance,
             max(timestamp) as last_attendance
-        FROM attendances
+        FROM {source}
         {where_clause}
         GROUP BY member_id
         ORDER BY total_attendances DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    result = data.get("data", [])
+    result = _run(query, layout)
+    if layout == "columns":
+        return result
     return result[0] if member_id and result else result
 
 
 @router.get("/classes/capacity-utilization")
-def get_class_capacity_utilization():
+@analytics_cache.cached(("classes", "attendances"))
+def get_class_capacity_utilization(layout: Layout = _LAYOUT_QUERY):
     """Get class capacity utilization (attendances vs capacity)"""
-    query = """
+    query = f"""
         SELECT 
             c.class_id,
             c.name,
             c.capacity,
-            count(a.event_id) as actual_attendances,
+            a.attendances as actual_attendances,
             CASE 
-                WHEN c.capacity > 0 THEN round((count(a.event_id) * 100.0) / c.capacity, 2)
+                WHEN c.capacity > 0 THEN round((a.attendances * 100.0) / c.capacity, 2)
                 ELSE 0
             END as utilization_percentage
         FROM classes c
-        LEFT JOIN attendances a ON c.class_id = a.class_id
-        WHERE c.capacity IS NOT NULL
-        GROUP BY c.class_id, c.name, c.capacity
+        LEFT JOIN (
+            SELECT class_id, sumMerge(attendances) as attendances
+            FROM {ATTENDANCE_ROLLUP}
+            GROUP BY class_id
+        ) a ON c.class_id = a.class_id
+        WHERE c.capacity IS NOT NULL AND c.{LIVE_ROWS}
         ORDER BY utilization_percentage DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+    return _run(query, layout)
 
 
 @router.get("/revenue/daily")
+@analytics_cache.cached(("payments",), dated=True)
 def get_daily_revenue(
     start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD format"),
-    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format")
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format"),
+    layout: Layout = _LAYOUT_QUERY
 ):
     """Get daily revenue breakdown"""
-    where_clauses = []
-    
-    if start_date:
-        where_clauses.append(f"timestamp >= '{start_date} 00:00:00'")
-    if end_date:
-        where_clauses.append(f"timestamp <= '{end_date} 23:59:59'")
-    
-    where_clause = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
-    
     query = f"""
         SELECT 
-            toDate(timestamp) as date,
-            sum(amount) as daily_revenue,
-            count(*) as payment_count,
-            avg(amount) as average_payment
-        FROM payments
-        {where_clause}
+            date,
+            sumMerge(revenue) as daily_revenue,
+            sumMerge(payments) as payment_count,
+            daily_revenue / payment_count as average_payment
+        FROM {REVENUE_ROLLUP}
+        {_date_range(start_date, end_date)}
         GROUP BY date
+        HAVING payment_count > 0
         ORDER BY date DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
-    return data.get("data", [])
+    return _run(query, layout)
+
+
+DashboardSection = Literal[
+    "revenue_total", "revenue_by_class", "revenue_daily",
+    "rooms_occupancy", "capacity_utilization", "trainer_utilization",
+]
+_DASHBOARD_SECTIONS = get_args(DashboardSection)
+
+
+# section -> (reference table, ID column, added name column)
+_REFERENCE_NAMES = {
+    "rooms_occupancy": ("rooms", "room_id", "room_name"),
+    "trainer_utilization": ("trainers", "trainer_id", "trainer_name"),
+}
+
+
+async def _class_names(class_ids: List[str]) -> Dict[str, str]:
+    if not class_ids:
+        return {}
+    ids = ", ".join(f"'{class_id}'" for class_id in class_ids)
+    rows = await aquery(f"SELECT class_id, name FROM {id_source('classes')} WHERE class_id IN ({ids}) AND {LIVE_ROWS}")
+    return {str(row["class_id"]): row["name"] for row in rows}
+
+
+def _reference_names(table: str, id_field: str) -> Dict[str, str]:
+    return {str(row[id_field]): row.get("name") for row in reference_cache.rows(table)}
+
+
+@router.get("/dashboard")
+async def get_dashboard(
+    sections: Optional[List[DashboardSection]] = Query(None, description="Sections to include (default: all)"),
+    start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD format (revenue sections)"),
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format (revenue sections)"),
+    top_classes: int = Query(10, ge=1, le=100, description="Classes kept in revenue_by_class"),
+):
+    """Everything the analytics page renders, in one request.
+
+    Sections run concurrently through the same cached handlers as the
+    individual endpoints; class, room and trainer IDs come back with names.
+    A failing section is reported under "errors" instead of failing the page.
+    """
+    wanted = list(dict.fromkeys(sections or _DASHBOARD_SECTIONS))
+    dated = {"start_date": start_date, "end_date": end_date, "layout": "rows"}
+    calls = {
+        "revenue_total": lambda: get_total_revenue(**dated),
+        "revenue_by_class": lambda: get_revenue_by_class(**dated),
+        "revenue_daily": lambda: get_daily_revenue(**dated),
+        "rooms_occupancy": lambda: get_room_occupancy(layout="rows"),
+        "capacity_utilization": lambda: get_class_capacity_utilization(layout="rows"),
+        "trainer_utilization": lambda: get_trainer_utilization(layout="rows"),
+    }
+    jobs = {name: calls[name] for name in wanted}
+    for section, (table, id_field, _) in _REFERENCE_NAMES.items():
+        if section in wanted:
+            jobs[table] = functools.partial(_reference_names, table, id_field)
+
+    timings: Dict[str, float] = {}
+
+    async def timed(name, call):
+        started = time.perf_counter()
+        try:
+            return await call()
+        finally:
+            timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    results = await asyncio.gather(
+        *(timed(name, functools.partial(run_in_threadpool, call)) for name, call in jobs.items()),
+        return_exceptions=True,
+    )
+    errors: Dict[str, str] = {}
+    done: Dict[str, Any] = {}
+    for name, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"[ANALYTICS] Dashboard part {name} failed: {result}")
+            errors[name] = str(result)
+        else:
+            done[name] = result
+
+    if "revenue_by_class" in done:
+        top = done["revenue_by_class"][:top_classes]
+        try:
+            names = await timed("classes", functools.partial(_class_names, [str(row["class_id"]) for row in top]))
+        except Exception as e:
+            print(f"[ANALYTICS] Dashboard part classes failed: {e}")
+            errors["classes"] = str(e)
+            names = {}
+        done["revenue_by_class"] = [{**row, "class_name": names.get(str(row["class_id"]))} for row in top]
+    for section, (table, id_field, name_field) in _REFERENCE_NAMES.items():
+        if section in done:
+            names = done.get(table, {})
+            done[section] = [{**row, name_field: names.get(str(row[id_field]))} for row in done[section]]
+
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "sections": {name: done[name] for name in wanted if name in done},
+        "errors": errors,
+        "timings_ms": timings,
+    }
@@ -1,21 +1,44 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, Response
+from typing import List, Optional, Literal
+from datetime import datetime
+from uuid import UUID
 from models.attendance import Attendance
-from db import select_all, insert_one, select_one, delete_one
+from db import select_one, stream_table, DuplicateIdError
+from mutation_queue import mutation_queue
+from write_buffer import buffered_insert, WriteBufferFullError
+from seat_reservations import seat_reservations, SeatUnavailableError
 from utils.validators import (
     ValidationError,
     validate_attendance_status,
-    validate_class_not_full,
-    validate_foreign_keys
 )
+from utils.streaming import StreamFormat, STREAM_QUERY, stream_response
+from utils.pagination import LIMIT_QUERY, CURSOR_QUERY, list_rows
 
 router = APIRouter(prefix="/attendances", tags=["attendances"])
 
 
 @router.get("/", response_model=List[Attendance])
-def list_attendances():
-    rows = select_all("attendances")
-    return rows
+def list_attendances(
+    response: Response,
+    class_id: Optional[UUID] = Query(None),
+    member_id: Optional[str] = Query(None),
+    status: Optional[Literal["confirmed", "checked-in", "checked-out", "cancelled"]] = Query(None),
+    since: Optional[datetime] = Query(None, description="Only attendances at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only attendances before this time"),
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    stream: Optional[StreamFormat] = STREAM_QUERY,
+):
+    filters = {
+        "class_id": class_id,
+        "member_id": member_id,
+        "status": status,
+        "timestamp__gte": since,
+        "timestamp__lt": until,
+    }
+    if stream:
+        return stream_response(stream_table("attendances", filters), Attendance, stream)
+    return list_rows("attendances", filters, limit, cursor, response)
 
 
 # TODO: should call member service to verify member_id exists
@@ -26,19 +49,38 @@ def create_attendance(att: Attendance):
         validate_attendance_status(att.status)
         
         # Validate class exists
-        validate_foreign_keys(None, class_id=att.class_id)
+        class_info = select_one("classes", "class_id", str(att.class_id))
+        if not class_info:
+            raise ValidationError(f"Class with ID {att.class_id} not found", "class_id")
         
-        # Check class capacity (only for non-cancelled attendances)
+        # Hold a seat (only for non-cancelled attendances) until the row is queued
+        reservation = None
         if att.status != "cancelled":
-            validate_class_not_full(None, att.class_id)
+            try:
+                reservation = seat_reservations.reserve(att.class_id, att.member_id, class_info.get("capacity"),
+                                                        one_per_member=False)
+            except SeatUnavailableError as e:
+                raise ValidationError(
+                    f"Class '{class_info.get('name')}' is full "
+                    f"({e.seats_taken}/{e.capacity} attendees)",
+                    "class_id"
+                )
         
-        att_dict = att.dict()
-        generated_id = insert_one("attendances", att_dict)
+        try:
+            att_dict = att.dict()
+            generated_id = buffered_insert("attendances", att_dict)
+            seat_reservations.confirm(reservation)
+        finally:
+            seat_reservations.release(reservation)
         if generated_id and not att.event_id:
             att.event_id = generated_id
         return att
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=e.message)
+    except WriteBufferFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except DuplicateIdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @router.get("/{event_id}", response_model=Attendance)
@@ -55,7 +97,9 @@ def delete_attendance(event_id: str):
     if not existing:
         raise HTTPException(status_code=404, detail="Attendance not found")
     try:
-        delete_one("attendances", "event_id", event_id)
+        deleted = mutation_queue.delete("attendances", "event_id", event_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete mutation failed: {e}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Attendance not found")
     return {"ok": True}
@@ -1,20 +1,27 @@
 """
 Transaction Flow:
-1. Validate class exists and has capacity
+1. Validate class exists and reserve a seat (fails if full or already booked)
 2. Deduct balance from user (MongoDB)
 3. Create payment record (ClickHouse)
-4. Create attendance record (ClickHouse)
-5. If any step fails, rollback all changes
+4. Create attendance record (ClickHouse) and confirm the seat
+5. If any step fails, rollback all changes and release the seat
 """
 
-from fastapi import APIRouter, HTTPException, Depends, Request, status
+import httpx
+
+from fastapi import APIRouter, HTTPException, Depends, Request, Response, status
 from pydantic import BaseModel, Field
 from typing import Optional
 from datetime import datetime
-from uuid import UUID, uuid4
+from uuid import UUID
 
-from db import select_one, insert_one, delete_one, update_one, _http_post
+from db import aselect_one, ainsert_one, aquery, id_source, member_source, LIVE_ROWS
+from mutation_queue import mutation_queue
+from seat_reservations import seat_reservations, SeatUnavailableError
 from auth_middleware import get_current_user
+from identity_cache import identity_cache
+from metrics import track_user_service, PhaseTimer
+from services import user_service_client
 from services.user_balance_service import (
     deduct_user_balance,
     refund_user_balance,
@@ -68,16 +75,23 @@ def get_bearer_token(request: Request) -> str:
 async def book_class(
     booking: BookingRequest,
     request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """
     1. Phase 1: Deduct balance from MongoDB
     2. Phase 2: Create payment and attendance in ClickHouse
     3. Rollback: If phase 2 fails, refund balance to MongoDB
+
+    Phase durations go to the booking_phase_seconds metric and the
+    Server-Timing response header.
     """
     
     # Transaction state tracking
+    timer = PhaseTimer()
+    outcome = "failed"
     balance_deducted = False
+    reservation = None
     payment_id = None
     attendance_id = None
     bearer_token = get_bearer_token(request)
@@ -88,8 +102,7 @@ async def book_class(
         # PHASE 0: PRE-VALIDATION (Read-only checks)
         # ============================================================
         
-        # Check if class exists
-        class_info = select_one("classes", "class_id", str(booking.class_id))
+        class_info = await aselect_one("classes", "class_id", str(booking.class_id))
         if not class_info:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -108,40 +121,24 @@ async def book_class(
             )
         
         amount_paid = float(class_price)
+        timer.lap("pre_validation")
         
-        # Check if member already has an attendance for this class
-        existing_attendance_query = f"""
-            SELECT count(*) as count 
-            FROM attendances 
-            WHERE class_id = '{booking.class_id}' 
-            AND member_id = '{booking.member_id}'
-            FORMAT JSON
-        """
-        resp = _http_post(existing_attendance_query)
-        data = resp.json()
-        if data.get("data", [{}])[0].get("count", 0) > 0:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail="You have already booked this class"
-            )
-        
-        # Check class capacity
-        if class_capacity is not None:
-            attendance_count_query = f"""
-                SELECT count(*) as count 
-                FROM attendances 
-                WHERE class_id = '{booking.class_id}'
-                FORMAT JSON
-            """
-            resp = _http_post(attendance_count_query)
-            data = resp.json()
-            current_attendances = data.get("data", [{}])[0].get("count", 0)
-            
-            if current_attendances >= class_capacity:
+        # Reserve a seat: duplicate and capacity checks in one atomic step,
+        # so concurrent bookings cannot all pass them. The class roster is
+        # loaded here if needed, i.e. only for classes that exist
+        try:
+            reservation = await seat_reservations.areserve(booking.class_id, booking.member_id, class_capacity)
+        except SeatUnavailableError as e:
+            if e.reason == "duplicate":
                 raise HTTPException(
                     status_code=status.HTTP_409_CONFLICT,
-                    detail=f"Class is full ({current_attendances}/{class_capacity})"
+                    detail="You have already booked this class"
                 )
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Class is full ({e.seats_taken}/{e.capacity})"
+            )
+        timer.lap("reserve")
         
         # ============================================================
         # PHASE 1: DEDUCT BALANCE FROM MONGODB (First Write)
@@ -154,6 +151,7 @@ async def book_class(
                 bearer_token=bearer_token
             )
             balance_deducted = True
+            timer.lap("balance")
             print(f"[TRANSACTION] Balance deducted from user {booking.member_id}: ${amount_paid}")
             
         except InsufficientBalanceError as e:
@@ -171,8 +169,8 @@ async def book_class(
         # PHASE 2: CREATE PAYMENT RECORD IN CLICKHOUSE
         # ============================================================
         
+        # IDs are generated by insert_one, so no duplicate check is needed
         payment_data = {
-            "payment_id": str(uuid4()),
             "member_id": booking.member_id,
             "class_id": str(booking.class_id),
             "amount": amount_paid,
@@ -181,9 +179,10 @@ async def book_class(
         }
         
         try:
-            payment_id = insert_one("payments", payment_data)
+            payment_id = await ainsert_one("payments", payment_data)
             if not payment_id:
                 payment_id = payment_data["payment_id"]
+            timer.lap("payment")
             print(f"[TRANSACTION] Payment created: {payment_id}")
             
         except Exception as e:
@@ -195,7 +194,6 @@ async def book_class(
         # ============================================================
         
         attendance_data = {
-            "event_id": str(uuid4()),
             "class_id": str(booking.class_id),
             "member_id": booking.member_id,
             "timestamp": datetime.utcnow(),
@@ -203,10 +201,13 @@ async def book_class(
         }
         
         try:
-            attendance_id = insert_one("attendances", attendance_data)
+            attendance_id = await ainsert_one("attendances", attendance_data)
             if not attendance_id:
                 attendance_id = attendance_data["event_id"]
             print(f"[TRANSACTION] Attendance created: {attendance_id}")
+            # the roster counts the attendance now, so the hold can go
+            seat_reservations.confirm(reservation)
+            timer.lap("attendance")
             
         except Exception as e:
             print(f"[TRANSACTION ERROR] Failed to create attendance: {e}")
@@ -216,7 +217,9 @@ async def book_class(
         # TRANSACTION SUCCESSFUL
         # ============================================================
         
-        print(f"[TRANSACTION SUCCESS] User {booking.member_id} booked class {booking.class_id}")
+        outcome = "booked"
+        response.headers["Server-Timing"] = timer.server_timing()
+        print(f"[TRANSACTION SUCCESS] User {booking.member_id} booked class {booking.class_id} {timer.as_ms()}")
         
         return BookingResponse(
             success=True,
@@ -229,8 +232,10 @@ async def book_class(
             message=f"Successfully booked '{class_name}' for ${amount_paid}"
         )
     
-    except HTTPException:
+    except HTTPException as e:
         # Re-raise HTTP exceptions (already handled)
+        seat_reservations.release(reservation)
+        outcome = "rejected" if e.status_code < 500 else "failed"
         raise
     
     except Exception as e:
@@ -240,11 +245,12 @@ async def book_class(
         
         print(f"[TRANSACTION ROLLBACK] Error occurred: {str(e)}")
         rollback_errors = []
+        seat_reservations.release(reservation)
         
         # Rollback Step 3: Delete attendance if created
         if attendance_id:
             try:
-                delete_one("attendances", "event_id", attendance_id)
+                await mutation_queue.adelete("attendances", "event_id", attendance_id)
                 print(f"[ROLLBACK] Deleted attendance: {attendance_id}")
             except Exception as rollback_error:
                 rollback_errors.append(f"Failed to delete attendance: {rollback_error}")
@@ -252,7 +258,7 @@ async def book_class(
         # Rollback Step 2: Delete payment if created
         if payment_id:
             try:
-                delete_one("payments", "payment_id", payment_id)
+                await mutation_queue.adelete("payments", "payment_id", payment_id)
                 print(f"[ROLLBACK] Deleted payment: {payment_id}")
             except Exception as rollback_error:
                 rollback_errors.append(f"Failed to delete payment: {rollback_error}")
@@ -273,11 +279,46 @@ async def book_class(
         error_detail = f"Booking transaction failed: {str(e)}"
         if rollback_errors:
             error_detail += f" | Rollback issues: {'; '.join(rollback_errors)}"
+        timer.lap("rollback")
         
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=error_detail
         )
+    
+    finally:
+        timer.observe(outcome)
+
+
+async def _fetch_user_id(bearer_token: str) -> str:
+    """Mongo _id of the token's user, from user-service /me"""
+    try:
+        async with track_user_service("get_me"):
+            response = await user_service_client.request(
+                "get_me", "GET",
+                "/me",
+                headers={"Authorization": f"Bearer {bearer_token}"},
+                timeout=5.0,
+                hedge=True
+            )
+    except httpx.RequestError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="User service unavailable"
+        )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not fetch user information"
+        )
+    user = response.json()
+    user_id = user.get("_id") or user.get("id")
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User ID not found in user data"
+        )
+    return user_id
 
 
 @router.get("/my-bookings")
@@ -286,9 +327,6 @@ async def get_my_bookings(
     current_user: dict = Depends(get_current_user)
 ):
     """Get all bookings (attendances) for the current user"""
-    import httpx
-    import os
-    
     # Extract username from current_user
     username = current_user.get("username")
     
@@ -301,33 +339,8 @@ async def get_my_bookings(
     # Get bearer token from request
     bearer_token = get_bearer_token(request)
     
-    # Get user ID from user-service /me endpoint
-    USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{USER_SERVICE_URL}/me",
-                headers={"Authorization": f"Bearer {bearer_token}"},
-                timeout=5.0
-            )
-            if response.status_code == 200:
-                user = response.json()
-                user_id = user.get("_id") or user.get("id")
-                if not user_id:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="User ID not found in user data"
-                    )
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail="Could not fetch user information"
-                )
-    except httpx.RequestError:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="User service unavailable"
-        )
+    # Get user ID from user-service /me (cached per token)
+    user_id = await identity_cache.user_id(bearer_token, lambda: _fetch_user_id(bearer_token))
     
     # Query attendances for this user
     query = f"""
@@ -344,18 +357,22 @@ async def get_my_bookings(
             p.payment_id AS payment_id,
             p.amount AS paid_amount,
             p.status AS payment_status
-        FROM attendances a
-        LEFT JOIN classes c ON a.class_id = c.class_id
-        LEFT JOIN payments p ON a.class_id = p.class_id AND a.member_id = p.member_id
-        WHERE a.member_id = '{user_id}'
+        FROM {member_source("attendances")} a
+        LEFT JOIN (
+            SELECT * FROM {id_source("classes")}
+            WHERE class_id IN (SELECT class_id FROM {member_source("attendances")} WHERE member_id = '{user_id}')
+            AND {LIVE_ROWS}
+        ) c ON a.class_id = c.class_id
+        LEFT JOIN (
+            SELECT * FROM {member_source("payments")} WHERE member_id = '{user_id}' AND {LIVE_ROWS}
+        ) p ON a.class_id = p.class_id AND a.member_id = p.member_id
+        WHERE a.member_id = '{user_id}' AND a.{LIVE_ROWS}
         ORDER BY a.timestamp DESC
-        FORMAT JSON
     """
     
-    resp = _http_post(query)
-    data = resp.json()
+    bookings = await aquery(query)
     
     return {
-        "bookings": data.get("data", []),
-        "total_count": len(data.get("data", []))
+        "bookings": bookings,
+        "total_count": len(bookings)
     }
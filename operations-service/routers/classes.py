@@ -1,8 +1,10 @@
-from fastapi import APIRouter, HTTPException, Query, Depends
+from fastapi import APIRouter, HTTPException, Query, Depends, Response
+from uuid import UUID
 from typing import List, Optional
 from datetime import datetime
 from models.classes import Class as ClassModel
-from db import select_all, insert_one, select_one, update_one, delete_one
+from db import insert_one, select_one, stream_table, DuplicateIdError
+from mutation_queue import mutation_queue
 from utils.validators import (
     ValidationError,
     validate_class_times,
@@ -11,15 +13,33 @@ from utils.validators import (
     check_trainer_availability,
     validate_foreign_keys
 )
+from utils.streaming import StreamFormat, STREAM_QUERY, stream_response
+from utils.pagination import LIMIT_QUERY, CURSOR_QUERY, list_rows
 from auth_middleware import get_current_user, require_trainer_or_admin
 
 router = APIRouter(prefix="/classes", tags=["classes"])
 
 
 @router.get("/", response_model=List[ClassModel])
-def list_classes():
-    rows = select_all("classes")
-    return rows
+def list_classes(
+    response: Response,
+    trainer_id: Optional[UUID] = Query(None),
+    room_id: Optional[UUID] = Query(None),
+    start_from: Optional[datetime] = Query(None, description="Only classes starting at or after this time"),
+    start_to: Optional[datetime] = Query(None, description="Only classes starting before this time"),
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    stream: Optional[StreamFormat] = STREAM_QUERY,
+):
+    filters = {
+        "trainer_id": trainer_id,
+        "room_id": room_id,
+        "start_time__gte": start_from,
+        "start_time__lt": start_to,
+    }
+    if stream:
+        return stream_response(stream_table("classes", filters), ClassModel, stream)
+    return list_rows("classes", filters, limit, cursor, response)
 
 
 @router.post("/", response_model=ClassModel)
@@ -52,6 +72,8 @@ def create_class(c: ClassModel, current_user: dict = Depends(require_trainer_or_
         return c
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=e.message)
+    except DuplicateIdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @router.get("/{class_id}", response_model=ClassModel)
@@ -90,7 +112,8 @@ def update_class(class_id: str, c: ClassModel):
             check_trainer_availability(None, c.trainer_id, c.start_time, c.end_time, exclude_class_id=class_id)
         
         class_dict = c.dict()
-        update_one("classes", "class_id", class_id, class_dict)
+        if not mutation_queue.update("classes", "class_id", class_id, class_dict):
+            raise HTTPException(status_code=404, detail="Class not found")
         c.class_id = class_id
         return c
     except ValidationError as e:
@@ -103,7 +126,9 @@ def delete_class(class_id: str):
     if not existing:
         raise HTTPException(status_code=404, detail="Class not found")
     try:
-        delete_one("classes", "class_id", class_id)
+        deleted = mutation_queue.delete("classes", "class_id", class_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete mutation failed: {e}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Class not found")
     return {"ok": True}
@@ -1,21 +1,46 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional, Literal
+from datetime import datetime
+from uuid import UUID
 from models.payment import Payment
-from db import select_all, insert_one, select_one, update_one, delete_one
+from db import select_one, stream_table, DuplicateIdError
+from mutation_queue import mutation_queue
+from write_buffer import buffered_insert, WriteBufferFullError
 from utils.validators import (
     ValidationError,
     validate_payment_amount,
     validate_foreign_keys
 )
+from utils.streaming import StreamFormat, STREAM_QUERY, stream_response
+from utils.pagination import LIMIT_QUERY, CURSOR_QUERY, list_rows
 from auth_middleware import get_current_user, require_admin
 
 router = APIRouter(prefix="/payments", tags=["payments"])
 
 
 @router.get("/", response_model=List[Payment])
-def list_payments(current_user: dict = Depends(get_current_user)):
-    rows = select_all("payments")
-    return rows
+def list_payments(
+    response: Response,
+    class_id: Optional[UUID] = Query(None),
+    member_id: Optional[str] = Query(None),
+    status: Optional[Literal["pending", "completed", "refunded"]] = Query(None),
+    since: Optional[datetime] = Query(None, description="Only payments at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only payments before this time"),
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    stream: Optional[StreamFormat] = STREAM_QUERY,
+    current_user: dict = Depends(get_current_user)
+):
+    filters = {
+        "class_id": class_id,
+        "member_id": member_id,
+        "status": status,
+        "timestamp__gte": since,
+        "timestamp__lt": until,
+    }
+    if stream:
+        return stream_response(stream_table("payments", filters), Payment, stream)
+    return list_rows("payments", filters, limit, cursor, response)
 
 # TODO: should call member service to verify member_id exists
 @router.post("/", response_model=Payment)
@@ -28,12 +53,16 @@ def create_payment(payment: Payment, current_user: dict = Depends(get_current_us
         validate_foreign_keys(None, class_id=payment.class_id)
         
         payment_dict = payment.dict()
-        generated_id = insert_one("payments", payment_dict)
+        generated_id = buffered_insert("payments", payment_dict)
         if generated_id and not payment.payment_id:
             payment.payment_id = generated_id
         return payment
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=e.message)
+    except WriteBufferFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except DuplicateIdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @router.get("/{payment_id}", response_model=Payment)
@@ -58,7 +87,8 @@ def update_payment(payment_id: str, payment: Payment):
         validate_foreign_keys(None, class_id=payment.class_id)
         
         payment_dict = payment.dict()
-        update_one("payments", "payment_id", payment_id, payment_dict)
+        if not mutation_queue.update("payments", "payment_id", payment_id, payment_dict):
+            raise HTTPException(status_code=404, detail="Payment not found")
         payment.payment_id = payment_id
         return payment
     except ValidationError as e:
@@ -71,7 +101,9 @@ def delete_payment(payment_id: str):
     if not existing:
         raise HTTPException(status_code=404, detail="Payment not found")
     try:
-        delete_one("payments", "payment_id", payment_id)
+        deleted = mutation_queue.delete("payments", "payment_id", payment_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete mutation failed: {e}")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Payment not found")
     return {"ok": True}
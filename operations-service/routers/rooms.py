@@ -1,21 +1,39 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, Response
+from typing import List, Optional
 from models.room import Room
-from db import select_all, insert_one, select_one, update_one, delete_one
+from db import insert_one, update_one, delete_one, stream_table, DuplicateIdError
+from reference_cache import reference_cache
+from utils.streaming import StreamFormat, STREAM_QUERY, stream_response
+from utils.pagination import LIMIT_QUERY, CURSOR_QUERY, list_rows
 
 router = APIRouter(prefix="/rooms", tags=["rooms"])
 
 
 @router.get("/", response_model=List[Room])
-def list_rooms():
-    rows = select_all("rooms")
-    return rows
+def list_rooms(
+    response: Response,
+    has_equipment: Optional[bool] = Query(None),
+    min_capacity: Optional[int] = Query(None, ge=0),
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    stream: Optional[StreamFormat] = STREAM_QUERY,
+):
+    filters = {"has_equipment": has_equipment, "capacity__gte": min_capacity}
+    if stream:
+        return stream_response(stream_table("rooms", filters), Room, stream)
+    if limit is None and cursor is None:
+        return reference_cache.filter("rooms", filters)
+    return list_rows("rooms", filters, limit, cursor, response)
 
 
 @router.post("/", response_model=Room)
 def create_room(room: Room):
     room_dict = room.dict()
-    generated_id = insert_one("rooms", room_dict)
+    try:
+        generated_id = insert_one("rooms", room_dict)
+    except DuplicateIdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    reference_cache.invalidate("rooms")
     # If ID was generated, update the response model
     if generated_id and not room.room_id:
         room.room_id = generated_id
@@ -24,7 +42,7 @@ def create_room(room: Room):
 
 @router.get("/{room_id}", response_model=Room)
 def get_room(room_id: str):
-    r = select_one("rooms", "room_id", room_id)
+    r = reference_cache.get("rooms", room_id)
     if not r:
         raise HTTPException(status_code=404, detail="Room not found")
     return r
@@ -32,23 +50,25 @@ def get_room(room_id: str):
 
 @router.put("/{room_id}", response_model=Room)
 def update_room(room_id: str, room: Room):
-    existing = select_one("rooms", "room_id", room_id)
-    if not existing:
-        raise HTTPException(status_code=404, detail="Room not found")
     room_dict = room.dict()
-    update_one("rooms", "room_id", room_id, room_dict)
+    # reference data is written synchronously so the shared cache never reloads a stale row;
+    # update_one reads the current row from ClickHouse, never from the cache
+    if not update_one("rooms", "room_id", room_id, room_dict):
+        raise HTTPException(status_code=404, detail="Room not found")
+    reference_cache.invalidate("rooms")
     room.room_id = room_id
     return room
 
 
 @router.delete("/{room_id}")
 def delete_room(room_id: str):
-    existing = select_one("rooms", "room_id", room_id)
-    if not existing:
-        raise HTTPException(status_code=404, detail="Room not found")
     try:
-        delete_one("rooms", "room_id", room_id)
+        deleted = delete_one("rooms", "room_id", room_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete mutation failed: {e}")
+    finally:
+        reference_cache.invalidate("rooms")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Room not found")
 
     return {"ok": True}
@@ -0,0 +1,84 @@
+from fastapi import APIRouter
+import db
+from write_buffer import write_buffer
+from mutation_queue import mutation_queue
+from reference_cache import reference_cache
+from analytics_cache import analytics_cache
+from roster_index import roster_index
+from seat_reservations import seat_reservations
+from auth_middleware import revocations
+from identity_cache import identity_cache
+from services import user_service_client
+
+router = APIRouter(prefix="/stats", tags=["stats"])
+
+
+@router.get("/clickhouse-pool")
+def get_clickhouse_pool_stats():
+    """Connection reuse statistics for the shared ClickHouse HTTP pool"""
+    return db.get_pool_stats()
+
+
+@router.get("/user-service-pool")
+def get_user_service_pool_stats():
+    """Connection reuse statistics for the shared user-service HTTP pool"""
+    return user_service_client.get_pool_stats()
+
+
+@router.get("/user-service-breakers")
+def get_user_service_breaker_stats():
+    """Circuit breaker state per user-service operation and the retry budget"""
+    return user_service_client.get_resilience_stats()
+
+
+@router.get("/id-filter")
+def get_id_filter_stats():
+    """Duplicate-ID filter fill level and how many reads it saved"""
+    return db.get_id_filter_stats()
+
+
+@router.get("/write-buffer")
+def get_write_buffer_stats():
+    """Per-table flush metrics for the buffered ClickHouse writer"""
+    return write_buffer.stats()
+
+
+@router.get("/reference-cache")
+def get_reference_cache_stats():
+    """Hit/miss counters for the rooms and trainers cache"""
+    return reference_cache.stats()
+
+
+@router.get("/analytics-cache")
+def get_analytics_cache_stats():
+    """Hit/stale/miss counters for the analytics result cache"""
+    return analytics_cache.stats()
+
+
+@router.get("/rosters")
+def get_roster_stats():
+    """Per-class roster index and seat holds used for booking admission"""
+    return {**roster_index.stats(), "reservations": seat_reservations.stats()}
+
+
+@router.get("/auth")
+def get_auth_stats():
+    """Local token verification: key ids and the synced revocation list"""
+    return revocations.stats()
+
+
+@router.get("/identity-cache")
+def get_identity_cache_stats():
+    """Hit/miss counters for cached token verifications and user IDs"""
+    return identity_cache.stats()
+
+
+@router.get("/mutations")
+def get_mutation_stats():
+    """Coalesced update/delete queue and the ClickHouse mutation backlog"""
+    stats = mutation_queue.stats()
+    try:
+        stats["clickhouse_backlog"] = db.get_mutation_backlog()
+    except Exception as e:
+        stats["clickhouse_backlog"] = {"error": str(e)}
+    return stats
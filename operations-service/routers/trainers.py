@@ -1,11 +1,14 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Request, Query, Response
+from typing import List, Optional
 from models.trainer import Trainer
-from db import select_all, insert_one, select_one, update_one, delete_one
+from db import update_one, stream_table, ainsert_one, aselect_one, adelete_one, DuplicateIdError
+from reference_cache import reference_cache
 from utils.validators import (
     ValidationError,
     validate_trainer_rating
 )
+from utils.streaming import StreamFormat, STREAM_QUERY, stream_response
+from utils.pagination import LIMIT_QUERY, CURSOR_QUERY, list_rows
 from auth_middleware import get_current_user, require_admin
 from services.user_service_sync import create_user_for_trainer, delete_user_for_trainer
 
@@ -13,9 +16,19 @@ router = APIRouter(prefix="/trainers", tags=["trainers"])
 
 
 @router.get("/", response_model=List[Trainer])
-def list_trainers():
-    rows = select_all("trainers")
-    return rows
+def list_trainers(
+    response: Response,
+    specialization: Optional[str] = Query(None),
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    stream: Optional[StreamFormat] = STREAM_QUERY,
+):
+    filters = {"specialization": specialization}
+    if stream:
+        return stream_response(stream_table("trainers", filters), Trainer, stream)
+    if limit is None and cursor is None:
+        return reference_cache.filter("trainers", filters)
+    return list_rows("trainers", filters, limit, cursor, response)
 
 
 @router.post("/", response_model=Trainer)
@@ -27,7 +40,8 @@ async def create_trainer(trainer: Trainer, current_user: dict = Depends(require_
         
         # First create in ClickHouse (operations DB)
         trainer_dict = trainer.dict()
-        generated_id = insert_one("trainers", trainer_dict)
+        generated_id = await ainsert_one("trainers", trainer_dict)
+        reference_cache.invalidate("trainers")
         if generated_id and not trainer.trainer_id:
             trainer.trainer_id = generated_id
         
@@ -43,11 +57,13 @@ async def create_trainer(trainer: Trainer, current_user: dict = Depends(require_
         return trainer
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=e.message)
+    except DuplicateIdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @router.get("/{trainer_id}", response_model=Trainer)
 def get_trainer(trainer_id: str):
-    t = select_one("trainers", "trainer_id", trainer_id)
+    t = reference_cache.get("trainers", trainer_id)
     if not t:
         raise HTTPException(status_code=404, detail="Trainer not found")
     return t
@@ -55,16 +71,16 @@ def get_trainer(trainer_id: str):
 
 @router.put("/{trainer_id}", response_model=Trainer)
 def update_trainer(trainer_id: str, trainer: Trainer, current_user: dict = Depends(require_admin)):
-    existing = select_one("trainers", "trainer_id", trainer_id)
-    if not existing:
-        raise HTTPException(status_code=404, detail="Trainer not found")
-    
     try:
         # Validate rating
         validate_trainer_rating(trainer.rating)
         
         trainer_dict = trainer.dict()
-        update_one("trainers", "trainer_id", trainer_id, trainer_dict)
+        # reference data is written synchronously so the shared cache never reloads a stale row;
+        # update_one reads the current row from ClickHouse, never from the cache
+        if not update_one("trainers", "trainer_id", trainer_id, trainer_dict):
+            raise HTTPException(status_code=404, detail="Trainer not found")
+        reference_cache.invalidate("trainers")
         trainer.trainer_id = trainer_id
         return trainer
     except ValidationError as e:
@@ -73,12 +89,13 @@ def update_trainer(trainer_id: str, trainer: Trainer, current_user: dict = Depen
 
 @router.delete("/{trainer_id}")
 async def delete_trainer(trainer_id: str, request: Request, current_user: dict = Depends(require_admin)):
-    existing = select_one("trainers", "trainer_id", trainer_id)
+    existing = await aselect_one("trainers", "trainer_id", trainer_id)
     if not existing:
         raise HTTPException(status_code=404, detail="Trainer not found")
     try:
         # Delete from ClickHouse
-        delete_one("trainers", "trainer_id", trainer_id)
+        await adelete_one("trainers", "trainer_id", trainer_id)
+        reference_cache.invalidate("trainers")
         
         # Also delete from user service (best effort) using trainer name to derive username
         auth_header = request.headers.get("authorization") or request.headers.get("Authorization")
@@ -0,0 +1,153 @@
+"""
+Seat reservations: decides booking admission in one atomic step per class.
+
+reserve() takes a class's lock, counts the roster's seats plus the live
+holds, and either records a hold for the member or raises
+SeatUnavailableError. Nothing slow (no I/O) happens under the lock, so
+concurrent bookings for one class queue for microseconds rather than
+racing a count(*) against a later insert.
+
+The caller then does the slow work (charge the member, write the
+attendance) and either confirm()s the hold once the attendance row has
+been accepted (the roster counts it from then on), or release()s it. A
+hold that is neither confirmed nor released expires after SEAT_HOLD_TTL
+seconds. Both calls are idempotent.
+
+Locks are striped (SEAT_LOCK_STRIPES) so memory stays flat however many
+classes are booked. Like the roster, holds are per process.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+from uuid import uuid4
+
+from roster_index import RosterIndex, roster_index
+
+SEAT_HOLD_TTL = float(os.getenv("SEAT_HOLD_TTL", "30"))  # seconds
+SEAT_LOCK_STRIPES = int(os.getenv("SEAT_LOCK_STRIPES", "256"))
+
+
+class SeatUnavailableError(Exception):
+    """Raised by reserve(); reason is "full" or "duplicate" """
+    def __init__(self, reason: str, seats_taken: int, capacity: Optional[int]):
+        self.reason = reason
+        self.seats_taken = seats_taken
+        self.capacity = capacity
+        if reason == "duplicate":
+            message = "Member already holds a seat in this class"
+        else:
+            message = f"Class is full ({seats_taken}/{capacity})"
+        super().__init__(message)
+
+
+class Reservation:
+    __slots__ = ("reservation_id", "class_id", "member_id", "expires")
+
+    def __init__(self, class_id: str, member_id: str, ttl: float):
+        self.reservation_id = str(uuid4())
+        self.class_id = class_id
+        self.member_id = member_id
+        self.expires = time.monotonic() + ttl
+
+
+class SeatReservations:
+    def __init__(self, rosters: RosterIndex = roster_index, ttl: float = SEAT_HOLD_TTL,
+                 stripes: int = SEAT_LOCK_STRIPES):
+        self.rosters = rosters
+        self.ttl = ttl
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # class -> reservation_id -> hold; guarded by the class's stripe
+        self._holds: Dict[str, Dict[str, Reservation]] = {}
+        self._counters_lock = threading.Lock()
+        self._counters = {"reserved": 0, "confirmed": 0, "released": 0, "expired": 0,
+                          "rejected_full": 0, "rejected_duplicate": 0}
+
+    def _lock(self, class_id: str) -> threading.Lock:
+        return self._locks[hash(class_id) % len(self._locks)]
+
+    def _count(self, name: str, n: int = 1) -> None:
+        if n:
+            with self._counters_lock:
+                self._counters[name] += n
+
+    def _try_reserve(self, class_id: str, member_id: str, capacity: Optional[int],
+                     one_per_member: bool) -> Optional[Reservation]:
+        """The admission decision; None if the class roster is not loaded"""
+        with self._lock(class_id):
+            checked = self.rosters.peek(class_id, member_id)
+            if checked is None:
+                return None
+            seats, booked = checked
+            holds = self._holds.get(class_id, {})
+            now = time.monotonic()
+            expired = [rid for rid, hold in holds.items() if hold.expires <= now]
+            for rid in expired:
+                del holds[rid]
+            if expired and not holds:
+                del self._holds[class_id]
+            self._count("expired", len(expired))
+            if one_per_member and (booked or any(hold.member_id == member_id for hold in holds.values())):
+                self._count("rejected_duplicate")
+                raise SeatUnavailableError("duplicate", seats + len(holds), capacity)
+            if capacity is not None and seats + len(holds) >= capacity:
+                self._count("rejected_full")
+                raise SeatUnavailableError("full", seats + len(holds), capacity)
+            reservation = Reservation(class_id, member_id, self.ttl)
+            holds[reservation.reservation_id] = reservation
+            self._holds[class_id] = holds
+        self._count("reserved")
+        return reservation
+
+    def reserve(self, class_id: Any, member_id: Any, capacity: Optional[int],
+                one_per_member: bool = True) -> Reservation:
+        """Hold a seat for member_id, or raise SeatUnavailableError.
+
+        capacity None means unlimited; one_per_member rejects a member who
+        already holds a seat or a reservation in the class.
+        """
+        class_id, member_id = str(class_id), str(member_id)
+        reservation = self._try_reserve(class_id, member_id, capacity, one_per_member)
+        while reservation is None:
+            self.rosters.admission(class_id)  # loads the roster
+            reservation = self._try_reserve(class_id, member_id, capacity, one_per_member)
+        return reservation
+
+    async def areserve(self, class_id: Any, member_id: Any, capacity: Optional[int],
+                       one_per_member: bool = True) -> Reservation:
+        class_id, member_id = str(class_id), str(member_id)
+        reservation = self._try_reserve(class_id, member_id, capacity, one_per_member)
+        while reservation is None:
+            await self.rosters.aadmission(class_id)
+            reservation = self._try_reserve(class_id, member_id, capacity, one_per_member)
+        return reservation
+
+    def _drop(self, reservation: Optional[Reservation]) -> bool:
+        if reservation is None:
+            return False
+        with self._lock(reservation.class_id):
+            holds = self._holds.get(reservation.class_id)
+            if not holds or holds.pop(reservation.reservation_id, None) is None:
+                return False
+            if not holds:
+                del self._holds[reservation.class_id]
+            return True
+
+    def confirm(self, reservation: Optional[Reservation]) -> None:
+        """The attendance is written (or queued); the roster now holds the seat"""
+        if self._drop(reservation):
+            self._count("confirmed")
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        """Give the seat back; a no-op after confirm()"""
+        if self._drop(reservation):
+            self._count("released")
+
+    def stats(self) -> Dict[str, Any]:
+        active = sum(len(holds) for holds in list(self._holds.values()))
+        with self._counters_lock:
+            counters = dict(self._counters)
+        return {"hold_ttl_seconds": self.ttl, "active_holds": active, **counters}
+
+
+seat_reservations = SeatReservations()
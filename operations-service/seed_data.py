@@ -5,11 +5,33 @@ from uuid import uuid4
 
 BASE_URL = "http://localhost:8080"
 
+def clickhouse_data_tables():
+    """Base tables plus the mirrors and rollups the migrations derive from them.
+
+    Everything stored in a MergeTree-family table counts, except the
+    migration history and the backups kept by migrations.
+    """
+    tables = ["attendances", "payments", "classes", "trainers", "rooms"]
+    try:
+        response = requests.post(
+            "http://localhost:8123",
+            auth=("admin", "admin"),
+            data="SELECT name FROM system.tables WHERE database = currentDatabase() "
+                 "AND engine LIKE '%MergeTree' AND name != 'schema_migrations' "
+                 "AND NOT endsWith(name, '__premigration') FORMAT JSONEachRow"
+        )
+        response.raise_for_status()
+        found = [json.loads(line)["name"] for line in response.text.splitlines() if line]
+        tables += [table for table in found if table not in tables]
+    except Exception as e:
+        print(f"  ✗ Could not list derived tables, clearing base tables only: {e}")
+    return tables
+
 def clear_all_data():
-    """Clear all data from tables"""
+    """Clear all data from tables, including mirrors and rollups"""
     print("Clearing all data...")
     
-    tables = ["attendances", "payments", "classes", "trainers", "rooms"]
+    tables = clickhouse_data_tables()
     
     # Truncate tables
     for table in tables:
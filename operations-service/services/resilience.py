@@ -0,0 +1,128 @@
+"""
+Circuit breaker and retry budget used by the user-service client.
+
+CircuitBreaker: after BREAKER_FAILURES consecutive failures (transport
+errors, timeouts, 5xx) the circuit opens and calls fail at once with
+CircuitOpenError for BREAKER_OPEN_SECONDS. Then one trial call is let
+through (half-open): success closes the circuit, failure opens it again.
+
+RetryBudget: a token bucket shared by all operations. Every first attempt
+deposits RETRY_BUDGET_RATIO of a token (up to RETRY_BUDGET_MAX); every
+retry or hedged request spends one. Retries therefore add at most that
+fraction of extra load, however slow user-service gets.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict
+
+import httpx
+
+import metrics
+
+BREAKER_FAILURES = int(os.getenv("USER_SERVICE_BREAKER_FAILURES", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("USER_SERVICE_BREAKER_OPEN_SECONDS", "10"))
+RETRY_BUDGET_RATIO = float(os.getenv("USER_SERVICE_RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MAX = float(os.getenv("USER_SERVICE_RETRY_BUDGET_MAX", "10"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of calling user-service while a circuit is open"""
+    def __init__(self, operation: str, retry_after: float):
+        self.operation = operation
+        self.retry_after = retry_after
+        super().__init__(f"Circuit for {operation} is open, retry in {retry_after:.1f}s")
+
+
+class CircuitBreaker:
+    def __init__(self, operation: str, failures: int = BREAKER_FAILURES, open_seconds: float = BREAKER_OPEN_SECONDS):
+        self.operation = operation
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "failures": 0, "short_circuited": 0, "opened": 0}
+        metrics.USER_SERVICE_BREAKER_STATE.labels(operation).set(0)
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            self.state = state
+            metrics.USER_SERVICE_BREAKER_STATE.labels(self.operation).set(_STATE_VALUES[state])
+            metrics.USER_SERVICE_BREAKER_TRANSITIONS.labels(self.operation, state).inc()
+            if state == OPEN:
+                self._counters["opened"] += 1
+                print(f"[USER SERVICE] Circuit for {self.operation} opened "
+                      f"after {self.consecutive_failures} failures")
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go out now"""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    self._counters["short_circuited"] += 1
+                    metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(self.operation, "short_circuit").inc()
+                    raise CircuitOpenError(self.operation, remaining)
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    self._counters["short_circuited"] += 1
+                    metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(self.operation, "short_circuit").inc()
+                    raise CircuitOpenError(self.operation, 0.0)
+                self._trial_running = True
+            self._counters["calls"] += 1
+
+    def abandon(self) -> None:
+        """The call was cancelled before it finished; counts neither way"""
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self.consecutive_failures = 0
+                self._set_state(CLOSED)
+                return
+            self._counters["failures"] += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures, **self._counters}
+
+
+class RetryBudget:
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, maximum: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self._tokens = maximum
+        self._lock = threading.Lock()
+        self._counters = {"deposits": 0, "spent": 0, "exhausted": 0}
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.maximum, self._tokens + self.ratio)
+            self._counters["deposits"] += 1
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self._counters["spent"] += 1
+                return True
+            self._counters["exhausted"] += 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"ratio": self.ratio, "max": self.maximum, "tokens": round(self._tokens, 2), **self._counters}
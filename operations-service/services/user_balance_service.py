@@ -2,11 +2,11 @@
 User Balance Service Client
 Handles communication with user-service for balance operations
 """
-import os
 import httpx
 from typing import Optional, Dict, Any
 
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
+from metrics import track_user_service
+from services import user_service_client
 
 
 class BalanceServiceError(Exception):
@@ -23,11 +23,13 @@ async def get_user_balance(user_id: str, bearer_token: str) -> float:
     headers = {"Authorization": f"Bearer {bearer_token}"}
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"{USER_SERVICE_URL}/users/{user_id}/balance",
+        async with track_user_service("get_balance"):
+            resp = await user_service_client.request(
+                "get_balance", "GET",
+                f"/users/{user_id}/balance",
                 headers=headers,
-                timeout=5.0
+                timeout=5.0,
+                hedge=True
             )
             resp.raise_for_status()
             data = resp.json()
@@ -45,9 +47,10 @@ async def deduct_user_balance(user_id: str, amount: float, bearer_token: str) ->
     payload = {"amount": amount}
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{USER_SERVICE_URL}/users/{user_id}/balance/deduct",
+        async with track_user_service("deduct_balance"):
+            resp = await user_service_client.request(
+                "deduct_balance", "POST",
+                f"/users/{user_id}/balance/deduct",
                 headers=headers,
                 json=payload,
                 timeout=5.0
@@ -69,9 +72,10 @@ async def refund_user_balance(user_id: str, amount: float, bearer_token: str) ->
     payload = {"amount": amount}
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{USER_SERVICE_URL}/users/{user_id}/balance/add",
+        async with track_user_service("refund_balance"):
+            resp = await user_service_client.request(
+                "refund_balance", "POST",
+                f"/users/{user_id}/balance/add",
                 headers=headers,
                 json=payload,
                 timeout=5.0
@@ -0,0 +1,228 @@
+"""
+Shared HTTP client for calls to user-service.
+
+One httpx.AsyncClient (and so one keep-alive connection pool) serves
+every call this service makes to user-service: token verification, /me,
+balance reads and updates, and trainer account sync. It is opened on
+startup and closed on shutdown (get_client() also opens it lazily, for
+scripts). Requests use paths relative to USER_SERVICE_URL.
+
+- USER_SERVICE_POOL_MAX_CONNECTIONS / _MAX_KEEPALIVE: pool size and how
+  many idle connections are kept, for up to USER_SERVICE_KEEPALIVE_EXPIRY
+  seconds
+- USER_SERVICE_HTTP2: negotiate HTTP/2 where the server supports it
+  (h2 comes with httpx[http2] in requirements.txt; uvicorn itself only
+  speaks HTTP/1.1, so this helps only behind an HTTP/2 proxy)
+- USER_SERVICE_CONNECT_TIMEOUT / USER_SERVICE_TIMEOUT: default timeouts;
+  calls may pass their own
+
+Calls go through request(), which adds (see services/resilience.py):
+
+- a circuit breaker per operation; while it is open, calls raise
+  CircuitOpenError (an httpx.TransportError) without touching the network
+- for GETs only: up to USER_SERVICE_RETRIES retries on transport errors
+  and 502/503/504, with full-jitter backoff and capped by the retry budget
+- for GETs that ask for it: a hedged second request when the first has
+  not answered within USER_SERVICE_HEDGE_AFTER_MS (0, the default,
+  disables hedging); the first response wins
+"""
+import asyncio
+import os
+import random
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+
+import metrics
+from services.resilience import CircuitBreaker, CircuitOpenError, RetryBudget
+
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8000")
+USER_SERVICE_POOL_MAX_CONNECTIONS = int(os.getenv("USER_SERVICE_POOL_MAX_CONNECTIONS", "100"))
+USER_SERVICE_POOL_MAX_KEEPALIVE = int(os.getenv("USER_SERVICE_POOL_MAX_KEEPALIVE", "20"))
+USER_SERVICE_KEEPALIVE_EXPIRY = float(os.getenv("USER_SERVICE_KEEPALIVE_EXPIRY", "30"))  # seconds
+USER_SERVICE_HTTP2 = os.getenv("USER_SERVICE_HTTP2", "false").lower() in ("1", "true", "yes")
+USER_SERVICE_CONNECT_TIMEOUT = float(os.getenv("USER_SERVICE_CONNECT_TIMEOUT", "2"))
+USER_SERVICE_TIMEOUT = float(os.getenv("USER_SERVICE_TIMEOUT", "5"))
+USER_SERVICE_RETRIES = int(os.getenv("USER_SERVICE_RETRIES", "2"))
+USER_SERVICE_RETRY_BACKOFF = float(os.getenv("USER_SERVICE_RETRY_BACKOFF_MS", "50")) / 1000
+USER_SERVICE_HEDGE_AFTER = float(os.getenv("USER_SERVICE_HEDGE_AFTER_MS", "0")) / 1000
+
+_RETRY_STATUSES = {502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+_http2 = False
+_counters = {"requests": 0, "connections_opened": 0}
+_counters_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+retry_budget = RetryBudget()
+
+
+def _count(name: str) -> None:
+    with _counters_lock:
+        _counters[name] += 1
+
+
+async def _trace(event: str, info: Dict[str, Any]) -> None:
+    if event == "connection.connect_tcp.complete":
+        _count("connections_opened")
+
+
+async def _on_request(request: httpx.Request) -> None:
+    _count("requests")
+    request.extensions["trace"] = _trace
+
+
+def _http2_available() -> bool:
+    if not USER_SERVICE_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  installed by httpx[http2]
+        return True
+    except ImportError:
+        print("[USER SERVICE] USER_SERVICE_HTTP2 is set but h2 is not installed; using HTTP/1.1")
+        return False
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared user-service client, creating it on first use"""
+    global _client, _http2
+    if _client is None or _client.is_closed:
+        _http2 = _http2_available()
+        _client = httpx.AsyncClient(
+            base_url=USER_SERVICE_URL,
+            http2=_http2,
+            limits=httpx.Limits(
+                max_connections=USER_SERVICE_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=USER_SERVICE_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=USER_SERVICE_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(USER_SERVICE_TIMEOUT, connect=USER_SERVICE_CONNECT_TIMEOUT),
+            event_hooks={"request": [_on_request]},
+        )
+    return _client
+
+
+def open_client() -> None:
+    """Create the shared client (called on startup)"""
+    get_client()
+
+
+async def aclose_client() -> None:
+    """Close the shared client and its connections (called on shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def breaker(operation: str) -> CircuitBreaker:
+    found = _breakers.get(operation)
+    if found is None:
+        with _counters_lock:
+            found = _breakers.setdefault(operation, CircuitBreaker(operation))
+    return found
+
+
+async def _attempt(operation: str, method: str, path: str, **kwargs) -> httpx.Response:
+    circuit = breaker(operation)
+    circuit.before_call()
+    try:
+        response = await get_client().request(method, path, **kwargs)
+    except httpx.RequestError:
+        circuit.record(False)
+        raise
+    except BaseException:
+        circuit.abandon()
+        raise
+    circuit.record(response.status_code < 500)
+    return response
+
+
+async def _hedged(operation: str, method: str, path: str, **kwargs) -> httpx.Response:
+    first = asyncio.ensure_future(_attempt(operation, method, path, **kwargs))
+    done, _ = await asyncio.wait({first}, timeout=USER_SERVICE_HEDGE_AFTER)
+    if done or not retry_budget.try_spend():
+        return await first
+    metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(operation, "hedge").inc()
+    second = asyncio.ensure_future(_attempt(operation, method, path, **kwargs))
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(operation, "hedge_won").inc()
+                    return task.result()
+        return first.result()  # both failed: raise the first error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def request(operation: str, method: str, path: str, hedge: bool = False, **kwargs) -> httpx.Response:
+    """Call user-service through the operation's circuit breaker; GETs are
+    retried, and hedged if hedge=True and USER_SERVICE_HEDGE_AFTER_MS is set"""
+    retry_budget.deposit()
+    if method.upper() != "GET":
+        return await _attempt(operation, method, path, **kwargs)
+    send = _hedged if hedge and USER_SERVICE_HEDGE_AFTER > 0 else _attempt
+    attempt = 0
+    while True:
+        error = None
+        try:
+            response = await send(operation, method, path, **kwargs)
+            if response.status_code not in _RETRY_STATUSES:
+                return response
+        except CircuitOpenError:
+            raise
+        except httpx.RequestError as e:
+            error = e
+        if attempt >= USER_SERVICE_RETRIES:
+            break
+        if not retry_budget.try_spend():
+            metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(operation, "budget_exhausted").inc()
+            break
+        attempt += 1
+        metrics.USER_SERVICE_RESILIENCE_EVENTS.labels(operation, "retry").inc()
+        await asyncio.sleep(random.uniform(0, USER_SERVICE_RETRY_BACKOFF * 2 ** attempt))
+    if error is not None:
+        raise error
+    return response
+
+
+def get_resilience_stats() -> Dict[str, Any]:
+    """Circuit breaker state per operation and the shared retry budget"""
+    return {
+        "retries": USER_SERVICE_RETRIES,
+        "hedge_after_ms": USER_SERVICE_HEDGE_AFTER * 1000,
+        "retry_budget": retry_budget.stats(),
+        "breakers": {operation: circuit.stats() for operation, circuit in list(_breakers.items())},
+    }
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Connection reuse statistics for the user-service pool"""
+    with _counters_lock:
+        counters = dict(_counters)
+    stats = {
+        "base_url": USER_SERVICE_URL,
+        "http2": _http2,
+        "max_connections": USER_SERVICE_POOL_MAX_CONNECTIONS,
+        "max_keepalive_connections": USER_SERVICE_POOL_MAX_KEEPALIVE,
+        "keepalive_expiry_seconds": USER_SERVICE_KEEPALIVE_EXPIRY,
+        **counters,
+        "reuse_ratio": round(1 - counters["connections_opened"] / counters["requests"], 4) if counters["requests"] else 0.0,
+        "open_connections": None,
+        "idle_connections": None,
+    }
+    # httpx does not expose its pool; read httpcore's connection list where
+    # it is, and report the counters alone if another version moved it
+    pool = getattr(getattr(_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is not None:
+        connections = list(connections)
+        stats["open_connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+    return stats
@@ -2,10 +2,11 @@
 User Service Sync Module
 Handles synchronization of trainer data with the user service
 """
-import httpx
 import os
 
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://localhost:8000")
+from metrics import track_user_service
+from services import user_service_client
+
 ADMIN_USERNAME = os.getenv("USER_SERVICE_ADMIN_USERNAME")
 ADMIN_PASSWORD = os.getenv("USER_SERVICE_ADMIN_PASSWORD")
 
@@ -23,10 +24,11 @@ async def create_user_for_trainer(trainer_id: str, name: str, email: str = None,
     if not password:
         password = "123456"  # Default password
     
-    async with httpx.AsyncClient() as client:
+    async with track_user_service("create_user"):
         try:
-            response = await client.post(
-                f"{USER_SERVICE_URL}/register",
+            response = await user_service_client.request(
+                "create_user", "POST",
+                "/register",
                 json={
                     "username": username,
                     "email": email,
@@ -58,10 +60,11 @@ async def _get_admin_token() -> str | None:
         print("[WARN] Missing USER_SERVICE_ADMIN_USERNAME/PASSWORD envs; cannot delete trainer user")
         return None
 
-    async with httpx.AsyncClient() as client:
+    async with track_user_service("admin_login"):
         try:
-            resp = await client.post(
-                f"{USER_SERVICE_URL}/login",
+            resp = await user_service_client.request(
+                "admin_login", "POST",
+                "/login",
                 json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD},
                 timeout=5.0
             )
@@ -77,10 +80,10 @@ async def _get_admin_token() -> str | None:
 
 async def _find_user_id_by_username(token: str, username: str) -> str | None:
     headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
+    async with track_user_service("find_user"):
         try:
             # Filter to role=trainer to reduce payload
-            resp = await client.get(f"{USER_SERVICE_URL}/users", params={"role": "trainer"}, headers=headers, timeout=7.0)
+            resp = await user_service_client.request("find_user", "GET", "/users", params={"role": "trainer"}, headers=headers, timeout=7.0)
             if resp.status_code != 200:
                 print(f"[ERROR] List users failed: {resp.status_code} {resp.text}")
                 return None
@@ -96,9 +99,9 @@ async def _find_user_id_by_username(token: str, username: str) -> str | None:
 
 async def _delete_user_by_id(token: str, user_id: str) -> bool:
     headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
+    async with track_user_service("delete_user"):
         try:
-            resp = await client.delete(f"{USER_SERVICE_URL}/users/{user_id}", headers=headers, timeout=5.0)
+            resp = await user_service_client.request("delete_user", "DELETE", f"/users/{user_id}", headers=headers, timeout=5.0)
             if resp.status_code in (204, 200):
                 return True
             print(f"[ERROR] Delete user failed: {resp.status_code} {resp.text}")
@@ -0,0 +1,84 @@
+"""
+create_mirror against a live ClickHouse: rows updated and deleted while
+the mirror is being built must end up in the mirror exactly as in the
+source.
+
+Writes are injected around the backfill, i.e. after the view attached and
+before the cancel repair. Skipped when ClickHouse is not reachable.
+
+    cd operations-service
+    CLICKHOUSE_HOST=localhost python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from migrations import ddl  # noqa: E402
+
+SOURCE = "test_mirror_source"
+MIRROR = "test_mirror_source_by_id"
+COLUMNS = [("id", "String"), ("value", "Int32")]
+
+
+def _reachable() -> bool:
+    try:
+        return requests.get(f"{db._BASE_URL}/ping", timeout=2).ok
+    except requests.RequestException:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _reachable(), reason="ClickHouse is not reachable")
+
+
+def _write(*rows):
+    """Insert (id, value, _version, _sign) rows into the source table"""
+    body = "".join(json.dumps(dict(zip(["id", "value", "_version", "_sign"], row))) + "\n" for row in rows)
+    db._http_post(f"INSERT INTO {SOURCE} FORMAT JSONEachRow", data=body)
+
+
+def _live(table):
+    rows = db.query(f"SELECT id, value FROM {table} WHERE _sign = 1 ORDER BY id")
+    return [(row["id"], row["value"]) for row in rows]
+
+
+def _drop():
+    db._http_post(f"DROP VIEW IF EXISTS {MIRROR}_mv")
+    db._http_post(f"DROP TABLE IF EXISTS {MIRROR}")
+    db._http_post(f"DROP TABLE IF EXISTS {SOURCE}")
+
+
+@pytest.fixture
+def source():
+    _drop()
+    db._http_post(ddl.versioned_table_sql(SOURCE, COLUMNS, "id"))
+    _write(("a", 1, 1, 1), ("b", 2, 1, 1), ("c", 3, 1, 1), ("d", 4, 1, 1))
+    yield
+    _drop()
+
+
+def test_writes_during_build_match_source(source, monkeypatch):
+    backfill = ddl.backfill
+
+    def backfill_with_writes(*args, **kwargs):
+        # cancelled before the backfill: collapsed in the source, only the
+        # cancel reaches the mirror, so the repair must pair it off
+        _write(("c", 3, 1, -1))
+        scanned = backfill(*args, **kwargs)
+        # cancelled after the backfill copied them: the mirror already has
+        # their state, so the repair must leave these cancels alone
+        _write(("a", 1, 1, -1), ("a", 10, 2, 1))
+        _write(("b", 2, 1, -1))
+        _write(("e", 5, 3, 1), ("e", 5, 3, -1))
+        return scanned
+
+    monkeypatch.setattr(ddl, "backfill", backfill_with_writes)
+    ddl.create_mirror(MIRROR, SOURCE, COLUMNS, "id", progress=lambda _: None)
+
+    assert _live(MIRROR) == _live(SOURCE) == [("a", 10), ("d", 4)]
+    assert ddl.table_comment(MIRROR) == ddl.MIRROR_READY_COMMENT
@@ -0,0 +1,34 @@
+"""
+Keyset pagination and filter helpers shared by the list endpoints.
+
+Pages are ordered by each table's sort key (db.ORDER_KEYS); the cursor for
+the next page is returned in the X-Next-Cursor response header so the
+response body stays a plain list.
+"""
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException, Query, Response
+
+from db import select_all, select_by_filters, select_page
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+LIMIT_QUERY = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size; enables keyset pagination")
+CURSOR_QUERY = Query(None, description=f"Opaque cursor from the {NEXT_CURSOR_HEADER} header of the previous page")
+
+
+def list_rows(table: str, filters: Dict[str, Any], limit: Optional[int], cursor: Optional[str],
+              response: Response) -> List[Dict[str, Any]]:
+    """Fetch a filtered list, paginated when limit or cursor is given"""
+    filters = {key: value for key, value in filters.items() if value is not None}
+    if limit is None and cursor is None:
+        return select_by_filters(table, filters) if filters else select_all(table)
+    try:
+        rows, next_cursor = select_page(table, filters, limit or DEFAULT_PAGE_SIZE, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows
@@ -0,0 +1,61 @@
+"""
+Streaming response helpers for list endpoints.
+
+Rows flow ClickHouse -> generator -> pydantic validation -> client without
+ever materialising the whole table.
+"""
+import json
+from typing import Any, Dict, Iterable, Iterator, Literal, Optional, Type
+
+from fastapi import Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+StreamFormat = Literal["ndjson", "json"]
+
+STREAM_QUERY = Query(
+    None,
+    description="Stream the result instead of buffering it: 'ndjson' (one object per line) or 'json' (chunked JSON array)",
+)
+
+# Rows are encoded in batches so each chunk written to the socket is a useful size
+_BATCH_SIZE = 500
+
+
+def _encode(rows: Iterable[Dict[str, Any]], model: Type[BaseModel]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(jsonable_encoder(model(**row)), separators=(",", ":"))
+
+
+def _ndjson(rows: Iterable[Dict[str, Any]], model: Type[BaseModel]) -> Iterator[str]:
+    batch = []
+    for encoded in _encode(rows, model):
+        batch.append(encoded)
+        if len(batch) >= _BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+
+def _json_array(rows: Iterable[Dict[str, Any]], model: Type[BaseModel]) -> Iterator[str]:
+    yield "["
+    batch = []
+    first = True
+    for encoded in _encode(rows, model):
+        batch.append(encoded)
+        if len(batch) >= _BATCH_SIZE:
+            yield ("" if first else ",") + ",".join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ("" if first else ",") + ",".join(batch)
+    yield "]"
+
+
+def stream_response(rows: Iterable[Dict[str, Any]], model: Type[BaseModel], fmt: Optional[StreamFormat]) -> StreamingResponse:
+    """Wrap a row generator in a StreamingResponse of the requested format"""
+    if fmt == "ndjson":
+        return StreamingResponse(_ndjson(rows, model), media_type="application/x-ndjson")
+    return StreamingResponse(_json_array(rows, model), media_type="application/json")
@@ -71,7 +71,7 @@ def validate_attendance_status(status: str) -> None:
 def check_room_availability(db, room_id: UUID, start_time: datetime, end_time: datetime, 
                             exclude_class_id: Optional[UUID] = None) -> None:
     """Check if room is available for the given time slot"""
-    from db import _http_post
+    from db import _http_post, LIVE_ROWS
     
     exclude_clause = f"AND class_id != '{exclude_class_id}'" if exclude_class_id else ""
     
@@ -81,7 +81,7 @@ def check_room_availability(db, room_id: UUID, start_time: datetime, end_time: d
     query = f"""
         SELECT class_id, name, start_time, end_time
         FROM classes
-        WHERE room_id = '{room_id}'
+        WHERE room_id = '{room_id}' AND {LIVE_ROWS}
         AND (
             (start_time <= '{start_str}' 
              AND end_time > '{start_str}')
@@ -112,7 +112,7 @@ def check_room_availability(db, room_id: UUID, start_time: datetime, end_time: d
 def check_trainer_availability(db, trainer_id: UUID, start_time: datetime, end_time: datetime,
                                 exclude_class_id: Optional[UUID] = None) -> None:
     """Check if trainer is available for the given time slot"""
-    from db import _http_post
+    from db import _http_post, LIVE_ROWS
     
     exclude_clause = f"AND class_id != '{exclude_class_id}'" if exclude_class_id else ""
     
@@ -122,7 +122,7 @@ def check_trainer_availability(db, trainer_id: UUID, start_time: datetime, end_t
     query = f"""
         SELECT class_id, name, start_time, end_time
         FROM classes
-        WHERE trainer_id = '{trainer_id}'
+        WHERE trainer_id = '{trainer_id}' AND {LIVE_ROWS}
         AND (
             (start_time <= '{start_str}' 
              AND end_time > '{start_str}')
@@ -152,24 +152,15 @@ def check_trainer_availability(db, trainer_id: UUID, start_time: datetime, end_t
 
 def check_class_capacity(db, class_id: UUID) -> Dict[str, Any]:
     """Check class capacity and return capacity info"""
-    from db import _http_post
+    from db import select_one
+    from roster_index import roster_index
     
     # Get class capacity
-    class_query = f"""
-        SELECT capacity, name
-        FROM classes
-        WHERE class_id = '{class_id}'
-        FORMAT JSON
-    """
-    
-    resp = _http_post(class_query)
-    data = resp.json()
-    class_data = data.get("data", [])
+    class_info = select_one("classes", "class_id", str(class_id))
     
-    if not class_data:
+    if not class_info:
         raise ValidationError("Class not found", "class_id")
     
-    class_info = class_data[0]
     capacity = class_info.get("capacity")
     
     if capacity is None:
@@ -181,19 +172,8 @@ def check_class_capacity(db, class_id: UUID) -> Dict[str, Any]:
             "class_name": class_info.get("name")
         }
     
-    # Count current attendances
-    attendance_query = f"""
-        SELECT count(*) as count
-        FROM attendances
-        WHERE class_id = '{class_id}'
-        AND status != 'cancelled'
-        FORMAT JSON
-    """
-    
-    resp = _http_post(attendance_query)
-    data = resp.json()
-    count_data = data.get("data", [{}])[0]
-    current_count = count_data.get("count", 0)
+    # Count current attendances (not cancelled)
+    current_count = roster_index.seats_taken(class_id)
     
     return {
         "capacity": capacity,
@@ -222,6 +202,7 @@ def validate_foreign_keys(db, class_id: Optional[UUID] = None,
                          member_id: Optional[UUID] = None) -> None:
     """Validate that foreign key references exist"""
     from db import select_one
+    from reference_cache import reference_cache
     
     if class_id:
         result = select_one("classes", "class_id", str(class_id))
@@ -229,12 +210,12 @@ def validate_foreign_keys(db, class_id: Optional[UUID] = None,
             raise ValidationError(f"Class with ID {class_id} not found", "class_id")
     
     if trainer_id:
-        result = select_one("trainers", "trainer_id", str(trainer_id))
+        result = reference_cache.get("trainers", trainer_id)
         if not result:
             raise ValidationError(f"Trainer with ID {trainer_id} not found", "trainer_id")
     
     if room_id:
-        result = select_one("rooms", "room_id", str(room_id))
+        result = reference_cache.get("rooms", room_id)
         if not result:
             raise ValidationError(f"Room with ID {room_id} not found", "room_id")
     
@@ -244,12 +225,12 @@ def validate_foreign_keys(db, class_id: Optional[UUID] = None,
 
 def validate_payment_before_attendance(db, class_id: UUID, member_id: UUID) -> None:
     """Validate that member has paid before checking in"""
-    from db import _http_post
+    from db import _http_post, LIVE_ROWS
     
     query = f"""
         SELECT payment_id
         FROM payments
-        WHERE class_id = '{class_id}'
+        WHERE class_id = '{class_id}' AND {LIVE_ROWS}
         AND member_id = '{member_id}'
         FORMAT JSON
     """
@@ -0,0 +1,322 @@
+"""
+In-process write buffer for high-volume ClickHouse tables.
+
+Rows are queued per table and written with a single db.insert_many call
+once a table has WRITE_BUFFER_MAX_ROWS rows waiting or its oldest row is
+WRITE_BUFFER_MAX_AGE seconds old. A background thread does the flushing so
+request handlers only pay for an append. Everything left is flushed on
+shutdown.
+
+Rows that fail to flush stay queued and are retried:
+
+- while ClickHouse is unreachable or times out, the whole batch is
+  retried as is
+- when ClickHouse rejects a batch, it is retried in halves (and the halves
+  in halves), so the rows that are fine still get written; the batch size
+  grows back after successful flushes
+- a row rejected on its own WRITE_BUFFER_MAX_RETRIES times is dropped:
+  logged, appended to WRITE_BUFFER_DEAD_LETTER_FILE (JSON lines) if set,
+  and counted in stats() as rows_dropped
+
+Buffering is opt-in per table (WRITE_BUFFER_TABLES, empty by default). A
+buffered row can be read back by ID (db.select_one) as soon as it is
+queued; list and analytics reads see it only after its flush.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+import requests
+
+import db
+
+WRITE_BUFFER_TABLES = {
+    t.strip() for t in os.getenv("WRITE_BUFFER_TABLES", "").split(",") if t.strip()
+}
+WRITE_BUFFER_MAX_ROWS = int(os.getenv("WRITE_BUFFER_MAX_ROWS", "1000"))
+WRITE_BUFFER_MAX_AGE = float(os.getenv("WRITE_BUFFER_MAX_AGE", "1.0"))  # seconds
+# Upper bound on queued rows per table while ClickHouse is unreachable
+WRITE_BUFFER_MAX_PENDING = int(os.getenv("WRITE_BUFFER_MAX_PENDING", "100000"))
+# Failed flushes of a single row before it is dropped, and where dropped rows go
+WRITE_BUFFER_MAX_RETRIES = int(os.getenv("WRITE_BUFFER_MAX_RETRIES", "5"))
+WRITE_BUFFER_DEAD_LETTER_FILE = os.getenv("WRITE_BUFFER_DEAD_LETTER_FILE")
+
+
+class WriteBufferFullError(Exception):
+    """Raised when a table's buffer is at WRITE_BUFFER_MAX_PENDING"""
+    pass
+
+
+class _TableBuffer:
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.oldest: Optional[float] = None
+        # after a rejected batch: flush at most this many rows at a time
+        self.batch_limit: Optional[int] = None
+        # id(row) -> times the row was rejected on its own
+        self.rejections: Dict[int, int] = {}
+        # metrics
+        self.rows_flushed = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rejected_flushes = 0  # failed because ClickHouse refused the rows
+        self.rows_dropped = 0
+        self.last_flush_rows = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_error: Optional[str] = None
+        self.flush_reasons: Dict[str, int] = {}
+
+
+class WriteBuffer:
+    log_tag = "WRITE BUFFER"
+    thread_name = "clickhouse-write-buffer"
+
+    def __init__(self, max_rows: int = WRITE_BUFFER_MAX_ROWS, max_age: float = WRITE_BUFFER_MAX_AGE,
+                 max_pending: int = WRITE_BUFFER_MAX_PENDING, max_retries: int = WRITE_BUFFER_MAX_RETRIES,
+                 dead_letter_file: Optional[str] = WRITE_BUFFER_DEAD_LETTER_FILE):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.dead_letter_file = dead_letter_file
+        self._tables: Dict[str, _TableBuffer] = {}
+        # rows queued by add(), by table and ID, until they are written
+        self._by_id: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        # serializes flushes so rows are written in the order they were added
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _table(self, table: str) -> _TableBuffer:
+        buf = self._tables.get(table)
+        if buf is None:
+            buf = self._tables[table] = _TableBuffer()
+        return buf
+
+    def add(self, table: str, obj: Dict[str, Any]):
+        """Queue a row and return its (possibly generated) ID"""
+        id_field, _ = db._assign_id(table, obj)
+        # versioned now, so a row read back before its flush can be updated or deleted
+        db._stamp_version(table, obj)
+
+        def remember():
+            if id_field:
+                self._by_id.setdefault(table, {})[str(obj[id_field])] = obj
+        self._enqueue(table, [obj], on_queued=remember)
+        return obj.get(id_field) if id_field else None
+
+    def pending_row(self, table: str, row_id: str) -> Optional[Dict[str, Any]]:
+        """A row queued by add() and not yet written, or None"""
+        with self._lock:
+            row = self._by_id.get(table, {}).get(row_id)
+            return dict(row) if row is not None else None
+
+    def _enqueue(self, table: str, rows: List[Dict[str, Any]], on_queued=None):
+        # on_queued runs under the buffer lock, so it cannot interleave with a flush
+        with self._lock:
+            buf = self._table(table)
+            if len(buf.rows) >= self.max_pending:
+                raise WriteBufferFullError(f"Write buffer for {table} is full ({len(buf.rows)} rows pending)")
+            if not buf.rows:
+                buf.oldest = time.monotonic()
+            buf.rows.extend(rows)
+            if on_queued is not None:
+                on_queued()
+            full = len(buf.rows) >= self.max_rows
+        db._queued(table, rows)
+        if full:
+            self._wakeup.set()
+
+    def _write(self, table: str, rows: List[Dict[str, Any]]):
+        # IDs were generated in add(), so no duplicate check is needed
+        db.insert_many(table, rows, check_duplicates=False)
+
+    def _settled(self, table: str, rows: List[Dict[str, Any]]):
+        """Called once rows have left the buffer: written, or dropped"""
+        id_field = db._ID_FIELDS.get(table)
+        with self._lock:
+            pending = self._by_id.get(table)
+            if pending and id_field:
+                for row in rows:
+                    pending.pop(str(row.get(id_field)), None)
+
+    def flush(self, table: Optional[str] = None, reason: str = "manual") -> int:
+        """Flush one table (or all tables) now; returns the number of rows written"""
+        tables = [table] if table else list(self._tables)
+        written = 0
+        with self._flush_lock:
+            for name in tables:
+                written += self._flush_table(name, reason)
+        return written
+
+    def _flush_table(self, table: str, reason: str) -> int:
+        with self._lock:
+            buf = self._tables.get(table)
+            if buf is None or not buf.rows:
+                return 0
+            taken_oldest = buf.oldest
+            limit = buf.batch_limit or len(buf.rows)
+            rows, buf.rows = buf.rows[:limit], buf.rows[limit:]
+            if not buf.rows:
+                buf.oldest = None
+
+        started = time.perf_counter()
+        try:
+            self._write(table, rows)
+        except Exception as e:
+            self._failed(table, buf, rows, e, taken_oldest)
+            return 0
+        self._settled(table, rows)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            for row in rows:
+                buf.rejections.pop(id(row), None)
+            if buf.batch_limit is not None:
+                buf.batch_limit *= 2
+                if buf.batch_limit >= self.max_rows:
+                    buf.batch_limit = None
+            buf.flushes += 1
+            buf.rows_flushed += len(rows)
+            buf.last_flush_rows = len(rows)
+            buf.last_flush_ms = round(elapsed_ms, 2)
+            buf.max_flush_ms = max(buf.max_flush_ms, buf.last_flush_ms)
+            buf.last_error = None
+            buf.flush_reasons[reason] = buf.flush_reasons.get(reason, 0) + 1
+        return len(rows)
+
+    def _failed(self, table: str, buf: _TableBuffer, rows: List[Dict[str, Any]], error: Exception,
+                taken_oldest: Optional[float]):
+        """Put a failed batch back in front of the queue, split or dropped as needed"""
+        # unreachable or timed out: nothing is known about the rows, retry them all later
+        rejected = not isinstance(error, requests.RequestException)
+        dropped = []
+        with self._lock:
+            if rejected and len(rows) == 1:
+                row = rows[0]
+                buf.rejections[id(row)] = buf.rejections.get(id(row), 0) + 1
+                if buf.rejections[id(row)] >= self.max_retries:
+                    del buf.rejections[id(row)]
+                    dropped, rows = rows, []
+            if rejected:
+                buf.rejected_flushes += 1
+                # retry in halves right away, so one bad row holds back as few others as possible
+                buf.batch_limit = max(1, len(rows) // 2)
+                buf.oldest = taken_oldest
+            else:
+                buf.oldest = time.monotonic()
+            buf.rows = rows + buf.rows
+            if not buf.rows:
+                buf.oldest = None
+            buf.failed_flushes += 1
+            buf.rows_dropped += len(dropped)
+            buf.last_error = str(error)
+        print(f"[{self.log_tag}] Failed to flush {len(rows) + len(dropped)} rows into {table}: {error}")
+        if dropped:
+            self._dead_letter(table, dropped, error)
+
+    def _dead_letter(self, table: str, rows: List[Dict[str, Any]], error: Exception):
+        print(f"[{self.log_tag}] Dropped {len(rows)} rows for {table} after {self.max_retries} failed flushes: "
+              f"{json.dumps(rows, default=str)}")
+        if self.dead_letter_file:
+            try:
+                with open(self.dead_letter_file, "a") as f:
+                    for row in rows:
+                        f.write(json.dumps({"table": table, "error": str(error), "row": row}, default=str) + "\n")
+            except OSError as e:
+                print(f"[{self.log_tag}] Could not write dead letters to {self.dead_letter_file}: {e}")
+        self._settled(table, rows)
+        db._dropped(table, rows)
+
+    def _due(self) -> Dict[str, str]:
+        now = time.monotonic()
+        due = {}
+        with self._lock:
+            for name, buf in self._tables.items():
+                if len(buf.rows) >= self.max_rows:
+                    due[name] = "size"
+                elif buf.oldest is not None and now - buf.oldest >= self.max_age:
+                    due[name] = "age"
+        return due
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(timeout=self.max_age / 2)
+            self._wakeup.clear()
+            for table, reason in self._due().items():
+                try:
+                    with self._flush_lock:
+                        self._flush_table(table, reason)
+                except Exception:
+                    traceback.print_exc()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher thread and write out everything still queued"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        # a rejected batch comes back split: keep flushing until ClickHouse is
+        # unreachable or nothing is left (every rejection brings a drop closer)
+        while any(buf.rows for buf in self._tables.values()):
+            rejected = sum(buf.rejected_flushes for buf in self._tables.values())
+            if not self.flush(reason="shutdown") and \
+                    rejected == sum(buf.rejected_flushes for buf in self._tables.values()):
+                break
+        pending = {name: len(buf.rows) for name, buf in self._tables.items() if buf.rows}
+        if pending:
+            print(f"[{self.log_tag}] Rows lost on shutdown (ClickHouse unavailable): {pending}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_rows": self.max_rows,
+                "max_age_seconds": self.max_age,
+                "max_retries": self.max_retries,
+                "tables": {
+                    name: {
+                        "pending_rows": len(buf.rows),
+                        "rows_flushed": buf.rows_flushed,
+                        "flushes": buf.flushes,
+                        "failed_flushes": buf.failed_flushes,
+                        "rejected_flushes": buf.rejected_flushes,
+                        "rows_dropped": buf.rows_dropped,
+                        "batch_limit": buf.batch_limit,
+                        "last_flush_rows": buf.last_flush_rows,
+                        "last_flush_ms": buf.last_flush_ms,
+                        "max_flush_ms": buf.max_flush_ms,
+                        "flush_reasons": dict(buf.flush_reasons),
+                        "last_error": buf.last_error,
+                    }
+                    for name, buf in self._tables.items()
+                },
+            }
+
+
+write_buffer = WriteBuffer()
+db._pending_insert = write_buffer.pending_row
+
+
+def buffered_insert(table: str, obj: Dict[str, Any]):
+    """Insert through the write buffer when it is enabled for the table.
+
+    Rows carrying a caller-supplied ID are written directly so the duplicate
+    check in db.insert_one still runs before the request returns.
+    """
+    id_field = db._ID_FIELDS.get(table)
+    if table not in WRITE_BUFFER_TABLES or (id_field and obj.get(id_field) is not None):
+        return db.insert_one(table, obj)
+    return write_buffer.add(table, obj)
@@ -1,10 +1,14 @@
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from config import settings
+from database import revocations_collection
 from models import TokenData
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -21,6 +25,33 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+# bcrypt takes tens of milliseconds of CPU; keep it off the event loop
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_in_threadpool(verify_password, plain_password, hashed_password)
+
+
+async def aget_password_hash(password: str) -> str:
+    return await run_in_threadpool(get_password_hash, password)
+
+
+def _load_keys() -> Tuple[Dict[str, str], str]:
+    """Signing keys by kid, and the kid new tokens are signed with"""
+    keys = {}
+    for item in settings.JWT_KEYS.split(","):
+        kid, _, secret = item.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret
+    if not keys:
+        keys = {"default": settings.SECRET_KEY}
+    active = settings.JWT_ACTIVE_KID or next(iter(keys))
+    if active not in keys:
+        raise RuntimeError(f"JWT_ACTIVE_KID {active!r} is not in JWT_KEYS")
+    return keys, active
+
+
+SIGNING_KEYS, ACTIVE_KID = _load_keys()
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create a JWT access token"""
     to_encode = data.copy()
@@ -29,36 +60,94 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+    # iat and jti let a single token, or all of a user's tokens, be revoked
+    to_encode.update({"exp": expire, "iat": int(time.time()), "jti": uuid4().hex})
+    encoded_jwt = jwt.encode(to_encode, SIGNING_KEYS[ACTIVE_KID], algorithm=settings.ALGORITHM,
+                             headers={"kid": ACTIVE_KID})
     return encoded_jwt
 
 
-def decode_token(token: str) -> TokenData:
+def _credentials_error() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials"
+    )
+
+
+def _verify_signature(token: str) -> dict:
+    """Claims of a token signed with any of SIGNING_KEYS"""
+    kid = jwt.get_unverified_header(token).get("kid")
+    if kid is not None:
+        if kid not in SIGNING_KEYS:
+            raise JWTError(f"Unknown key id {kid}")
+        return jwt.decode(token, SIGNING_KEYS[kid], algorithms=[settings.ALGORITHM])
+    # tokens issued before key ids were added
+    for secret in SIGNING_KEYS.values():
+        try:
+            return jwt.decode(token, secret, algorithms=[settings.ALGORITHM])
+        except JWTError as e:
+            error = e
+    raise error
+
+
+async def is_revoked(payload: dict) -> bool:
+    """Whether the token itself or all tokens of its user issued before it were revoked"""
+    conditions = [{"username": payload.get("sub"), "revoked_before": {"$gt": payload.get("iat", 0)}}]
+    if payload.get("jti"):
+        conditions.append({"jti": payload["jti"]})
+    return await revocations_collection.find_one({"$or": conditions}, {"_id": 1}) is not None
+
+
+async def decode_token(token: str) -> TokenData:
     """Decode and validate a JWT token"""
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        username: str = payload.get("sub")
-        role: str = payload.get("role")
-        
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials"
-            )
-        
-        return TokenData(username=username, role=role)
+        payload = _verify_signature(token)
     except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials"
-        )
+        raise _credentials_error()
+
+    username: str = payload.get("sub")
+    role: str = payload.get("role")
+
+    if username is None or await is_revoked(payload):
+        raise _credentials_error()
+
+    expires = payload.get("exp")
+    return TokenData(username=username, role=role, jti=payload.get("jti"),
+                     expires_at=datetime.utcfromtimestamp(expires) if expires else None)
+
+
+async def revoke_token(current_user: TokenData) -> None:
+    """Revoke one token (logout)"""
+    if not current_user.jti:
+        # a token without a jti can only be revoked with the rest of the user's tokens
+        await revoke_user_tokens(current_user.username)
+        return
+    await revocations_collection.insert_one({
+        "jti": current_user.jti,
+        "username": current_user.username,
+        "created_at": datetime.utcnow(),
+        "expires_at": current_user.expires_at or datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
+    })
+
+
+async def revoke_user_tokens(username: str) -> None:
+    """Revoke every token issued to username so far (password change, deletion)"""
+    now = datetime.utcnow()
+    await revocations_collection.insert_one({
+        "username": username,
+        # tokens issued in this same second stay valid, so a login right
+        # after a password change is not caught by its own revocation
+        "revoked_before": int(time.time()),
+        "created_at": now,
+        # every token issued before now has expired by then
+        "expires_at": now + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
+    })
 
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenData:
     """Get the current authenticated user from token"""
     token = credentials.credentials
-    return decode_token(token)
+    return await decode_token(token)
 
 
 async def require_role(required_role: str):
@@ -0,0 +1,148 @@
+"""
+Throughput at high concurrency: threadpool routes vs. async routes.
+
+- threadpool: GET /me and GET /users/{id}/balance written as before, as
+  plain `def` handlers over a synchronous pymongo.MongoClient, so
+  Starlette runs each request on its worker threadpool (40 threads by
+  default); same middleware and command listener as the service
+- async: the same requests against main.app, whose handlers await
+  pymongo's AsyncMongoClient
+
+Both apps are driven in-process through httpx's ASGI transport, so the
+handler model and the driver are the only differences. Requests alternate
+between the two endpoints for a set of seeded members. Runs against the
+MongoDB in MONGODB_URL, in a scratch database (BENCH_DB_NAME, default
+fitness_users_bench) that is dropped at the end.
+
+    cd user-service
+    MONGODB_URL=mongodb://localhost:27017 python benchmarks/async_vs_threadpool.py [requests] [concurrency,...]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+# never the service's own database: it is dropped at the end
+os.environ["MONGODB_DB_NAME"] = os.getenv("BENCH_DB_NAME", "fitness_users_bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import anyio  # noqa: E402
+import httpx  # noqa: E402
+from bson import ObjectId  # noqa: E402
+from fastapi import Depends, FastAPI, HTTPException  # noqa: E402
+from fastapi.security import HTTPAuthorizationCredentials  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+import main as service  # noqa: E402
+import metrics  # noqa: E402
+from auth import _verify_signature, create_access_token, security  # noqa: E402
+from config import settings  # noqa: E402
+from database import close_db, init_db  # noqa: E402
+
+MEMBERS = 200
+
+sync_client = MongoClient(settings.MONGODB_URL, maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+                          event_listeners=[metrics.MongoCommandMetrics()])
+sync_users = sync_client[settings.MONGODB_DB_NAME]["users"]
+sync_revocations = sync_client[settings.MONGODB_DB_NAME]["token_revocations"]
+
+threadpool_app = FastAPI()
+# same CORS and metrics middleware as the service
+threadpool_app.user_middleware = list(service.app.user_middleware)
+
+
+def sync_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    payload = _verify_signature(credentials.credentials)
+    conditions = [{"username": payload["sub"], "revoked_before": {"$gt": payload.get("iat", 0)}},
+                  {"jti": payload.get("jti")}]
+    if sync_revocations.find_one({"$or": conditions}, {"_id": 1}) is not None:
+        raise HTTPException(status_code=401)
+    return payload
+
+
+@threadpool_app.get("/me")
+def sync_me(current_user: dict = Depends(sync_current_user)):
+    user = sync_users.find_one({"username": current_user["sub"]})
+    user["_id"] = str(user["_id"])
+    user.pop("hashed_password", None)
+    return user
+
+
+@threadpool_app.get("/users/{user_id}/balance")
+def sync_balance(user_id: str, current_user: dict = Depends(sync_current_user)):
+    user = sync_users.find_one({"_id": ObjectId(user_id)})
+    return {"user_id": str(user["_id"]), "balance": user.get("balance", 0.0)}
+
+
+def seed():
+    sync_client.drop_database(settings.MONGODB_DB_NAME)
+    members = []
+    for i in range(MEMBERS):
+        username = f"bench{i}"
+        result = sync_users.insert_one({
+            "username": username, "email": f"{username}@bench.example.com", "full_name": "Benchmark",
+            "role": "member", "balance": 100.0, "hashed_password": "-", "is_active": True,
+            "created_at": datetime.utcnow(), "updated_at": datetime.utcnow(),
+        })
+        members.append((str(result.inserted_id), create_access_token({"sub": username, "role": "member"})))
+    return members
+
+
+async def run(app, members, requests: int, concurrency: int) -> dict:
+    samples = []
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+    # unhandled errors (e.g. pool wait queue timeouts under overload) count
+    # as 500s, as behind a server, instead of aborting the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i: int):
+            nonlocal errors
+            user_id, token = members[i % len(members)]
+            path = "/me" if i % 2 else f"/users/{user_id}/balance"
+            async with limit:
+                started = time.perf_counter()
+                resp = await client.get(path, headers={"Authorization": f"Bearer {token}"})
+                samples.append((time.perf_counter() - started) * 1000)
+                errors += resp.status_code != 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - started
+    samples.sort()
+    return {
+        "per_second": round(requests / elapsed),
+        "p50_ms": round(samples[len(samples) // 2], 2),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "mean_ms": round(statistics.mean(samples), 2),
+        "errors": errors,
+    }
+
+
+async def bench(requests: int, levels):
+    members = seed()
+    await init_db()
+    try:
+        threads = anyio.to_thread.current_default_thread_limiter().total_tokens
+        print(f"{requests} requests per run, {MEMBERS} members, threadpool of {threads}")
+        for concurrency in levels:
+            for label, app in (("threadpool + MongoClient", threadpool_app), ("async + AsyncMongoClient", service.app)):
+                await run(app, members, min(requests, 200), concurrency)  # warm-up: pools, indexes
+                print(f"  {concurrency:>5} in flight  {label:<25}: {await run(app, members, requests, concurrency)}")
+    finally:
+        await close_db()
+        sync_client.drop_database(settings.MONGODB_DB_NAME)
+        sync_client.close()
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    levels = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [50, 200, 1000]
+    asyncio.run(bench(requests, levels))
+
+
+if __name__ == "__main__":
+    main()
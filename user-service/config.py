@@ -5,11 +5,23 @@ class Settings(BaseSettings):
     # MongoDB settings
     MONGODB_URL: str = "mongodb://mongodb:27017"
     MONGODB_DB_NAME: str = "fitness_users"
+    # Connection pool (per process): requests beyond MONGODB_MAX_POOL_SIZE
+    # wait for a free connection, at most MONGODB_WAIT_QUEUE_TIMEOUT_MS
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 10
+    MONGODB_MAX_CONNECTING: int = 4
+    MONGODB_MAX_IDLE_TIME_MS: int = 300000
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: int = 2000
     
     # JWT settings
     SECRET_KEY: str = "your-secret-key-change-this-in-production"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # Key rotation: "kid:secret,kid:secret". New tokens are signed with
+    # JWT_ACTIVE_KID (default: the first key); every listed key still
+    # verifies. Empty means SECRET_KEY under kid "default".
+    JWT_KEYS: str = ""
+    JWT_ACTIVE_KID: str = ""
     
     class Config:
         env_file = ".env"
@@ -1,19 +1,42 @@
-from pymongo import MongoClient, ASCENDING
+from pymongo import AsyncMongoClient, ASCENDING
 from config import settings
+from metrics import MongoCommandMetrics
 
-client = MongoClient(settings.MONGODB_URL)
+client = AsyncMongoClient(
+    settings.MONGODB_URL,
+    event_listeners=[MongoCommandMetrics()],
+    maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+    maxConnecting=settings.MONGODB_MAX_CONNECTING,
+    maxIdleTimeMS=settings.MONGODB_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+)
 db = client[settings.MONGODB_DB_NAME]
 
 # Collections
 users_collection = db["users"]
+# revoked token ids (jti) and per-user "tokens issued before" cutoffs
+revocations_collection = db["token_revocations"]
 
 
-def init_db():
+async def init_db():
     """Initialize database with indexes and constraints"""
     # Create unique index on email
-    users_collection.create_index([("email", ASCENDING)], unique=True)
+    await users_collection.create_index([("email", ASCENDING)], unique=True)
     
     # Create index on username
-    users_collection.create_index([("username", ASCENDING)], unique=True)
+    await users_collection.create_index([("username", ASCENDING)], unique=True)
+
+    # Revocations: looked up by jti or username, synced by created_at,
+    # and dropped by MongoDB once the tokens they cover have expired
+    await revocations_collection.create_index([("jti", ASCENDING)], sparse=True)
+    await revocations_collection.create_index([("username", ASCENDING)])
+    await revocations_collection.create_index([("created_at", ASCENDING)])
+    await revocations_collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
     
     print("Database initialized successfully")
+
+
+async def close_db():
+    """Close pooled MongoDB connections (called on shutdown)"""
+    await client.close()
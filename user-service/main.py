@@ -1,19 +1,23 @@
 from fastapi import FastAPI, HTTPException, status, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Optional
 import uvicorn
+from pymongo import ReturnDocument
 
-from database import users_collection, init_db
+from database import users_collection, revocations_collection, init_db, close_db
 from models import UserCreate, UserResponse, UserUpdate, LoginRequest, Token, TokenData, BalanceUpdate, BalanceResponse
 from auth import (
-    get_password_hash, 
-    verify_password, 
+    aget_password_hash,
+    averify_password,
     create_access_token, 
     get_current_user,
-    require_admin
+    require_admin,
+    revoke_token,
+    revoke_user_tokens
 )
 from config import settings
+import metrics
 
 app = FastAPI(
     title="User Service",
@@ -29,28 +33,40 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     """Initialize database on startup"""
     try:
-        init_db()
+        await init_db()
         print("User service started successfully")
     except Exception as e:
         print(f"Error initializing database: {e}")
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_db()
+
+
 @app.get("/")
-def root():
+async def root():
     return {"message": "User Service is running!"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return metrics.metrics_response()
+
+
 @app.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def register_user(user: UserCreate):
+async def register_user(user: UserCreate):
     """Register a new user"""
     # Check if user already exists
-    existing_user = users_collection.find_one({
+    existing_user = await users_collection.find_one({
         "$or": [
             {"email": user.email},
             {"username": user.username}
@@ -65,25 +81,25 @@ def register_user(user: UserCreate):
     
     # Create user document
     user_dict = user.model_dump()
-    user_dict["hashed_password"] = get_password_hash(user_dict.pop("password"))
+    user_dict["hashed_password"] = await aget_password_hash(user_dict.pop("password"))
     user_dict["created_at"] = datetime.utcnow()
     user_dict["updated_at"] = datetime.utcnow()
     user_dict["is_active"] = True
     
     # Insert into database
-    result = users_collection.insert_one(user_dict)
+    result = await users_collection.insert_one(user_dict)
     user_dict["_id"] = str(result.inserted_id)
     
     return UserResponse(**user_dict)
 
 
 @app.post("/login", response_model=Token)
-def login(login_data: LoginRequest):
+async def login(login_data: LoginRequest):
     """Login and get access token"""
     # Find user by username
-    user = users_collection.find_one({"username": login_data.username})
+    user = await users_collection.find_one({"username": login_data.username})
     
-    if not user or not verify_password(login_data.password, user["hashed_password"]):
+    if not user or not await averify_password(login_data.password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
@@ -106,9 +122,9 @@ def login(login_data: LoginRequest):
 
 
 @app.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: TokenData = Depends(get_current_user)):
+async def get_current_user_info(current_user: TokenData = Depends(get_current_user)):
     """Get current user information"""
-    user = users_collection.find_one({"username": current_user.username})
+    user = await users_collection.find_one({"username": current_user.username})
     
     if not user:
         raise HTTPException(
@@ -121,7 +137,7 @@ def get_current_user_info(current_user: TokenData = Depends(get_current_user)):
 
 
 @app.get("/users", response_model=List[UserResponse])
-def list_users(
+async def list_users(
     role: str = None,
     current_user: TokenData = Depends(require_admin)
 ):
@@ -131,7 +147,7 @@ def list_users(
         query["role"] = role
     
     users = []
-    for user in users_collection.find(query):
+    async for user in users_collection.find(query):
         user["_id"] = str(user["_id"])
         users.append(UserResponse(**user))
     
@@ -139,7 +155,7 @@ def list_users(
 
 
 @app.get("/users/{user_id}", response_model=UserResponse)
-def get_user(
+async def get_user(
     user_id: str,
     current_user: TokenData = Depends(get_current_user)
 ):
@@ -149,7 +165,7 @@ def get_user(
     from bson import ObjectId
     
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -177,7 +193,7 @@ def get_user(
 
 
 @app.put("/users/{user_id}", response_model=UserResponse)
-def update_user(
+async def update_user(
     user_id: str,
     user_update: UserUpdate,
     current_user: TokenData = Depends(get_current_user)
@@ -186,7 +202,7 @@ def update_user(
     from bson import ObjectId
     
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
     except:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -209,25 +225,30 @@ def update_user(
     # Prepare update data
     update_data = user_update.model_dump(exclude_unset=True)
     
-    if "password" in update_data:
-        update_data["hashed_password"] = get_password_hash(update_data.pop("password"))
+    password_changed = "password" in update_data
+    if password_changed:
+        update_data["hashed_password"] = await aget_password_hash(update_data.pop("password"))
     
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
-        users_collection.update_one(
+        await users_collection.update_one(
             {"_id": ObjectId(user_id)},
             {"$set": update_data}
         )
     
+    # sessions opened with the old password end here
+    if password_changed:
+        await revoke_user_tokens(user["username"])
+    
     # Get updated user
-    updated_user = users_collection.find_one({"_id": ObjectId(user_id)})
+    updated_user = await users_collection.find_one({"_id": ObjectId(user_id)})
     updated_user["_id"] = str(updated_user["_id"])
     
     return UserResponse(**updated_user)
 
 
 @app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user(
+async def delete_user(
     user_id: str,
     current_user: TokenData = Depends(require_admin)
 ):
@@ -235,24 +256,25 @@ def delete_user(
     from bson import ObjectId
     
     try:
-        result = users_collection.delete_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one_and_delete({"_id": ObjectId(user_id)}, {"username": 1})
     except:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid user ID format"
         )
     
-    if result.deleted_count == 0:
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
+    await revoke_user_tokens(user["username"])
     return None
 
 
 @app.post("/verify-token")
-def verify_token(current_user: TokenData = Depends(get_current_user)):
+async def verify_token(current_user: TokenData = Depends(get_current_user)):
     """Verify if a token is valid"""
     return {
         "valid": True,
@@ -261,13 +283,42 @@ def verify_token(current_user: TokenData = Depends(get_current_user)):
     }
 
 
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(current_user: TokenData = Depends(get_current_user)):
+    """Revoke the token used for this request"""
+    await revoke_token(current_user)
+    return None
+
+
+@app.get("/revocations")
+async def list_revocations(
+    since: Optional[datetime] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    """Revocations recorded since `since` (all unexpired ones if omitted),
+    for services that verify tokens locally"""
+    if current_user.role not in ["service", "admin"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access denied"
+        )
+    
+    server_time = datetime.utcnow()
+    query = {"expires_at": {"$gt": server_time}}
+    if since is not None:
+        query["created_at"] = {"$gte": since.replace(tzinfo=None)}
+    
+    revocations = await revocations_collection.find(query, {"_id": 0, "created_at": 0}).to_list()
+    return {"server_time": server_time, "revocations": revocations}
+
+
 @app.get("/users/{user_id}/balance", response_model=BalanceResponse)
-def get_user_balance(user_id: str, current_user: TokenData = Depends(get_current_user)):
+async def get_user_balance(user_id: str, current_user: TokenData = Depends(get_current_user)):
     """Get user's current balance"""
     from bson import ObjectId
     
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
     except:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -294,7 +345,7 @@ def get_user_balance(user_id: str, current_user: TokenData = Depends(get_current
 
 
 @app.post("/users/{user_id}/balance/add", response_model=BalanceResponse)
-def add_balance(
+async def add_balance(
     user_id: str,
     balance_update: BalanceUpdate,
     current_user: TokenData = Depends(get_current_user)
@@ -303,7 +354,7 @@ def add_balance(
     from bson import ObjectId
     
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await users_collection.find_one({"_id": ObjectId(user_id)})
     except:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -323,23 +374,27 @@ def add_balance(
             detail="Access denied"
         )
     
-    current_balance = user.get("balance", 0.0)
-    new_balance = current_balance + balance_update.amount
-    
-    users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"balance": new_balance, "updated_at": datetime.utcnow()}}
+    # $inc rather than read-modify-write, so concurrent top-ups all count
+    updated = await users_collection.find_one_and_update(
+        {"_id": user["_id"]},
+        {"$inc": {"balance": balance_update.amount}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
     )
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
     
     return BalanceResponse(
-        user_id=str(user["_id"]),
-        balance=new_balance,
-        previous_balance=current_balance
+        user_id=str(updated["_id"]),
+        balance=updated["balance"],
+        previous_balance=updated["balance"] - balance_update.amount
     )
 
 
 @app.post("/users/{user_id}/balance/deduct", response_model=BalanceResponse)
-def deduct_balance(
+async def deduct_balance(
     user_id: str,
     balance_update: BalanceUpdate,
     current_user: TokenData = Depends(get_current_user)
@@ -351,39 +406,37 @@ def deduct_balance(
     from bson import ObjectId
     
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        object_id = ObjectId(user_id)
     except:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid user ID format"
         )
     
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    current_balance = user.get("balance", 0.0)
+    # Check and deduct in one step, so concurrent bookings cannot both
+    # spend the same funds
+    updated = await users_collection.find_one_and_update(
+        {"_id": object_id, "balance": {"$gte": balance_update.amount}},
+        {"$inc": {"balance": -balance_update.amount}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
     
-    # Check sufficient funds
-    if current_balance < balance_update.amount:
+    if not updated:
+        user = await users_collection.find_one({"_id": object_id}, {"balance": 1})
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_402_PAYMENT_REQUIRED,
-            detail=f"Insufficient balance. Current: {current_balance}, Required: {balance_update.amount}"
+            detail=f"Insufficient balance. Current: {user.get('balance', 0.0)}, Required: {balance_update.amount}"
         )
     
-    new_balance = current_balance - balance_update.amount
-    
-    users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"balance": new_balance, "updated_at": datetime.utcnow()}}
-    )
-    
     return BalanceResponse(
-        user_id=str(user["_id"]),
-        balance=new_balance,
-        previous_balance=current_balance
+        user_id=str(updated["_id"]),
+        balance=updated["balance"],
+        previous_balance=updated["balance"] + balance_update.amount
     )
 
 
@@ -0,0 +1,74 @@
+"""
+Prometheus metrics for the user service, served on /metrics.
+
+- http_request_duration_seconds / http_requests_in_flight: per route
+- mongodb_command_seconds: every MongoDB command, by command name
+"""
+import time
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served", ["method"])
+
+MONGODB_COMMAND_SECONDS = Histogram(
+    "mongodb_command_seconds", "MongoDB command latency", ["command"], buckets=_LATENCY_BUCKETS,
+)
+MONGODB_COMMAND_ERRORS = Counter("mongodb_command_errors_total", "Failed MongoDB commands", ["command"])
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo listener timing every command sent to MongoDB"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGODB_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGODB_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGODB_COMMAND_ERRORS.labels(event.command_name).inc()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency and in-flight requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = HTTP_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            # label by route template (/users/{user_id}), not the raw path
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -50,6 +50,8 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: Optional[str] = None
     role: Optional[str] = None
+    jti: Optional[str] = None
+    expires_at: Optional[datetime] = None
 
 
 class LoginRequest(BaseModel):